@@ -1,6 +1,8 @@
 from data_formatter.arg_parse import parse
+import sys
 import warnings
 from data_formatter.data_formatter import DataFormatter
+from data_formatter.shard import run_local_shards
 
 
 def main() -> None:
@@ -9,17 +11,46 @@ def main() -> None:
     input_folder = args.input
     output_folder = args.output
     formatter = DataFormatter(input_folder, output_folder, print_folders=args.print_folders,
-                              log_path=args.log, err_path=args.err, record_path=args.record)
+                              log_path=args.log, err_path=args.err, record_path=args.record,
+                              inventory_path=args.inventory, workers=args.workers,
+                              assembly=args.assembly, incremental=args.incremental, hash_files=args.hash,
+                              cache_dir=args.cache, cache_size=args.cache_size * 1024 * 1024,
+                              metrics_path=args.metrics, prometheus_path=args.prometheus,
+                              metrics_interval=args.metrics_interval, scan_workers=args.scan_workers,
+                              skip_invalid_folders=args.skip_invalid_folders, shard=args.shard,
+                              max_decode_memory=args.max_decode_memory * 1024 * 1024)
 
-    if args.extract_csv:
-        formatter.extract_csv()
+    if args.local_shards is not None:
+        # every shard runs with the same arguments, in its own process
+        run_local_shards(_without_option(sys.argv[1:], '--local_shards'), args.local_shards)
+        formatter.combine_shards(args.local_shards)
+    elif args.combine is not None:
+        formatter.combine_shards(args.combine)
+    elif args.extract_csv:
+        formatter.extract_csv(args.export_format, args.export_append)
         if args.extract_patients:
             formatter.extract_patient_folders()
     elif args.extract_patients:
         formatter.extract_patient_folders()
     else:
         formatter.format()
-        formatter.extract_csv()
+        formatter.extract_csv(args.export_format, args.export_append)
+
+
+def _without_option(argv, option):
+    """
+    Return argv without the option and its value
+    """
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + '='):
+            result.append(arg)
+    return result
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import argparse
+from data_formatter.shard import parse_shard
 
 
 def parse():
@@ -7,10 +8,59 @@ def parse():
     parser.add_argument('--output', type=str, default='H:\MKIS\Output')
     parser.add_argument('--log', type=str, default=None)
     parser.add_argument('--err', type=str, default=None)
-    parser.add_argument('--record', type=str, default=None)
+    parser.add_argument('--record', type=str, default=None,
+                        help='record of the processed files (.db). A .txt record of a previous version is imported')
+    parser.add_argument('--inventory', type=str, default=None,
+                        help='save the scan of the input folder in this file, and reuse it with --extract_csv and '
+                             '--extract_patients')
     parser.add_argument('--time', type=str, default='creation', help='choose between creation time and modification time')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to convert the files')
+    parser.add_argument('--scan_workers', type=int, default=1,
+                        help='number of directories listed at the same time during the scan, e.g. 16 on a network share')
+    parser.add_argument('--skip_invalid_folders', action='store_true',
+                        help='do not scan the folders named Arch, Stoma, Wund or Patientenunterlagen outside the '
+                             'patient folders')
+    parser.add_argument('--assembly', type=str, default='merger', choices=['merger', 'stream'],
+                        help="'stream' copies the converted files one at a time into the PDF of every patient, so the "
+                             "memory used doesn't grow with the number of pages")
+    parser.add_argument('--incremental', action='store_true',
+                        help='process again only the patients whose files have changed since the last run')
+    parser.add_argument('--hash', action='store_true',
+                        help='with --incremental, identify the files by their content, so moved files are not changes')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='folder of a cache of the converted PDFs, to convert identical files only once')
+    parser.add_argument('--cache_size', type=int, default=2048, help='maximum size of the cache in MB')
+    parser.add_argument('--max_decode_memory', type=int, default=128,
+                        help='memory in MB used at most to decode an image that has to be resized. Larger images are '
+                             'decoded at a reduced resolution')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='save the time spent in every stage, the conversions by data format and the slowest files '
+                             'in this JSON file')
+    parser.add_argument('--prometheus', type=str, default=None, help='save the metrics in this Prometheus textfile')
+    parser.add_argument('--metrics_interval', type=float, default=None,
+                        help='also save the metrics every this number of seconds during the run')
+    parser.add_argument('--shard', type=_shard, default=None,
+                        help='process only the shard K/N of the patients, e.g. 1/4, with its own log, err file, record '
+                             'and patient exports. Every shard can run on a different machine')
+    parser.add_argument('--combine', type=int, default=None,
+                        help='fold the outputs of the given number of shards into the usual log, err file, record and '
+                             'patient exports')
+    parser.add_argument('--local_shards', type=int, default=None,
+                        help='run the given number of shards in as many processes on this machine, and combine them')
     parser.add_argument('--extract_csv', action='store_true')
+    parser.add_argument('--export_format', type=str, nargs='+', default=['csv'], choices=['csv', 'jsonl', 'parquet'],
+                        help='formats of the patients file: csv_file.csv, patients.jsonl and patients.parquet (needs '
+                             'pyarrow)')
+    parser.add_argument('--export_append', action='store_true',
+                        help='add only the new patients to the patients files instead of writing them again')
     parser.add_argument('--extract_patients', action='store_true')
     parser.add_argument('--print_folders', action='store_true')
     args = parser.parse_args()
     return args
+
+
+def _shard(text):
+    try:
+        return parse_shard(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
@@ -0,0 +1,440 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from data_formatter.data_formatter import DataFormatter, merge_pdfs, invalid_folders, _conversion_results, \
+    _timed_file_to_pdf
+from data_formatter.inventory import Inventory
+from data_formatter.manifest import PatientManifest
+from data_formatter.output_planner import OutputPlanner
+from data_formatter.patient_parser import extract_patients_data, _extract_patient_data
+from data_formatter.pdf_converter import file_to_pdf, resample_image
+from data_formatter.office import benchmark_pool
+from data_formatter.tree_generator import DEFAULT_FORMATS, generate_tree, make_templates
+
+# numbers of files of the benchmarked trees
+DEFAULT_SCALES = [1000, 10000, 100000]
+# memory that resample_image may use on top of the decode ceiling, for the resized image and the PDF encoder
+DECODE_MEMORY_MARGIN = 32 * 1024 * 1024
+# seconds of every directory listing in the scan benchmark, like a round trip to a network share ...
+SCAN_LATENCY = 0.002
+# ... and the numbers of threads that list the directories
+SCAN_WORKERS = [1, 4, 16]
+# modules whose import is timed by benchmark_startup ...
+STARTUP_MODULES = ['data_formatter.__main__', 'data_formatter.data_formatter']
+# ... and the dependencies of the converters, that they should not import
+CONVERTER_DEPENDENCIES = ['PIL', 'PyPDF2', 'extract_msg', 'tqdm', 'pdf2image', 'comtypes', 'win32com']
+# a timing is a regression when it is slower than the previous results by more than this share ...
+REGRESSION_THRESHOLD = 0.1
+# ... and by more than this number of seconds, so that the noise of the short timings is ignored
+MIN_REGRESSION_SECONDS = 0.005
+
+
+@contextlib.contextmanager
+def _quiet():
+    """
+    Hide what is printed to stdout, e.g. the log printed by DataFormatter.format
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def benchmark_stages(in_path, out_path, workers=1, assembly='merger'):
+    """
+    Run the stages of DataFormatter.format one after the other on the input folder in_path, and return the seconds
+    taken by each of them:
+    - scan: the walk of the input folder, with the parsing of the folder names done by the Inventory
+    - parse: the parsing of all the patient folder names, without the memoized results
+    - convert: the planning of the output paths and the conversion of all the files to PDF, with workers processes
+    - merge: the merge of the PDFs of every patient, with the given assembly
+    - metadata: the metadata files of the patients
+    """
+    times = {}
+    formatter = DataFormatter(in_path, out_path, workers=workers, assembly=assembly)
+
+    start = time.perf_counter()
+    inventory = Inventory.scan(formatter.abs_in_path)
+    times['scan'] = time.perf_counter() - start
+
+    _extract_patient_data.cache_clear()
+    start = time.perf_counter()
+    extract_patients_data([patient.name for patient in inventory.patients])
+    times['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    planner = OutputPlanner()
+    manifests = []
+    try:
+        for patient in inventory.patients:
+            out_paths = planner.plan(formatter._output_dir(patient.folder),
+                                     [os.path.basename(file_entry.path) for file_entry in patient.files])
+            jobs = [(file_entry.path, out_path_file, file_entry.ctime)
+                    for file_entry, out_path_file in zip(patient.files, out_paths)]
+            if executor is None:
+                results = [_timed_file_to_pdf(in_path_file, out_path_file) for in_path_file, out_path_file, _ in jobs]
+            else:
+                results = _conversion_results([formatter._submit_conversion(executor, in_path_file, out_path_file)
+                                               for in_path_file, out_path_file, _ in jobs])
+            manifest = PatientManifest(formatter._output_dir(patient.folder))
+            for (_, out_path_file, path_time), (error_msg, _) in zip(jobs, results):
+                if error_msg is None:
+                    manifest.add(out_path_file, path_time)
+            manifests.append(manifest)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    times['convert'] = time.perf_counter() - start
+
+    manifests = [manifest for manifest in manifests if len(manifest) > 0]
+    start = time.perf_counter()
+    for manifest in manifests:
+        merge_pdfs(manifest, assembly)
+    times['merge'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with _quiet():
+        for manifest in manifests:
+            formatter._make_metadata(manifest.out_dir)
+    times['metadata'] = time.perf_counter() - start
+    return times
+
+
+class LatencyScandir:
+    def __init__(self, latency=SCAN_LATENCY):
+        """
+        Stand-in for os.scandir on a network share, on a local folder: every directory listing waits latency seconds
+        before it starts, like a round trip to the server. It counts the listings
+        """
+        self.latency = latency
+        self.n_listings = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        with self._lock:
+            self.n_listings += 1
+        time.sleep(self.latency)
+        return os.scandir(path)
+
+
+def benchmark_scan(in_path, latency=SCAN_LATENCY, workers=SCAN_WORKERS):
+    """
+    Scan the input folder in_path with LatencyScandir and every number of workers, skipping the invalid folders, and
+    return the seconds taken by each scan. Check that all the scans return the same inventory
+    """
+    results = {'latency': latency, 'seconds': {}}
+    inventories = []
+    for n_workers in workers:
+        scandir = LatencyScandir(latency)
+        start = time.perf_counter()
+        inventory = Inventory.scan(in_path, n_workers, invalid_folders, scandir)
+        results['seconds'][str(n_workers)] = time.perf_counter() - start
+        results['directories'] = scandir.n_listings
+        inventories.append([(patient.folder, patient.files) for patient in inventory.patients])
+    if any(inventory != inventories[0] for inventory in inventories):
+        raise RuntimeError('The concurrent scan of {} returned a different inventory'.format(in_path))
+    return results
+
+
+def benchmark_format(in_path, out_path, **kwargs):
+    """
+    Return the seconds taken by DataFormatter.format and by DataFormatter.extract_csv on the input folder in_path. The
+    keyword arguments are passed to DataFormatter
+    """
+    formatter = DataFormatter(in_path, out_path, **kwargs)
+    times = {}
+    with _quiet():
+        start = time.perf_counter()
+        formatter.format()
+        times['format'] = time.perf_counter() - start
+        start = time.perf_counter()
+        formatter.extract_csv()
+        times['extract_csv'] = time.perf_counter() - start
+    return times
+
+
+def benchmark_converters(work_dir, formats=DEFAULT_FORMATS, repeat=50, **template_args):
+    """
+    Return the total, the mean and the minimum seconds taken by file_to_pdf on a file of every data format, converted
+    repeat times. The files are made by make_templates with the keyword arguments
+    """
+    results = {}
+    templates = make_templates(work_dir, list(formats), n_variants=1, **template_args)
+    for data_format, (in_path,) in templates.items():
+        out_path = os.path.join(work_dir, data_format + '.out.pdf')
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            error_msg = file_to_pdf(in_path, out_path)
+            times.append(time.perf_counter() - start)
+            if error_msg is not None:
+                raise RuntimeError(error_msg)
+            os.remove(out_path)
+        results[data_format] = {'total': sum(times), 'mean': sum(times) / len(times), 'min': min(times)}
+    return results
+
+
+_STARTUP_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [name for name in {dependencies!r} if name in sys.modules]]))
+'''
+
+
+def benchmark_startup(modules=STARTUP_MODULES, repeat=5):
+    """
+    Import every module in a new interpreter repeat times, and return the minimum seconds taken by the import and by the
+    whole process, and the converter dependencies that the import has loaded
+    """
+    # the package is imported from the same folder as this module
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([package_root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    results = {}
+    for module in modules:
+        script = _STARTUP_SCRIPT.format(module=module, dependencies=CONVERTER_DEPENDENCIES)
+        import_times = []
+        process_times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', script], env=env, stdout=subprocess.PIPE, check=True,
+                                    universal_newlines=True).stdout
+            process_times.append(time.perf_counter() - start)
+            seconds, loaded = json.loads(output.splitlines()[-1])
+            import_times.append(seconds)
+        results[module] = {'import_seconds': min(import_times), 'process_seconds': min(process_times),
+                           'loaded_dependencies': loaded}
+    return results
+
+
+def _peak_rss():
+    """
+    Return the peak resident memory of this process in bytes, or None if it can't be measured
+    """
+    if sys.platform == 'win32':
+        import win32api
+        import win32process
+        return win32process.GetProcessMemoryInfo(win32api.GetCurrentProcess())['PeakWorkingSetSize']
+    try:
+        # the peak of the current process image, unlike ru_maxrss that on Linux keeps the peak of the parent process
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes, but in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _measure_memory(function, args):
+    """
+    Call function with args and return the peak resident memory of the process before and after the call, in bytes
+    """
+    baseline = _peak_rss()
+    function(*args)
+    return baseline, _peak_rss()
+
+
+def peak_memory(function, *args):
+    """
+    Call function with args in a new process, and return the peak resident memory of the process above the memory it
+    used before the call, in bytes. Return None if the peak memory can't be measured
+    """
+    # a new interpreter, so that the memory of this process is not counted
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        baseline, peak = executor.submit(_measure_memory, function, args).result()
+    if baseline is None or peak is None:
+        return None
+    return peak - baseline
+
+
+def check_decode_memory(work_dir, image_size=(8000, 6000), max_memory=64 * 1024 * 1024):
+    """
+    Convert a PNG of image_size pixels with resample_image under a decode ceiling of max_memory bytes, and check that the
+    peak memory of the conversion stays under the ceiling, with a margin of DECODE_MEMORY_MARGIN
+    """
+    in_path = os.path.join(work_dir, 'large.png')
+    out_path = os.path.join(work_dir, 'large.pdf')
+    Image.new('RGB', image_size, (200, 120, 40)).save(in_path)
+    start = time.perf_counter()
+    memory = peak_memory(resample_image, in_path, out_path, max_memory)
+    result = {'image_size': list(image_size), 'max_memory': max_memory, 'seconds': time.perf_counter() - start,
+              'peak_memory': memory, 'within_ceiling': None}
+    if memory is not None:
+        result['within_ceiling'] = memory <= max_memory + DECODE_MEMORY_MARGIN
+    return result
+
+
+def benchmark_office_pool(work_dir, n_documents=10, start_time=0.2):
+    """
+    Return the seconds taken to convert n_documents with an Office stand-in that takes start_time seconds to start,
+    when the application is started for every document and when the sessions are pooled
+    """
+    in_path = os.path.join(work_dir, 'document.docx')
+    with open(in_path, 'wb') as f:
+        f.write(b'\0' * 1024)
+    per_document, pooled = benchmark_pool(n_documents, in_path, os.path.join(work_dir, 'document.pdf'), start_time)
+    return {'documents': n_documents, 'start_time': start_time, 'per_document': per_document, 'pooled': pooled}
+
+
+def run_benchmarks(work_dir, scales=DEFAULT_SCALES, workers=1, assembly='merger', label=None, keep=False,
+                   **tree_args):
+    """
+    Run all the benchmarks and return their results as a dict that can be saved as JSON. For every scale, a tree with
+    that number of files is generated in work_dir, and its stages, its scan with the latency of a network share,
+    DataFormatter.format and DataFormatter.extract_csv are timed. A tree kept from a previous run with keep is reused. The import of the package, the converters, the
+    memory used to decode a large image and the Office session pool are benchmarked too.
+
+    :param work_dir: folder of the generated trees and of their outputs
+    :param scales: list of the numbers of files of the trees
+    :param workers: number of processes used to convert the files
+    :param assembly: either 'merger' or 'stream', see merge_pdfs
+    :param label: name of the results, e.g. the version of the code
+    :param keep: if True, the generated trees are not removed
+    :param tree_args: keyword arguments of generate_tree
+    """
+    results = {'label': label, 'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'cpus': os.cpu_count(), 'workers': workers, 'assembly': assembly,
+               'scales': {}}
+    os.makedirs(work_dir, exist_ok=True)
+    for n_files in scales:
+        tree_path = os.path.join(work_dir, 'tree_{}'.format(n_files))
+        summary_path = tree_path + '.json'
+        scale = {}
+        if os.path.isfile(summary_path):
+            with open(summary_path, 'r', encoding='utf-8') as f:
+                scale['tree'] = json.load(f)
+        else:
+            shutil.rmtree(tree_path, ignore_errors=True)
+            start = time.perf_counter()
+            scale['tree'] = generate_tree(tree_path, n_files, **tree_args)
+            scale['generate'] = time.perf_counter() - start
+            if keep:
+                with open(summary_path, 'w', encoding='utf-8') as f:
+                    json.dump(scale['tree'], f)
+
+        scale['scan_latency'] = benchmark_scan(tree_path)
+        out_path = os.path.join(work_dir, 'out_{}'.format(n_files))
+        shutil.rmtree(out_path, ignore_errors=True)
+        scale['stages'] = benchmark_stages(tree_path, os.path.join(out_path, 'stages'), workers, assembly)
+        scale.update(benchmark_format(tree_path, os.path.join(out_path, 'format'), workers=workers, assembly=assembly))
+        scale['files_per_second'] = n_files / scale['format']
+        shutil.rmtree(out_path, ignore_errors=True)
+        if not keep:
+            shutil.rmtree(tree_path, ignore_errors=True)
+        results['scales'][str(n_files)] = scale
+        print('{} files: {}'.format(n_files, ', '.join('{} {:.2f}s'.format(stage, seconds)
+                                                       for stage, seconds in scale['stages'].items())))
+
+    results['startup'] = benchmark_startup()
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        results['converters'] = benchmark_converters(tmp_dir)
+        results['decode_memory'] = check_decode_memory(tmp_dir)
+        results['office_pool'] = benchmark_office_pool(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def _timings(results):
+    """
+    Return the timings in the results of run_benchmarks, by name
+    """
+    timings = {}
+    for n_files, scale in results['scales'].items():
+        for stage, seconds in scale['stages'].items():
+            timings['{} {}'.format(n_files, stage)] = seconds
+        for name in ('format', 'extract_csv'):
+            timings['{} {}'.format(n_files, name)] = scale[name]
+        for n_workers, seconds in scale.get('scan_latency', {}).get('seconds', {}).items():
+            timings['{} scan x{}'.format(n_files, n_workers)] = seconds
+    for module, startup in results.get('startup', {}).items():
+        timings['import ' + module] = startup['import_seconds']
+    for data_format, converter in results.get('converters', {}).items():
+        timings['converter ' + data_format] = converter['total']
+    return timings
+
+
+def compare(old_results, new_results, threshold=REGRESSION_THRESHOLD):
+    """
+    Print the timings of two results of run_benchmarks side by side, and return the names of the timings that are
+    slower in new_results by more than threshold (e.g. 0.1 for 10%) and by more than MIN_REGRESSION_SECONDS. Only the
+    timings found in both are compared
+    """
+    old_timings = _timings(old_results)
+    new_timings = _timings(new_results)
+    regressions = []
+    print('{:<24} {:>10} {:>10} {:>8}'.format('', old_results.get('label') or 'old', new_results.get('label') or 'new',
+                                               'ratio'))
+    for name, new in new_timings.items():
+        if name not in old_timings:
+            continue
+        old = old_timings[name]
+        ratio = new / old if old > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold and new - old > MIN_REGRESSION_SECONDS:
+            regressions.append(name)
+            flag = ' slower'
+        print('{:<24} {:>10.3f} {:>10.3f} {:>8.2f}{}'.format(name, old, new, ratio, flag))
+    return regressions
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='benchmark DataFormatter on generated patient folders')
+    parser.add_argument('--work_dir', type=str, required=True, help='folder of the generated trees and outputs')
+    parser.add_argument('--scales', type=int, nargs='*', default=DEFAULT_SCALES,
+                        help='numbers of files of the trees. Without numbers only the startup and the converters are '
+                             'benchmarked')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--assembly', type=str, default='merger', choices=['merger', 'stream'])
+    parser.add_argument('--files_per_patient', type=int, default=20)
+    parser.add_argument('--msg_template', type=str, default=None,
+                        help='.msg file copied to add emails to the trees, since they can not be generated')
+    parser.add_argument('--label', type=str, default=None, help='name of the results, e.g. the version of the code')
+    parser.add_argument('--out', type=str, default=None, help='save the results in this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='compare the results with this JSON file')
+    parser.add_argument('--keep', action='store_true', help='keep the generated trees and reuse them in the next runs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    formats = dict(DEFAULT_FORMATS)
+    if args.msg_template is not None:
+        formats['msg'] = 0.1
+    results = run_benchmarks(args.work_dir, args.scales, args.workers, args.assembly, args.label, args.keep,
+                             files_per_patient=args.files_per_patient, formats=formats,
+                             msg_template=args.msg_template)
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            old_results = json.load(f)
+        regressions = compare(old_results, results)
+        if regressions:
+            print('Slower than {}: {}'.format(args.compare, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
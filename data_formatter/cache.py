@@ -0,0 +1,198 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from data_formatter.util import make_dir, open_file
+from data_formatter.fingerprint import file_hash
+
+# default maximum size of the cached PDFs, in bytes
+MAX_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+# number of hits whose last used time is kept in memory before the index is updated
+LAST_USED_BATCH = 100
+
+# cache of the current process, see open_cache
+_cache = None
+
+
+class ConversionCache:
+    def __init__(self, cache_dir, max_size=MAX_CACHE_SIZE):
+        """
+        Local cache of converted PDFs, addressed by the hash of the content of the converted file and by the data format
+        and the version of its converter, so that identical files found in different places are converted only once.
+        The PDFs are stored in cache_dir, and a SQLite index keeps their sizes and the times they were last used: when
+        the PDFs take more than max_size bytes, the least recently used ones are removed.
+
+        The index is shared by all the processes that use cache_dir. The last used times of the hits are written to it
+        in batches of LAST_USED_BATCH, so a lookup doesn't commit a write. The hits and misses are counted by every
+        ConversionCache for itself, see stats.
+
+        :param cache_dir: path to the folder of the cache
+        :param max_size: maximum size of the cached PDFs, in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        make_dir(Path(cache_dir))
+        self._lock = threading.Lock()
+        # the emails convert their attachments in more threads
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'), timeout=60, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_used REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self._conn.commit()
+        self._last_used = {}  # last used times of the hits not written to the index yet, by key
+        self._unwritten_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(source, data_format, version):
+        """
+        Return the key of the PDF of source, converted by the converter of data_format with the given version
+
+        :param source: str or bytes. path to the file to convert, or its content
+        """
+        if isinstance(source, bytes):
+            content_hash = hashlib.blake2b(source, digest_size=16).hexdigest()
+        else:
+            content_hash = file_hash(source)
+        return '{}-{}-{}'.format(content_hash, data_format, version)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pdf')
+
+    def get(self, key, out_file):
+        """
+        Copy the cached PDF with the given key to out_file. Return True if the PDF is in the cache, otherwise False.
+        A PDF copied to a path is hard linked when possible
+
+        :param out_file: str or binary file object. path where to store the PDF, or the file to write it in
+        """
+        with self._lock:
+            found = self._conn.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is not None
+            if found:
+                try:
+                    if isinstance(out_file, (str, os.PathLike)):
+                        try:
+                            os.link(self._path(key), out_file)
+                        except OSError:
+                            shutil.copyfile(self._path(key), out_file)
+                    else:
+                        with open(self._path(key), 'rb') as f:
+                            shutil.copyfileobj(f, out_file)
+                except FileNotFoundError:
+                    # removed by another process
+                    self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    self._conn.commit()
+                    self._last_used.pop(key, None)
+                    found = False
+            if found:
+                self.hits += 1
+                self._last_used[key] = time.time()
+                self._unwritten_hits += 1
+                if self._unwritten_hits >= LAST_USED_BATCH:
+                    self._write_last_used()
+                    self._conn.commit()
+            else:
+                self.misses += 1
+        return found
+
+    def put(self, key, pdf_file):
+        """
+        Add the PDF in pdf_file to the cache with the given key, and remove the least recently used PDFs if the cache
+        is too large
+
+        :param pdf_file: str or binary file object. path to the PDF, or the PDF itself
+        """
+        # write the PDF next to its final path and rename it, so that other processes never read a partial PDF
+        tmp_path = '{}.{}.tmp'.format(self._path(key), os.getpid())
+        with open_file(pdf_file) as f, open(tmp_path, 'wb') as out:
+            f.seek(0)
+            shutil.copyfileobj(f, out)
+        size = os.path.getsize(tmp_path)
+        if size > self.max_size:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            # the PDFs used since the last batch are not evicted first
+            self._write_last_used()
+            self._conn.execute('INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)',
+                               (key, size, time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def _write_last_used(self):
+        """
+        Write the last used times of the hits kept in memory to the index, without committing
+        """
+        if self._last_used:
+            self._conn.executemany('UPDATE entries SET last_used = ? WHERE key = ?',
+                                   [(last_used, key) for key, last_used in self._last_used.items()])
+            self._last_used = {}
+        self._unwritten_hits = 0
+
+    def _evict(self):
+        """
+        Remove the least recently used PDFs until the cached PDFs take at most self.max_size bytes
+        """
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in self._conn.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def stats(self):
+        """
+        Return the number of hits and misses of this ConversionCache since it was opened, including the ones added with
+        add_stats. The other processes that use the same cache_dir, e.g. other runs, are not counted
+        """
+        with self._lock:
+            return self.hits, self.misses
+
+    def add_stats(self, hits, misses):
+        """
+        Add the hits and misses counted by the cache of another process, e.g. a worker process of the same run
+        """
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def close(self):
+        with self._lock:
+            self._write_last_used()
+            self._conn.commit()
+            self._conn.close()
+
+
+def open_cache(cache_dir, max_size=MAX_CACHE_SIZE):
+    """
+    Open the conversion cache used by file_to_pdf in the current process. It is also the initializer of the worker
+    processes of DataFormatter
+    """
+    global _cache
+    close_cache()
+    _cache = ConversionCache(cache_dir, max_size)
+    return _cache
+
+
+def get_cache():
+    """
+    Return the conversion cache of the current process, or None if it has not been opened
+    """
+    return _cache
+
+
+def close_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
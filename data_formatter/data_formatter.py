@@ -1,170 +1,127 @@
 import os
+import io
+import json
+import time
 from pathlib import Path
-import re
-import csv
-from dateutil.parser import parse as date_parse
+from collections import deque
+from concurrent.futures import Future
 from datetime import date
-from tqdm import tqdm
-from pdf2image import convert_from_path
-from PIL import Image, ImageFont, ImageDraw
-from PyPDF2 import PdfMerger
-from data_formatter.util import get_format, make_dir, search_str, append_str, check_cache_file, make_file, get_root, get_directory_name, remove_data_format
-from data_formatter.pdf_converter import file_to_pdf, jpg_to_pdf
+from data_formatter.util import get_format, make_dir, make_file, get_root, get_directory_name, remove_data_format
+from data_formatter.pdf_converter import file_to_pdf, get_converter
+from data_formatter.image_decode import MAX_DECODE_MEMORY
+from data_formatter.patient_parser import extract_patient_data
+from data_formatter.record import FilesRecord
+from data_formatter.inventory import Inventory
+from data_formatter.pipeline import MergeWorker
+from data_formatter.pdf_writer import concatenate_pdfs
+from data_formatter.manifest import PatientManifest
+from data_formatter.output_planner import OutputPlanner
+from data_formatter.patient_export import EXPORT_FILES, PatientExporter, export_path, read_patients
+from data_formatter.shard import in_shard, shard_path
+from data_formatter.fingerprint import patient_fingerprint
+from data_formatter.cache import MAX_CACHE_SIZE, open_cache, get_cache, close_cache
+from data_formatter.journal import Journal, CONVERTING, CONVERTED, MERGED
+from data_formatter.run_writer import RunWriter
+from data_formatter.metrics import SLOWEST_FILES, open_metrics, close_metrics, stage
 
 invalid_folders = ['Arch', 'Stoma', 'Wund', 'Patientenunterlagen']
 
 
-def extract_patient_data(patient: str) -> list[str, str, str, str]:
+def _timed_file_to_pdf(in_path, out_path, verbose=False, max_decode_memory=MAX_DECODE_MEMORY):
     """
-    Extract first_name, last_name, birthday, case_nr from the patient folder name.
+    Convert the file in in_path to PDF with file_to_pdf, and return its error message and the seconds it took
+    """
+    start = time.perf_counter()
+    error_msg = file_to_pdf(in_path, out_path, verbose=verbose, max_decode_memory=max_decode_memory)
+    return error_msg, time.perf_counter() - start
 
 
-    :param patient: patient folder name
-    :return: first_name, last_name, birthday, case_nr
+def _worker_file_to_pdf(in_path, out_path, verbose=False, max_decode_memory=MAX_DECODE_MEMORY):
     """
-    # TODO: Invertire first_name con last_name
-    first_name = None
-    last_name = None
-    birthday = None
-    case_nr = None
-
-    skip_words = ['', '-', 'geb', 'fallnr', 'fall-nr', 'fr', 'frau', 'hr', 'herr', 'der', 'auf',
-                  'zim', 'nf', 'unbekannt', 'tumorwunde', 'hausarzt']
+    Like _timed_file_to_pdf, in a worker process. Also return the hits and misses of the conversion cache of the worker
+    during the conversion, or None if the cache is not open: a worker converts one file at a time, so they are the ones
+    of this conversion
+    """
+    cache = get_cache()
+    if cache is None:
+        return _timed_file_to_pdf(in_path, out_path, verbose, max_decode_memory) + (None,)
+    old_stats = cache.stats()
+    error_msg, seconds = _timed_file_to_pdf(in_path, out_path, verbose, max_decode_memory)
+    return error_msg, seconds, [new - old for new, old in zip(cache.stats(), old_stats)]
 
-    patient_data = patient.split(' ')
-    # remove geb. in front of the date
-    patient_data = [datum.replace('geb.', '') for datum in patient_data]
 
-    # remove ',' and '-' from beginning and end of words
-    patient_data = [datum.strip(' ,-.') for datum in patient_data]
+def _add_cache_stats(cache_stats):
+    """
+    Add the hits and misses of a conversion in a worker process, as returned by _worker_file_to_pdf, to the conversion
+    cache of this process
+    """
+    cache = get_cache()
+    if cache_stats is not None and cache is not None:
+        cache.add_stats(*cache_stats)
 
-    # remove words in the skip_words list
-    patient_data = [datum for datum in patient_data if not datum.lower() in skip_words]
 
-    # first find the birthday, and remove it from the list patient_data.
-    prov_patient_data = []
-    for datum in patient_data:
+def _conversion_results(futures):
+    """
+    Yield the error message and the seconds of every conversion future of _worker_file_to_pdf, in order. If the worker
+    process of a conversion failed, its error is returned as the error message
+    """
+    for future in futures:
         try:
-            if date_parse(datum):
-                birthday = datum
-                prov_patient_data.append('birthday')  # put a mark to remember the position where the birthday was
-                continue
-        except:
-            pass
-        prov_patient_data.append(datum)
-    patient_data = prov_patient_data
-
-    # split words if that are separated with a comma or a dot
-    prov_patient_data = []
-    for datum in patient_data:
-        prov = []
-        splitted = datum.split(',')
-        for word in splitted:
-            prov.extend(word.split('.'))
-        for word in prov:
-            if word != '':
-                prov_patient_data.append(word)
-    patient_data = prov_patient_data
-
-    # here we remove the doctor name and we isolate the fall_nr
-    skip_doctor = False
-    prov_patient_data = []
-    for datum in patient_data:
-        if skip_doctor:
-            if len(datum) > 1:
-                skip_doctor = False
-            continue
-        if datum.lower() == 'dr' or datum.lower() == 'prof' or datum.lower() == 'd':
-            skip_doctor = True
-            continue
-        # remove nf-zentrum, nf-arzt
-        if 'nf-' in datum.lower():
-            continue
-        if datum.isnumeric() and len(datum) > 5:
-            case_nr = datum
-            continue
-        prov_patient_data.append(datum)
-    patient_data = prov_patient_data
-
-    # delete all remaining numeric data
-    prov_patient_data = []
-    for datum in patient_data:
-        if datum.isnumeric():
+            error_msg, seconds, cache_stats = future.result()
+        except Exception as e:
+            yield str(e), 0.0
             continue
-        prov_patient_data.append(datum)
-    patient_data = prov_patient_data
+        _add_cache_stats(cache_stats)
+        yield error_msg, seconds
 
-    if patient_data:
-        first_name = patient_data[0]
-        if len(patient_data) > 1:
-            if patient_data[1] != 'birthday':
-                last_name = patient_data[1]
-                if len(patient_data) > 2:
-                    for i in range(2, len(patient_data)):
-                        if patient_data[i] == 'birthday':
-                            break
-                        last_name += ' ' + patient_data[i]
 
-    return [first_name, last_name, birthday, case_nr]
+def _metadata_error(out_dir, e):
+    return 'Was not possible to write the metadata of the patient in {}: {}'.format(out_dir, e)
 
 
-def get_patient_folder(root, patient_folder):
-    """
-    Given the root, and the previous patient_folder, return the new patient_folder
+def merge_pdfs(manifest, assembly='merger'):
     """
-    # in this case our current folder is inside the patient_folder, so we simply return the patient_folder
-    if patient_folder is not None and patient_folder in root:
-        return patient_folder
+    Given the manifest of a patient, with the PDF files converted for the patient ordered by the creation (or
+    modification) times of their source files, merge these files in a single PDF in the same order
 
-    current_folder = get_directory_name(root)
-    [_, _, _, case_nr] = extract_patient_data(current_folder)
-
-    # if the current_folder has a case_nr is a patient_folder. So return the path
-    if case_nr is not None:
-        return root
-
-    # if the current folder does not have a case_nr, can't be a patient folder
-    return None
-
-
-def merge_pdfs(txt_path):
+    :param manifest: PatientManifest
+    :param assembly: either 'merger' or 'stream'. 'merger' merges the PDFs with PyPDF2's PdfMerger, that keeps all of
+    them open until the merged PDF is written. 'stream' copies the pages of one PDF at a time to the merged PDF while
+    it is written, so the memory used doesn't grow with the number of pages of the patient
     """
-    Given a txt file with a list of PDF files and their creation times, merge these files in a single PDF according to
-    the files creation times
-    """
-    txt_path_root = get_root(txt_path)
-    patient = get_directory_name(txt_path_root)
-    with open(txt_path, encoding='utf-8') as f:
-        lines = f.readlines()
-    files = []
-    for i in range(len(lines) // 2):
-        path = re.sub('\n', '', lines[2 * i])
-        time = float(re.sub('\n', '', lines[2 * i + 1]))
-        files.append([path, time])
-    files = sorted(files, key=lambda x: x[1])
-    paths = [file[0] for file in files]
-
-    merger = PdfMerger()
-
-    for pdf in paths:
-        merger.append(pdf)
+    root = manifest.out_dir
+    patient = get_directory_name(root)
+    paths = manifest.paths
 
-    root = get_root(txt_path)
     [first_name, last_name, birthday, case_nr] = extract_patient_data(patient)
     filename = first_name + ', ' + last_name + ' Fall-Nr ' + case_nr + '.pdf'
     merge_path = os.path.join(root, filename)
-    merger.write(merge_path)
-    merger.close()
 
-    # remove pdfs and txt file
-    os.remove(txt_path)
+    if assembly == 'stream':
+        concatenate_pdfs(paths, merge_path)
+    else:
+        from PyPDF2 import PdfMerger
+
+        merger = PdfMerger()
+
+        for pdf in paths:
+            merger.append(pdf)
+
+        merger.write(merge_path)
+        merger.close()
+
+    # remove the pdfs and the sidecar of the manifest
     for pdf in paths:
         os.remove(pdf)
+    manifest.remove()
 
 
 class DataFormatter:
     def __init__(self, input_folder, output_folder, time_order='creation', print_folders=False,
-                 log_path=None, err_path=None, record_path=None):
+                 log_path=None, err_path=None, record_path=None, inventory_path=None, workers=1, assembly='merger',
+                 incremental=False, hash_files=False, cache_dir=None, cache_size=MAX_CACHE_SIZE, metrics_path=None,
+                 prometheus_path=None, metrics_interval=None, slowest_files=SLOWEST_FILES, scan_workers=1,
+                 skip_invalid_folders=False, shard=None, max_decode_memory=MAX_DECODE_MEMORY):
         """
 
         :param input_folder: input folder, either as a relatve path or as an absolute path
@@ -173,7 +130,37 @@ class DataFormatter:
         :param verbose:
         :param log_path:
         :param err_path:
-        :param record_path:
+        :param record_path: path to the record of the processed files. A .txt record of a previous version is imported
+        in a .db record with the same name. The journal of the patients in flight is kept next to it, in a
+        _journal.db file
+        :param inventory_path: if not None, the scan of the input folder is saved in this file, and reused by
+        extract_csv and extract_patient_folders in the following runs
+        :param workers: number of processes used to convert the files to PDF
+        :param assembly: either 'merger' or 'stream'. how the PDFs of a patient are merged, see merge_pdfs
+        :param incremental: if True, only the patients whose files have changed since the last run are processed, and
+        all their files are converted again, so that their merged PDF is complete. The other patients are skipped
+        without opening their files
+        :param hash_files: used with incremental. if True, the files are identified by the hash of their content, so
+        a file moved or renamed inside its patient folder doesn't count as a change
+        :param cache_dir: if not None, folder of a cache of the converted PDFs. A file with the same content as a file
+        already converted, in this or in a previous run, is copied from the cache instead of being converted again
+        :param cache_size: maximum size of the cache in bytes. The least recently used PDFs are removed first
+        :param metrics_path: if not None, the metrics of the run (time spent in every stage, conversions by data format,
+        slowest files) are saved in this JSON file at the end of format
+        :param prometheus_path: if not None, the metrics of the run are saved in this file in the Prometheus text format
+        :param metrics_interval: if not None, the metrics are also saved every metrics_interval seconds during the run
+        :param slowest_files: number of slowest files listed in the metrics
+        :param scan_workers: number of directories of the input folder listed at the same time during the scan. More
+        than one speeds up the scan of a network share, where every listing waits for the server
+        :param skip_invalid_folders: if True, the folders named like invalid_folders are not scanned, unless they are
+        inside a patient folder
+        :param shard: if not None, the shard (K, N) processed by this DataFormatter, as returned by parse_shard. Only the
+        patients whose case nr hashes to the shard K out of N are processed, so that N DataFormatters, e.g. on N
+        machines, can process the same input folder into the same output folder. Each shard has its own log, err file,
+        record, inventory, metrics and patient exports, named as in shard_path, that combine_shards folds into the
+        usual files
+        :param max_decode_memory: memory ceiling in bytes of the decoding of an image that has to be resized. The images
+        that would need more are decoded at a reduced resolution
         """
         cwd = os.getcwd()
 
@@ -190,6 +177,32 @@ class DataFormatter:
 
         self.print_folders = print_folders
         self.time_order = time_order
+        self.workers = workers
+        self.assembly = assembly
+        self.incremental = incremental
+        self.hash_files = hash_files
+        # fingerprints of the patient folders to process in incremental mode, by folder
+        self.changed_patients = None
+        # journal of the patients in flight, opened by format
+        self.journal = None
+
+        if cache_dir is None or os.path.isabs(cache_dir):
+            self.cache_dir = cache_dir
+        else:
+            self.cache_dir = os.path.join(cwd, cache_dir)
+        self.cache_size = cache_size
+
+        self.metrics_path = None if metrics_path is None else os.path.join(cwd, metrics_path)
+        self.prometheus_path = None if prometheus_path is None else os.path.join(cwd, prometheus_path)
+        self.metrics_interval = metrics_interval
+        self.slowest_files = slowest_files
+        self.scan_workers = scan_workers
+        self.skip_invalid_folders = skip_invalid_folders
+        self.max_decode_memory = max_decode_memory
+        # metrics of the last run of format
+        self.metrics = None
+        # planner of the output paths of the converted files, created by format
+        self.output_planner = None
 
         if log_path is None:
             self.log_path = os.path.join(self.abs_out_path, 'log.txt')
@@ -210,7 +223,7 @@ class DataFormatter:
                 self.err_path = os.path.join(cwd, err_path)
 
         if record_path is None:
-            self.record_path = os.path.join(self.abs_out_path, 'files_record.txt')
+            self.record_path = os.path.join(self.abs_out_path, 'files_record.db')
         else:
             # make sure record_path is an absolute path
             if os.path.isabs(record_path):
@@ -218,129 +231,209 @@ class DataFormatter:
             else:
                 self.record_path = os.path.join(cwd, record_path)
 
+        if inventory_path is None or os.path.isabs(inventory_path):
+            self.inventory_path = inventory_path
+        else:
+            self.inventory_path = os.path.join(cwd, inventory_path)
+
+        self.shard = shard
+        if shard is not None:
+            self.log_path = shard_path(self.log_path, shard)
+            self.err_path = shard_path(self.err_path, shard)
+            self.record_path = shard_path(self.record_path, shard)
+            if self.inventory_path is not None:
+                self.inventory_path = shard_path(self.inventory_path, shard)
+            if self.metrics_path is not None:
+                self.metrics_path = shard_path(self.metrics_path, shard)
+            if self.prometheus_path is not None:
+                self.prometheus_path = shard_path(self.prometheus_path, shard)
+        self.journal_path = remove_data_format(self.record_path) + '_journal.db'
+        self._inventory = None
+        # writer of the log, the err file and the record, opened by format
+        self.writer = None
+
     def format(self):
         """
         Format the files into the patient folders in the self.abs_in_path folder, and save the formatted file in the
         abs_out_path folder
         """
-        # count the files in the folders
-        print('Counting the files in the folder ...')
-        self.tot_files = self._count_files()
-        
-        # initialize the log file and the err file
-        make_file(self.log_path)
-        make_file(self.err_path)
-
-        self.n_files = 0  # set the count of the files that have already been processed to 0
+        inventory, record = self._open_run()
         not_converted_files = []  # these will be the files that was not possible to convert to PDF because of some error
         ignored_files = []  # These will be the files that have already been processed in a previous run of the algorithm, and therefore skipped this time
-        patient_folder = None  # the current patient folder
-
-        # txt_path is the path where to store the temporary txt file that keeps track of all the files converted to PDF
-        # for a given patient. Once all the PDF files for a given patient have been merged, this temporary file is
-        # deleted
-        txt_path = None
-        txt_path_previous = None  # txt_path of the previous round
 
         if self.print_folders:
             print('A total of {} files will be processed.\n'.format(self.tot_files))
         else:
             # initialize the charging bar if we are not going to print the folders
+            from tqdm import tqdm
+
             self.charge_bar = tqdm(total=self.tot_files)
 
-        for root, _, files in os.walk(self.abs_in_path):
-            patient_folder = get_patient_folder(root, patient_folder)
+        # with more than one worker the files are converted in a pool of processes, while this process keeps handling
+        # the output paths, the manifests of the patients, the err file and the record
+        cache_args = None
+        if self.cache_dir is not None:
+            # the cache is opened in this process and in every worker
+            cache_args = (self.cache_dir, self.cache_size)
+            cache = open_cache(*cache_args)
+        if self.workers <= 1:
+            executor = None
+        else:
+            # imported here, like the other dependencies of the conversions, to keep the startup fast
+            from concurrent.futures import ProcessPoolExecutor
+            if cache_args is not None:
+                executor = ProcessPoolExecutor(max_workers=self.workers, initializer=open_cache, initargs=cache_args)
+            else:
+                executor = ProcessPoolExecutor(max_workers=self.workers)
+        # the PDFs of every finished patient are merged in the background, while the next patients are converted
+        merge_worker = MergeWorker(self._merge_patient, self._append_err)
+        # patients whose conversions have been started but not finished yet. With a pool, up to self.workers patients
+        # are kept in flight, so that the workers don't wait at the patient boundaries
+        pending = deque()
+        if self.metrics_interval is not None:
+            self.metrics.start_export(self.metrics_interval, self.metrics_path, self.prometheus_path)
 
-            if patient_folder is None:
-                # the current folder is not under a patient_folder, so we skip it
-                continue
+        try:
+            for patient in inventory.patients:
+                with stage('plan'):
+                    jobs = self._plan_patient(patient, record, ignored_files)
+                if jobs:
+                    # from now on, an interrupted run is recovered by processing the patient again
+                    self.journal.begin(self._output_dir(patient.folder), patient.folder,
+                                       [[in_path_file, out_path_file] for in_path_file, out_path_file, _ in jobs])
+                if executor is None:
+                    # convert the files only when the patient is finished, one at a time
+                    results = (_timed_file_to_pdf(in_path_file, out_path_file, self.print_folders,
+                                                  self.max_decode_memory)
+                               for in_path_file, out_path_file, _ in jobs)
+                else:
+                    futures = [self._submit_conversion(executor, in_path_file, out_path_file)
+                               for in_path_file, out_path_file, _ in jobs]
+                    results = _conversion_results(futures)
+                pending.append((patient, jobs, results))
+
+                while len(pending) > (0 if executor is None else self.workers):
+                    self._finish_patient(*pending.popleft(), record, merge_worker, not_converted_files)
+
+            # finish the patients still in flight
+            while pending:
+                self._finish_patient(*pending.popleft(), record, merge_worker, not_converted_files)
+        finally:
+            # wait for the last merges before closing
+            merge_worker.close()
+            self.metrics.stop_export()
+            self.journal.close()
+            if executor is not None:
+                executor.shutdown()
+            self.writer.commit()
+            record.close()
+            if cache_args is not None:
+                # the hits and misses of this run, in this process and in the workers
+                hits, misses = cache.stats()
+                close_cache()
 
-            if self.print_folders:
-                print('--\ncurrent folder: ' + root)
+        if not self.print_folders:
+            # terminate the charge_bar once the formatting is complete
+            self._update_charge_bar()
+            self.charge_bar.close()
 
-            for file in files:
-                # if the file it's a Thumbs.db cache file, skip it
-                if check_cache_file(file):
-                    continue
+        self._end_run(not_converted_files, ignored_files, (hits, misses) if cache_args is not None else None)
 
-                # check if the file has already been processed in another run, if yes skip it
-                if search_str(self.record_path, os.path.join(root, file)):
-                    # add the file to the list of ignored files since we are not going to process it in this run
-                    ignored_files.append(os.path.join(root, file))
-                    # show info in the log
-                    self._show_info(file, skipping=True)
-                    continue
+    def format_async(self, workers=None, merge_workers=1, patients_in_flight=None, queue_size=2):
+        """
+        Format the files like format, with a FormatEngine, and return an asynchronous iterator of the FileResult of
+        every file as it is processed. See FormatEngine for the arguments, e.g.
 
-                # show info in the log
-                self._show_info(file)
-
-                # out_path_file is the path where we are going to convert our file to pdf, out_path_dir is the
-                # new patient folder in the self.abs_out_path folder
-                out_path_file, out_path_dir = self._make_output_path(patient_folder, file)
-                in_path_file = os.path.join(root, file) # the path where the file is currently stored
-                # convert the file to pdf and save the pdf in the out_path_file, generate an error message
-                error_msg = file_to_pdf(in_path_file, out_path_file, verbose=self.print_folders)
-                if error_msg is None:
-                    # if error_msg is None means that the file has been converted to pdf successfully, therefore we add
-                    # the file to a temporary txt_file that keep track of all the converted pdf files for a given patient
-                    txt_path = self._update_info_txt(in_path_file, out_path_file, out_path_dir)
-                    if txt_path_previous is None:
-                        txt_path_previous = txt_path
-                else:
-                    # if there is an error message it means that the conversion of the file didn't happen. We save the
-                    # error message in the err_path file, and we add the file to the list of the non_converted_files
-                    append_str(self.err_path, error_msg)
-                    not_converted_files.append([in_path_file, error_msg])
-
-                # The file has been processed, so add it to the self.record_path file
-                append_str(self.record_path, os.path.join(root, file))
-
-            # merge all the PDF files of the previous patient (in fact, if txt_path_previous != txt_path it means that
-            # the current patient is different from the previous one, which means that all the files of the previous
-            # patient have been already processed, and the PDFs can be merged)
-            if txt_path_previous != txt_path:
-                try:
-                    merge_pdfs(txt_path_previous)
-                    self._make_metadata(txt_path_previous)
-                except Exception as e:
-                    # handle errors in the merging process
-                    append_str(self.err_path, str(e))
-                txt_path_previous = txt_path
+            async for result in formatter.format_async(workers=4):
+                print(result.in_path, result.status)
+        """
+        from data_formatter.engine import FormatEngine
 
-        # remember to merge all the files of the last patient as well
-        try:
-            merge_pdfs(txt_path)
-            self._make_metadata(txt_path)
-        except Exception as e:
-            # handle errors in the merging process
-            append_str(self.err_path, str(e))
+        return FormatEngine(self, workers, merge_workers, patients_in_flight, queue_size).run()
 
-        if not self.print_folders:
-            # terminate the charge_bar once the formatting is complete
-            self.charge_bar.close()
+    def _open_run(self):
+        """
+        Start a run: open the metrics, scan the input folder, initialize the log, the err file and the writer, open the
+        record of the files processed in the previous runs and the journal, and finish the patients left in flight by an
+        interrupted run. Return the inventory and the record, that can only be used by the calling thread
+        """
+        self.metrics = open_metrics(self.slowest_files)
+        # the output folders are created and listed once in a run
+        self.output_planner = OutputPlanner()
 
-        # save the not_converted_files and the ignored_files in the log
-        self._save_log(not_converted_files, ignored_files)
+        # scan the input folder
+        print('Scanning the files in the folder ...')
+        with stage('scan'):
+            inventory = self.get_inventory(rescan=True)
+        self.tot_files = inventory.n_files
 
-    def extract_csv(self):
+        # initialize the log file and the err file
+        make_file(self.log_path)
+        make_file(self.err_path)
+
+        # open the record of the files processed in the previous runs, and finish the patients left in flight by an
+        # interrupted run
+        record = FilesRecord(self.record_path)
+        self.writer = RunWriter(self.log_path, self.err_path, record)
+        make_file(self.writer.jsonl_path)
+        self.journal = Journal(self.journal_path)
+        with stage('recover'):
+            self._recover(record)
+        if self.incremental:
+            with stage('fingerprint'):
+                self.changed_patients = self._find_changed_patients(inventory, record)
+            print('{} of the {} patients have changed since the last run.'
+                  .format(len(self.changed_patients), len(inventory.patients)))
+
+        self.n_files = 0  # set the count of the files that have already been processed to 0
+        self.charge_bar = None
+        self._charge_bar_pending = 0
+        return inventory, record
+
+    def _end_run(self, not_converted_files, ignored_files, cache_counts=None, verbose=True):
         """
-        Create a CSV file with all the patients in the folder, where the columns are 'Vorname', 'Nachname',
-        'Geburtstag', 'Fall-nr'
+        Finish a run, after the record has been closed: save the not converted files, the ignored files and the hits
+        and misses of the conversion cache, if cache_counts is not None, in the log, and export the metrics
+        """
+        # save the not_converted_files and the ignored_files in the log
+        with stage('log'):
+            self._save_log(not_converted_files, ignored_files, verbose)
+        if cache_counts is not None:
+            hits, misses = cache_counts
+            cache_info = 'Conversion cache: {} hits, {} misses.'.format(hits, misses)
+            self.writer.log('\n' + cache_info)
+            self.writer.event('cache', hits=hits, misses=misses)
+            self.writer.flush()
+            if verbose:
+                print('\n' + cache_info)
+
+        self.metrics.export(self.metrics_path, self.prometheus_path)
+        close_metrics()
+
+    def extract_csv(self, formats=('csv',), append=False):
+        """
+        Export all the patients in the folder to the output folder, with the columns 'Vorname', 'Nachname', 'Geburtstag',
+        'Fall-nr': by default to a CSV file. The patients are written as they are read from the inventory, once per case
+        number.
+
+        :param formats: export formats among 'csv' (csv_file.csv), 'jsonl' (patients.jsonl) and 'parquet'
+        (patients.parquet, needs pyarrow)
+        :param append: bool. if True, add only the patients that are not in the files yet, instead of writing them again
         """
         print('\nExtracting patients information from the folders ...')
-        csv_path = os.path.join(self.abs_out_path, 'csv_file.csv')
-        header = ['Vorname', 'Nachname', 'Geburtstag', 'Fall-nr']
-        patients_data = self._extract_patients_data()
-
-        print('Creating the csv file ...')
-        with open(csv_path, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
-            for patient_data in patients_data:
-                # if the case id is None we don't save the patient
-                if patient_data[3] is None:
-                    continue
-                writer.writerow(patient_data)
+        inventory = self.get_inventory()
+
+        print('Creating the {} file{} ...'.format(', '.join(formats), 's' if len(formats) > 1 else ''))
+        make_dir(Path(self.abs_out_path))
+        with PatientExporter(self.abs_out_path, formats, append, self.shard) as exporter:
+            for patient in inventory.patients:
+                exporter.add(patient.patient_data)
+        counts = exporter.counts
+        print('{} patients added, {} already exported'.format(counts['added'], counts['existing']))
+        if counts['duplicate']:
+            print('{} patient folders skipped, their case nr has already been exported'.format(counts['duplicate']))
+        if counts['no_case_nr']:
+            print('{} patient folders skipped, they have no case nr'.format(counts['no_case_nr']))
         print('Done!')
 
     def extract_patient_folders(self):
@@ -351,66 +444,332 @@ class DataFormatter:
         make_dir(Path(log_dir))
         # clear the log file if there exist already one
         with open(self.log_path, 'w', encoding='utf-8') as f:
-            f.write('')
-
-        patient_folder = None
-        previous_patient_folder = None
-
-        for root, subdirs, files in os.walk(self.abs_in_path):
-            patient_folder = get_patient_folder(root, patient_folder)
-            if patient_folder is not None and previous_patient_folder != patient_folder:
-                patient = get_directory_name(patient_folder)
-                with open(self.log_path, 'a', encoding='utf-8') as f:
-                    f.write(patient + '\n')
-                previous_patient_folder = patient_folder
-
-    def _count_files(self):
-        """
-        Count all the files inside the self.abs_in_path that are inside a valid patient folder (with existing case_nr)
-        and that are not cache files
-        """
-        count = 0
-        patient_folder = None
-        for root, _, files in os.walk(self.abs_in_path):
-            patient_folder = get_patient_folder(root, patient_folder)
-            # if the current root is not inside a patient_folder, continue
-            if patient_folder is None:
+            for patient in self.get_inventory().patients:
+                f.write(patient.name + '\n')
+
+    def combine_shards(self, n_shards):
+        """
+        Fold the outputs of the n_shards shards of a sharded run into the outputs of a single run: the logs, the err
+        files and the JSON lines files of the shards are written one after the other in the log, the err file and the
+        JSON lines file, the records are merged in the record, and the patient exports are merged, once per case nr.
+        The files of the shards are kept. A shard interrupted while converting the files of a patient must be run again
+        first, since its record is not consistent with its output folders. The patients of an interrupted shard whose
+        files are all converted, but not merged yet, are listed in the err file: running the shard again finishes them
+        """
+        shards = [(k, n_shards) for k in range(1, n_shards + 1)]
+        missing = []
+        unfinished = []
+        stuck_errors = []
+        for shard in shards:
+            record_path = shard_path(self.record_path, shard)
+            journal_path = remove_data_format(record_path) + '_journal.db'
+            if not os.path.isfile(record_path):
+                missing.append('{}/{}'.format(*shard))
+            elif os.path.isfile(journal_path):
+                journal = Journal(journal_path)
+                try:
+                    entries = journal.entries()
+                finally:
+                    journal.close()
+                if any(state == CONVERTING for _, _, state, _ in entries):
+                    unfinished.append('{}/{}'.format(*shard))
+                stuck_errors += ['The patient in {} of the shard {}/{} has not been merged, run the shard again to '
+                                 'finish it'.format(out_dir, *shard) for out_dir, _, _, _ in entries]
+        if missing:
+            raise ValueError('The shards {} have not been run'.format(', '.join(missing)))
+        if unfinished:
+            raise ValueError('The shards {} have been interrupted, run them again before combining them'
+                             .format(', '.join(unfinished)))
+
+        print('Combining the {} shards ...'.format(n_shards))
+        jsonl_path = remove_data_format(self.log_path) + '.jsonl'
+        for path in (self.log_path, self.err_path, jsonl_path):
+            make_file(path)
+        with open(self.log_path, 'a', encoding='utf-8') as log, open(self.err_path, 'a', encoding='utf-8') as err, \
+                open(jsonl_path, 'a', encoding='utf-8') as jsonl:
+            for shard in shards:
+                shard_log_path = shard_path(self.log_path, shard)
+                if os.path.isfile(shard_log_path):
+                    with open(shard_log_path, 'r', encoding='utf-8') as f:
+                        log.write('Shard {}/{}:\n\n'.format(*shard) + f.read() + '\n\n')
+                shard_err_path = shard_path(self.err_path, shard)
+                if os.path.isfile(shard_err_path):
+                    with open(shard_err_path, 'r', encoding='utf-8') as f:
+                        err.write(f.read())
+                # the events are tagged with their shard
+                shard_jsonl_path = remove_data_format(shard_log_path) + '.jsonl'
+                if os.path.isfile(shard_jsonl_path):
+                    with open(shard_jsonl_path, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            if line.strip():
+                                event = json.loads(line)
+                                event['shard'] = '{}/{}'.format(*shard)
+                                jsonl.write(json.dumps(event, ensure_ascii=False) + '\n')
+            for error_msg in stuck_errors:
+                print(error_msg)
+                err.write(error_msg + '\n')
+
+        record = FilesRecord(self.record_path)
+        try:
+            for shard in shards:
+                record.merge(shard_path(self.record_path, shard))
+            n_files = len(record)
+        finally:
+            record.close()
+
+        for export_format in EXPORT_FILES:
+            paths = [export_path(self.abs_out_path, export_format, shard) for shard in shards]
+            paths = [path for path in paths if os.path.isfile(path)]
+            if not paths:
                 continue
-            for file in files:
-                # if it's a cache file skip it
-                if check_cache_file(file):
-                    continue
-                count += 1
-        return count
+            with PatientExporter(self.abs_out_path, [export_format]) as exporter:
+                for path in paths:
+                    for patient_data in read_patients(path, export_format):
+                        exporter.add(patient_data)
+            print('{} patients in the {} file'.format(exporter.counts['added'], export_format))
+        print('{} files in the record.'.format(n_files))
+        print('Done!')
+
+    def get_inventory(self, rescan=False):
+        """
+        Return the Inventory of the input folder. The input folder is scanned only once per DataFormatter: the
+        following calls return the same inventory, unless rescan is True. If self.inventory_path is set, the inventory is saved there after a
+        scan, and it is loaded from there instead of scanning the input folder again.
 
-    def _extract_patients_data(self):
+        :param rescan: if True, scan the input folder even if it has already been scanned or there is a saved inventory
+        """
+        if self._inventory is not None and not rescan:
+            return self._inventory
+        if not rescan and self.inventory_path is not None and os.path.isfile(self.inventory_path):
+            inventory = Inventory.load(self.inventory_path)
+            if inventory.in_path == self.abs_in_path:
+                self._inventory = inventory
+                return inventory
+        skip_folders = invalid_folders if self.skip_invalid_folders else ()
+        # the patient folders of the other shards are not listed
+        patient_filter = None if self.shard is None else lambda patient_data: in_shard(patient_data, self.shard)
+        self._inventory = Inventory.scan(self.abs_in_path, self.scan_workers, skip_folders,
+                                         patient_filter=patient_filter)
+        if self.inventory_path is not None:
+            make_dir(Path(self.inventory_path).parent)
+            self._inventory.save(self.inventory_path)
+        return self._inventory
+
+    def _plan_patient(self, patient, record, ignored_files):
         """
-        Exctract all the patients data from their patient folder name (first name, last name, birthday, case nr), and
-        return them into a vector
+        Return the list of the files of the patient that have to be converted, as [in_path_file, out_path_file,
+        time], where time is the creation or modification time of the file, according to self.time_order, taken from
+        the inventory. The files already processed in a previous run are added to ignored_files.
+        In incremental mode all the files of a patient that has changed are converted, and no file of the other
+        patients is
         """
-        patient_folder = None
-        previous_patient_folder = None
-        patients_data = []
+        to_convert = []
+        changed = self.changed_patients is not None and patient.folder in self.changed_patients
+        if changed:
+            # all the files are converted again, so the PDFs left by an interrupted run are not needed
+            PatientManifest.load(self._output_dir(patient.folder)).discard()
+        for file_entry in patient.files:
+            in_path_file = file_entry.path  # the path where the file is currently stored
+            file = os.path.basename(in_path_file)
+
+            # check if the file has already been processed in another run, if yes skip it. In incremental mode the
+            # files of the patients that haven't changed are skipped instead
+            if self.changed_patients is not None:
+                skip = not changed
+            else:
+                with stage('record'):
+                    skip = in_path_file in record
+            if skip:
+                # add the file to the list of ignored files since we are not going to process it in this run
+                ignored_files.append(in_path_file)
+                self.writer.processed(in_path_file, skipped=True)
+                self.metrics.add_skipped()
+                # show info in the log
+                self._show_info(file, skipping=True)
+                continue
 
-        for root, subdirs, files in os.walk(self.abs_in_path):
-            patient_folder = get_patient_folder(root, patient_folder)
-            if patient_folder is not None and previous_patient_folder != patient_folder:
-                patient = get_directory_name(patient_folder)
-                patient_data = extract_patient_data(patient)
-                patients_data.append(patient_data)
-                previous_patient_folder = patient_folder
+            to_convert.append(file_entry)
+
+        if not to_convert:
+            return []
+        # the paths where we are going to convert our files to pdf, in the new patient folder in the self.abs_out_path
+        # folder
+        out_paths = self.output_planner.plan(self._output_dir(patient.folder),
+                                             [os.path.basename(file_entry.path) for file_entry in to_convert])
+        jobs = []
+        for file_entry, out_path_file in zip(to_convert, out_paths):
+            path_time = file_entry.ctime if self.time_order == 'creation' else file_entry.mtime
+            jobs.append([file_entry.path, out_path_file, path_time])
+        return jobs
+
+    def _submit_conversion(self, executor, in_path_file, out_path_file):
+        """
+        Submit the conversion of in_path_file to the executor and return its future. The files whose converter is not
+        process safe are converted in this process instead, and the returned future is already done
+        """
+        converter = get_converter(get_format(in_path_file))
+        if converter is not None and converter.process_safe:
+            return executor.submit(_worker_file_to_pdf, in_path_file, out_path_file, self.print_folders,
+                                   self.max_decode_memory)
+        future = Future()
+        # the hits and misses of this process are already counted by its cache
+        future.set_result(_timed_file_to_pdf(in_path_file, out_path_file, self.print_folders, self.max_decode_memory)
+                          + (None,))
+        return future
+
+    def _finish_patient(self, patient, jobs, results, record, merge_worker, not_converted_files):
+        """
+        Given the files of a patient as returned by _plan_patient and the error messages and the seconds of their
+        conversions, update the manifest of the patient, the err file, the record and the metrics, and submit the
+        manifest to merge_worker to merge the PDFs of the patient
+        """
+        # the manifest keeps track of all the files converted to PDF for the patient, ordered by time. It starts with
+        # the PDFs left by an interrupted run, if any
+        manifest = PatientManifest.load(self._output_dir(patient.folder))
+        if not jobs and len(manifest) > 0:
+            # only the PDFs left by an interrupted run have to be merged
+            self.journal.begin(manifest.out_dir, patient.folder, [])
+        root = None  # the folder of the current file
+        sizes = {file_entry.path: file_entry.size for file_entry in patient.files}
+
+        for [in_path_file, out_path_file, path_time], (error_msg, seconds) in zip(jobs, results):
+            if self.print_folders and os.path.dirname(in_path_file) != root:
+                root = os.path.dirname(in_path_file)
+                print('--\ncurrent folder: ' + root)
+            # show info in the log
+            self._show_info(os.path.basename(in_path_file))
 
-        return patients_data
+            if error_msg is None:
+                # if error_msg is None means that the file has been converted to pdf successfully, therefore we add
+                # the file to the manifest of the patient
+                manifest.add(out_path_file, path_time)
+            else:
+                # if there is an error message it means that the conversion of the file didn't happen. We add the file
+                # to the list of the non_converted_files
+                not_converted_files.append([in_path_file, error_msg])
+
+            # The file has been processed, so add it to the record. The error message, if any, goes to the err file
+            self.writer.processed(in_path_file, error_msg)
+            self.metrics.add_file(in_path_file, seconds, sizes[in_path_file], error=error_msg is not None)
+
+        if self.changed_patients is not None and patient.folder in self.changed_patients:
+            record.set_fingerprint(patient.folder, self.changed_patients[patient.folder])
+
+        if len(manifest) > 0:
+            # save the manifest before the files are committed to the record: if the run stops before the PDFs are
+            # merged, the next run finds them in the sidecar
+            if jobs:
+                manifest.save()
+            # the patient is complete, so commit its files to the record and write the log lines
+            with stage('record'):
+                self.writer.commit()
+            self.journal.set_state(manifest.out_dir, CONVERTED)
+            # all the files of the patient have been processed, so the PDFs can be merged
+            merge_worker.submit(manifest)
+        else:
+            with stage('record'):
+                self.writer.commit()
+            if jobs:
+                # no file could be converted, so there is nothing to merge
+                self.journal.finish(manifest.out_dir)
+        if not self.print_folders:
+            self._update_charge_bar()
 
-    def _make_metadata(self, txt_path):
+    def _recover(self, record):
         """
-        Create the metadata .jpl file
+        Bring the patients left in flight by an interrupted run, as found in the journal, to a consistent state. The
+        patients that were being converted are processed again in this run: their files are removed from the record
+        and the PDFs converted for them are removed. The patients that were converted are merged, and the patients that
+        were merged get their metadata file
         """
-        txt_path_root = get_root(txt_path)
-        patient = get_directory_name(txt_path_root)
+        for out_dir, folder, state, jobs in self.journal.entries():
+            if state == CONVERTING:
+                print('Redoing the interrupted patient ' + folder)
+                record.remove([in_path_file for in_path_file, _ in jobs])
+                record.remove_fingerprint(folder)
+                record.commit()
+                out_paths = [out_path_file for _, out_path_file in jobs]
+                for out_path_file in out_paths:
+                    if os.path.isfile(out_path_file):
+                        os.remove(out_path_file)
+                # keep the PDFs of the manifest that were left by an older run
+                manifest = PatientManifest.load(out_dir)
+                manifest.drop(out_paths)
+                if len(manifest) > 0:
+                    manifest.save()
+                else:
+                    manifest.remove()
+                self.journal.finish(out_dir)
+            elif state == CONVERTED:
+                print('Merging the interrupted patient ' + folder)
+                manifest = PatientManifest.load(out_dir)
+                if len(manifest) > 0:
+                    try:
+                        self._merge_patient(manifest)
+                    except Exception as e:
+                        self._append_err(str(e))
+                else:
+                    self.journal.finish(out_dir)
+            elif state == MERGED:
+                try:
+                    self._make_metadata(out_dir)
+                except Exception as e:
+                    self._append_err(_metadata_error(out_dir, e))
+                # like in _merge_patient, a patient whose metadata can't be written is not tried again
+                self.journal.finish(out_dir)
+
+    def _find_changed_patients(self, inventory, record):
+        """
+        Return the fingerprints of the patients in the inventory whose fingerprint is different from the one saved in
+        the record in the last run, by patient folder
+        """
+        changed_patients = {}
+        for patient in inventory.patients:
+            fingerprint = patient_fingerprint(patient, self.time_order, record if self.hash_files else None)
+            if record.get_fingerprint(patient.folder) != fingerprint:
+                changed_patients[patient.folder] = fingerprint
+        # save the new hashes
+        record.commit()
+        return changed_patients
+
+    def _merge_patient(self, manifest):
+        """
+        Merge the PDFs listed in the manifest and create the metadata file of the patient. If the merge or the metadata
+        fail, e.g. because the name of the patient folder has no first name, the patient is removed from the journal and
+        its manifest sidecar is removed, so that the next runs don't fail on it again: the converted PDFs are left in the
+        output folder of the patient, and a RuntimeError with the patient is raised
+        """
+        out_dir = manifest.out_dir
+        try:
+            with stage('merge'):
+                merge_pdfs(manifest, self.assembly)
+        except Exception as e:
+            manifest.remove()
+            self.journal.finish(out_dir)
+            raise RuntimeError('Was not possible to merge the PDFs of the patient in {}: {}'.format(out_dir, e)) from e
+        self.journal.set_state(out_dir, MERGED)
+        try:
+            with stage('metadata'):
+                self._make_metadata(out_dir)
+        except Exception as e:
+            self.journal.finish(out_dir)
+            raise RuntimeError(_metadata_error(out_dir, e)) from e
+        self.journal.finish(out_dir)
+
+    def _append_err(self, error_msg):
+        """
+        Append error_msg to the err file. Safe to call from the merge worker thread
+        """
+        self.writer.error(error_msg)
+
+    def _make_metadata(self, out_path_dir):
+        """
+        Create the metadata .jpl file in the output folder of the patient
+        """
+        patient = get_directory_name(out_path_dir)
         [first_name, last_name, birthday, case_nr] = extract_patient_data(patient)
         filename = first_name + ', ' + last_name + ' Fall-Nr ' + case_nr + '.jpl'
-        metadata_path = os.path.join(txt_path_root, filename)
+        metadata_path = os.path.join(out_path_dir, filename)
         metadata_dir = get_root(metadata_path)
         make_dir(Path(metadata_dir))  # create the metadata dir if it has not been created yet
 
@@ -450,32 +809,16 @@ class DataFormatter:
             else:
                 print('WARNING: was not possible to extract the birthday in patient: {}'.format(patient))
 
-    # given the input_folder (e.g. 'test_data'), the output_folder (e.g. 'results'), the absolute path of the patient folder
-    # and the filename, create the output_path_dir if it doesn't exis yet, and output the dir_path and file_path
-    def _make_output_path(self, patient_folder, filename):
+    def _output_dir(self, patient_folder):
         """
-        given the input_folder (e.g. 'test_data'), the output_folder (e.g. 'results'), the absolute path of the patient folder
-        and the filename, create the output_path_dir if it doesn't exist yet, and return the dir_path and file_path
+        Return the output folder of the patient with the given absolute folder path
         """
-        output_path_dir = self.abs_out_path + patient_folder[len(self.abs_in_path):]
-        make_dir(Path(output_path_dir))
-        file = remove_data_format(filename)  # file is filename without '.format'
-
-        # make sure that all the files have a distinct name
-        idx = 0
-        while True:
-            out_filename = file + str(idx) + '.pdf'
-            output_path_file = os.path.join(output_path_dir, out_filename)
-            if Path(output_path_file).is_file():
-                idx += 1
-            else:
-                break
-        return output_path_file, output_path_dir
+        return self.abs_out_path + patient_folder[len(self.abs_in_path):]
 
     def _save_log(self, not_converted_files, ignored_files, verbose=True):
 
         # save in the log ignored and not converted files
-        with open(self.log_path, 'a', encoding='utf-8') as f:
+        with io.StringIO() as f:
             tot_files = self.tot_files
             if ignored_files:
                 f.write(
@@ -498,6 +841,11 @@ class DataFormatter:
             if not ignored_files and not_converted_files:
                 f.write('All the {} files have been successfully converted.'.format(self.tot_files))
 
+            self.writer.log(f.getvalue())
+        self.writer.event('summary', files=self.tot_files, ignored=len(ignored_files),
+                          not_converted=len(not_converted_files))
+        self.writer.flush()
+
         # print the log
         if verbose:
             with open(self.log_path, 'r', encoding='utf-8') as f:
@@ -506,21 +854,6 @@ class DataFormatter:
                 for line in lines:
                     print(line, end='')
 
-    def _update_info_txt(self, in_path_file, out_path_file, out_path_dir):
-        """
-        update (create, if doesn't exist yet) the txt file with the time creation of the in_path_file
-        """
-        txt_path = os.path.join(out_path_dir, 'info.txt')
-        with open(txt_path, "a+", encoding='utf-8') as file:
-            if self.time_order == 'creation':
-                path_time = str(os.path.getctime(in_path_file))
-            else:
-                path_time = str(os.path.getmtime(in_path_file))
-            file_info = out_path_file + '\n' + path_time + '\n'
-            file_info = file_info.encode('utf-8', 'replace').decode('utf-8')
-            file.write(out_path_file + '\n' + path_time + '\n', )
-        return txt_path
-
     def _show_info(self, file, skipping=False):
         skipping_text = ''
         if skipping:
@@ -532,5 +865,13 @@ class DataFormatter:
             print('\t[{}/{} files processed ({:.1f}%)] - file {}{} '
                   .format(self.n_files, self.tot_files, 100 * self.n_files / self.tot_files, skipping_text, file))
         else:
-            # update the charging bar
-            self.charge_bar.update(n=1)
+            # the charging bar is updated once per patient
+            self._charge_bar_pending += 1
+
+    def _update_charge_bar(self):
+        """
+        Update the charging bar with the files shown since the last update
+        """
+        if self._charge_bar_pending and self.charge_bar is not None:
+            self.charge_bar.update(n=self._charge_bar_pending)
+            self._charge_bar_pending = 0
@@ -0,0 +1,316 @@
+import asyncio
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from data_formatter.util import get_format
+from data_formatter.pdf_converter import get_converter
+from data_formatter.data_formatter import _timed_file_to_pdf, _worker_file_to_pdf, _add_cache_stats
+from data_formatter.cache import open_cache, close_cache
+from data_formatter.metrics import stage
+
+# a file processed by the engine: status is 'converted', 'error' or 'skipped', error is the error message of a file not
+# converted, and seconds is the time taken by its conversion. out_path is None for the skipped files
+FileResult = namedtuple('FileResult', ['patient_folder', 'in_path', 'out_path', 'status', 'error', 'seconds'])
+# maximum number of results waiting to be read: when the results are not read, the conversions stop
+MAX_PENDING_RESULTS = 1000
+
+
+class FormatEngine:
+    def __init__(self, formatter, workers=None, merge_workers=1, patients_in_flight=None, queue_size=2):
+        """
+        Asyncio engine that formats the files of a DataFormatter like DataFormatter.format, with the stages of the run
+        connected by bounded queues: the planning of the patients, the conversion of their files, and the merge of their
+        PDFs with their metadata. The event loop only moves the patients between the stages:
+        - the scan, the record, the log and the other bookkeeping of DataFormatter run in a single bookkeeping thread,
+          since the record can only be used by the thread that opened it. The scan lists the directories with the
+          formatter's scan_workers
+        - the files are converted in a pool of workers processes, when workers is more than one and the converter is
+          process safe, otherwise in a pool of workers threads if the converter is thread safe, and in a single thread
+          for the other converters, e.g. the Office sessions belong to that thread
+        - the patients are merged in a pool of merge_workers threads
+
+        The results of the files are yielded by run as the files are processed. The patients are committed to the record
+        when all their files are converted, so a run that is stopped early, e.g. by leaving the loop over run, is
+        recovered by the next run like an interrupted format.
+
+        :param formatter: DataFormatter
+        :param workers: maximum number of files converted at the same time. By default formatter.workers
+        :param merge_workers: maximum number of patients merged at the same time
+        :param patients_in_flight: maximum number of patients whose files are being converted. By default workers
+        :param queue_size: maximum number of patients waiting between two stages
+        """
+        self.formatter = formatter
+        self.workers = workers if workers is not None else formatter.workers
+        self.merge_workers = merge_workers
+        self.patients_in_flight = patients_in_flight if patients_in_flight is not None else self.workers
+        self.queue_size = queue_size
+
+    async def run(self):
+        """
+        Format the files and yield the FileResult of every file as it is processed: first the files skipped because
+        they were processed in a previous run, then the converted files, in the order in which their conversions
+        finish. The errors of the run are raised after the results that precede them
+        """
+        results = asyncio.Queue(MAX_PENDING_RESULTS)
+        run = asyncio.ensure_future(self._run(results))
+        try:
+            while True:
+                get = asyncio.ensure_future(results.get())
+                await asyncio.wait([get, run], return_when=asyncio.FIRST_COMPLETED)
+                if get.done():
+                    yield get.result()
+                    continue
+                get.cancel()
+                # the run is over: yield the results left in the queue, and raise its error, if any
+                while not results.empty():
+                    yield results.get_nowait()
+                run.result()
+                break
+        finally:
+            if not run.done():
+                run.cancel()
+                try:
+                    await run
+                except asyncio.CancelledError:
+                    pass
+
+    async def _run(self, results):
+        formatter = self.formatter
+        loop = asyncio.get_running_loop()
+        self._results = results
+        self._bookkeeping = ThreadPoolExecutor(max_workers=1)
+        self._serial = ThreadPoolExecutor(max_workers=1)
+        self._threads = ThreadPoolExecutor(max_workers=self.workers)
+        self._processes = None
+        self._merges = ThreadPoolExecutor(max_workers=self.merge_workers)
+        record = None
+        cache_args = None
+        merge_worker = None
+        tasks = []
+        try:
+            inventory, record = await self._bookkeep(formatter._open_run)
+            if formatter.metrics_interval is not None:
+                formatter.metrics.start_export(formatter.metrics_interval, formatter.metrics_path,
+                                               formatter.prometheus_path)
+            if formatter.cache_dir is not None:
+                cache_args = (formatter.cache_dir, formatter.cache_size)
+                cache = open_cache(*cache_args)
+            if self.workers > 1:
+                # imported here, like in format, to keep the startup fast
+                from concurrent.futures import ProcessPoolExecutor
+                if cache_args is not None:
+                    self._processes = ProcessPoolExecutor(max_workers=self.workers, initializer=open_cache,
+                                                          initargs=cache_args)
+                else:
+                    self._processes = ProcessPoolExecutor(max_workers=self.workers)
+            self._conversions = asyncio.Semaphore(self.workers)
+
+            not_converted_files = []
+            ignored_files = []
+            planned = asyncio.Queue(self.queue_size)
+            converted = asyncio.Queue(self.queue_size)
+            merge_worker = _MergeQueue(converted, loop)
+            tasks = [asyncio.ensure_future(self._plan(inventory, record, ignored_files, planned)),
+                     asyncio.ensure_future(self._convert(planned, record, merge_worker, not_converted_files))]
+            tasks += [asyncio.ensure_future(self._merge(converted)) for _ in range(self.merge_workers)]
+            await _wait_all(tasks)
+
+            await self._bookkeep(self._close, record)
+            record = None
+            if cache_args is not None:
+                # the hits and misses of this run, in this process and in the workers
+                cache_counts = list(cache.stats())
+            else:
+                cache_counts = None
+            await self._bookkeep(formatter._end_run, not_converted_files, ignored_files, cache_counts, False)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if merge_worker is not None:
+                # the merge stage has stopped, so the patients can't be submitted anymore
+                merge_worker.abort()
+            self._serial.shutdown(cancel_futures=True)
+            self._threads.shutdown(cancel_futures=True)
+            self._merges.shutdown()
+            if self._processes is not None:
+                self._processes.shutdown(cancel_futures=True)
+            if record is not None:
+                # the run has been stopped: the next run recovers the patients in flight from the journal
+                await self._bookkeep(self._close, record)
+            self._bookkeeping.shutdown()
+            if cache_args is not None:
+                close_cache()
+
+    def _close(self, record):
+        """
+        Close the journal, the writer and the record, after the last merge
+        """
+        formatter = self.formatter
+        formatter.metrics.stop_export()
+        formatter.journal.close()
+        formatter.writer.commit()
+        record.close()
+
+    async def _plan(self, inventory, record, ignored_files, planned):
+        """
+        Stage that plans the conversions of the patients, as in format, and puts them in the planned queue. The skipped
+        files are added to the results
+        """
+        for patient in inventory.patients:
+            n_ignored = len(ignored_files)
+            jobs = await self._bookkeep(self._plan_patient, patient, record, ignored_files)
+            for in_path_file in ignored_files[n_ignored:]:
+                await self._results.put(FileResult(patient.folder, in_path_file, None, 'skipped', None, 0.0))
+            await planned.put((patient, jobs))
+        await planned.put(None)
+
+    def _plan_patient(self, patient, record, ignored_files):
+        formatter = self.formatter
+        with stage('plan'):
+            jobs = formatter._plan_patient(patient, record, ignored_files)
+        if jobs:
+            # from now on, an interrupted run is recovered by processing the patient again
+            formatter.journal.begin(formatter._output_dir(patient.folder), patient.folder,
+                                    [[in_path_file, out_path_file] for in_path_file, out_path_file, _ in jobs])
+        return jobs
+
+    async def _convert(self, planned, record, merge_worker, not_converted_files):
+        """
+        Stage that converts the files of up to patients_in_flight patients at the same time. When all the files of a
+        patient are converted, the patient is finished as in format and its manifest goes to the merge stage
+        """
+        in_flight = asyncio.Semaphore(self.patients_in_flight)
+        patients = set()
+        try:
+            while True:
+                item = await planned.get()
+                if item is None:
+                    break
+                await in_flight.acquire()
+                task = asyncio.ensure_future(self._convert_patient(*item, record, merge_worker, not_converted_files))
+                task.add_done_callback(lambda _: in_flight.release())
+                patients.add(task)
+                # raise the error of a finished patient, if any
+                for finished in [task for task in patients if task.done()]:
+                    patients.discard(finished)
+                    finished.result()
+            await _wait_all(list(patients))
+        finally:
+            for task in patients:
+                task.cancel()
+        await merge_worker.close(self.merge_workers)
+
+    async def _convert_patient(self, patient, jobs, record, merge_worker, not_converted_files):
+        conversions = [self._convert_file(patient, in_path_file, out_path_file)
+                       for in_path_file, out_path_file, _ in jobs]
+        conversion_results = await asyncio.gather(*conversions)
+        await self._bookkeep(self.formatter._finish_patient, patient, jobs, conversion_results, record, merge_worker,
+                             not_converted_files)
+
+    async def _convert_file(self, patient, in_path_file, out_path_file):
+        """
+        Convert a file in the executor of its converter, add its result to the results and return its error message and
+        the seconds of the conversion
+        """
+        converter = get_converter(get_format(in_path_file))
+        if converter is not None and converter.process_safe and self._processes is not None:
+            executor = self._processes
+        elif converter is not None and converter.thread_safe:
+            executor = self._threads
+        else:
+            executor = self._serial
+        loop = asyncio.get_running_loop()
+        async with self._conversions:
+            try:
+                if executor is self._processes:
+                    error_msg, seconds, cache_stats = await loop.run_in_executor(
+                        executor, _worker_file_to_pdf, in_path_file, out_path_file, self.formatter.print_folders,
+                        self.formatter.max_decode_memory)
+                    _add_cache_stats(cache_stats)
+                else:
+                    error_msg, seconds = await loop.run_in_executor(executor, _timed_file_to_pdf, in_path_file,
+                                                                    out_path_file, self.formatter.print_folders,
+                                                                    self.formatter.max_decode_memory)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # e.g. the worker process of the conversion failed
+                error_msg, seconds = str(e), 0.0
+        status = 'converted' if error_msg is None else 'error'
+        await self._results.put(FileResult(patient.folder, in_path_file, out_path_file, status, error_msg, seconds))
+        return error_msg, seconds
+
+    async def _merge(self, converted):
+        """
+        Stage that merges the PDFs of the converted patients and writes their metadata
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            manifest = await converted.get()
+            if manifest is None:
+                break
+            try:
+                await loop.run_in_executor(self._merges, self.formatter._merge_patient, manifest)
+            except Exception as e:
+                # handle errors in the merging process
+                self.formatter._append_err(str(e))
+
+    async def _bookkeep(self, function, *args):
+        """
+        Call function with args in the bookkeeping thread
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._bookkeeping, function, *args)
+
+
+class _MergeQueue:
+    def __init__(self, queue, loop):
+        """
+        Stand-in for the MergeWorker of format, that submits the manifests from the bookkeeping thread to the queue of
+        the merge stage. submit blocks the bookkeeping thread while the queue is full
+        """
+        self.queue = queue
+        self.loop = loop
+        self._pending = set()  # futures of the manifests being put in the queue
+        self._aborted = False
+        self._lock = threading.Lock()
+
+    def submit(self, manifest):
+        with self._lock:
+            if self._aborted:
+                raise RuntimeError('The merge stage has stopped')
+            future = asyncio.run_coroutine_threadsafe(self.queue.put(manifest), self.loop)
+            self._pending.add(future)
+        try:
+            future.result()
+        finally:
+            self._pending.discard(future)
+
+    def abort(self):
+        """
+        Stop the submits waiting for a place in the queue. Called by the event loop
+        """
+        with self._lock:
+            self._aborted = True
+            for future in self._pending:
+                future.cancel()
+
+    async def close(self, n_workers):
+        # one stop signal for every merge worker
+        for _ in range(n_workers):
+            await self.queue.put(None)
+
+
+async def _wait_all(tasks):
+    """
+    Wait until all the tasks are done. If one of them fails, cancel the others and raise its exception
+    """
+    if not tasks:
+        return
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
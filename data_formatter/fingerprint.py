@@ -0,0 +1,55 @@
+import os
+import json
+import hashlib
+
+# size of the blocks in which a file is read to hash it
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """
+    Return the BLAKE2b hash of the content of the file in path, as a hex string
+    """
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def patient_fingerprint(patient, time_order='creation', record=None):
+    """
+    Return a fingerprint of the files of a patient, that changes when the merged PDF of the patient could change: when
+    a file is added, removed or modified, or when the time used to order the files changes.
+
+    Without a record only the stat data of the inventory are used, so no file is opened, and a file is identified by
+    its path in the patient folder. With a record a file is identified by the hash of its content instead, so a file
+    moved or renamed inside the patient folder doesn't change the fingerprint. The hashes are saved in the record, and
+    only the files whose size or modification time has changed since they were hashed are read.
+
+    :param patient: PatientEntry
+    :param time_order: either 'creation' or 'modification'. the time used to order the files of the patient
+    :param record: FilesRecord, or None to not hash the files
+    :return: str
+    """
+    entries = []
+    for file_entry in patient.files:
+        path_time = file_entry.ctime if time_order == 'creation' else file_entry.mtime
+        content_hash = None
+        if record is not None:
+            content_hash = record.get_hash(file_entry.path, file_entry.size, file_entry.mtime)
+            if content_hash is None:
+                try:
+                    content_hash = file_hash(file_entry.path)
+                except OSError:
+                    # the file can't be read, so it is identified by its path
+                    pass
+                else:
+                    record.set_hash(file_entry.path, file_entry.size, file_entry.mtime, content_hash)
+        if content_hash is None:
+            name = os.path.relpath(file_entry.path, patient.folder)
+            entries.append(['path', name, file_entry.size, file_entry.mtime, path_time])
+        else:
+            entries.append(['hash', content_hash, file_entry.size, path_time])
+    entries.sort()
+    return hashlib.blake2b(json.dumps(entries).encode('utf-8'), digest_size=16).hexdigest()
@@ -0,0 +1,163 @@
+import io
+import zlib
+import struct
+from data_formatter.util import open_file
+
+# default maximum memory, in bytes, used to decode an image that has to be resized. A 48 MP photo (about 192 MB
+# decoded) is decoded at a reduced resolution
+MAX_DECODE_MEMORY = 128 * 1024 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# bytes per pixel of the 8 bit PNG color types
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def decode_memory(image):
+    """
+    Estimate the memory needed to decode the whole image. Pillow stores every pixel in 4 bytes, except for the single
+    band modes
+    """
+    x_len, y_len = image.size
+    bytes_per_pixel = 1 if image.mode in ('1', 'L', 'P') else 4
+    return x_len * y_len * bytes_per_pixel
+
+
+def load_reduced(in_file, size, max_memory=MAX_DECODE_MEMORY):
+    """
+    Decode the image in in_file at a reduced resolution, using at most about max_memory bytes, and return it resized to
+    size. JPEG images are decoded with the draft mode of the decoder (down to 1/8 of the resolution), and 8 bit, not
+    interlaced PNG images are decoded in horizontal bands that are reduced one at a time. The other images are decoded
+    as usual.
+
+    :param in_file: str or binary file object. path to the image, or the image itself
+    :param size: (x_len, y_len). size of the returned image
+    :param max_memory: int. memory ceiling in bytes
+    :return: PIL.Image in RGB mode
+    """
+    from PIL import Image
+
+    with Image.open(in_file) as image:
+        if image.format == 'PNG':
+            reduced = _load_png_reduced(in_file, size, max_memory)
+            if reduced is not None:
+                return reduced.resize(size, Image.LANCZOS)
+        elif image.format == 'JPEG':
+            # the decoder picks the largest reduction that still gives an image at least as large as size
+            image.draft(image.mode, size)
+        image.load()
+        factor = min(image.size[0] // size[0], image.size[1] // size[1])
+        reduced = image.convert('RGB')
+    if factor > 1:
+        reduced = reduced.reduce(factor)
+    return reduced.resize(size, Image.LANCZOS)
+
+
+def _read_chunks(f):
+    """
+    Yield the type and the data of every chunk of the PNG file f, after the signature
+    """
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', header)
+        data = f.read(length)
+        f.read(4)  # CRC
+        yield chunk_type, data
+        if chunk_type == b'IEND':
+            return
+
+
+def _load_png_reduced(in_file, size, max_memory):
+    """
+    Decode the PNG in in_file in horizontal bands, each one reduced by an integer factor as soon as it is decoded, so
+    that only one band at full resolution is in memory. Return the reduced image in RGB mode, at least as large as size,
+    or None if the PNG is not supported (interlaced, or not 8 bits per channel).
+
+    Every band is decoded by Pillow as a small PNG made of the last unfiltered row of the previous band followed by the
+    filtered rows of the band, so the PNG filters that refer to the previous row still work.
+    """
+    from PIL import Image
+
+    with open_file(in_file) as f:
+        f.seek(0)
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        chunks = _read_chunks(f)
+        chunk_type, ihdr = next(chunks)
+        if chunk_type != b'IHDR':
+            return None
+        x_len, y_len, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', ihdr)
+        if bit_depth != 8 or interlace != 0 or color_type not in PNG_CHANNELS:
+            return None
+        row_bytes = x_len * PNG_CHANNELS[color_type]
+
+        factor = max(1, min(x_len // size[0], y_len // size[1]))
+        # memory used by every row of a band: the decompressed rows (up to twice), the IDAT chunk and the whole band
+        # PNG, the decoded band and its RGB copy (4 bytes per pixel)
+        band_rows = max_memory // (5 * (row_bytes + 1) + 8 * x_len) // factor * factor
+        band_rows = max(factor, band_rows)
+
+        # copy the chunks that describe the colors, like the palette
+        color_chunks = []
+        reduced = Image.new('RGB', (x_len // factor, y_len // factor))
+        decompressor = zlib.decompressobj()
+        band_bytes = band_rows * (row_bytes + 1)
+        pending = bytearray()  # decompressed filtered rows that have not been decoded yet
+        previous_row = None  # last unfiltered row of the previous band
+        y = 0
+        for chunk_type, data in chunks:
+            if chunk_type in (b'PLTE', b'tRNS', b'gAMA', b'sRGB', b'iCCP', b'cHRM'):
+                color_chunks.append((chunk_type, data))
+                continue
+            if chunk_type != b'IDAT':
+                continue
+            while data:
+                # decompress at most one band at a time
+                pending += decompressor.decompress(data, band_bytes)
+                data = decompressor.unconsumed_tail
+                while True:
+                    n_rows = min(band_rows, y_len - y)
+                    if n_rows == 0 or len(pending) < n_rows * (row_bytes + 1):
+                        break
+                    band_size = n_rows * (row_bytes + 1)
+                    with memoryview(pending) as view:
+                        band, previous_row = _decode_band(ihdr, color_chunks, previous_row, view[:band_size], n_rows)
+                    del pending[:band_size]
+                    if band.mode != 'RGB':
+                        band = band.convert('RGB')
+                    if factor > 1:
+                        band = band.reduce(factor)
+                    reduced.paste(band, (0, y // factor))
+                    y += n_rows
+        return reduced
+
+
+def _decode_band(ihdr, color_chunks, previous_row, band_data, n_rows):
+    """
+    Decode n_rows filtered rows of a PNG. Return the decoded band and its last row, unfiltered
+    """
+    from PIL import Image
+
+    x_len = struct.unpack('>I', ihdr[:4])[0]
+    compressor = zlib.compressobj(0)
+    if previous_row is not None:
+        # a row with filter type 0 (None)
+        idat = compressor.compress(b'\x00' + previous_row) + compressor.compress(band_data) + compressor.flush()
+        n_rows += 1
+    else:
+        idat = compressor.compress(band_data) + compressor.flush()
+    header = struct.pack('>II', x_len, n_rows) + ihdr[8:]
+    chunks = [PNG_SIGNATURE]
+    for chunk_type, data in [(b'IHDR', header)] + color_chunks + [(b'IDAT', idat), (b'IEND', b'')]:
+        chunks.append(struct.pack('>I', len(data)) + chunk_type)
+        chunks.append(data)
+        chunks.append(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+    mini_png = io.BytesIO(b''.join(chunks))
+    del chunks, idat
+    band = Image.open(mini_png)
+    band.load()
+    last_row = band.crop((0, n_rows - 1, x_len, n_rows)).tobytes()
+    if previous_row is not None:
+        band = band.crop((0, 1, x_len, n_rows))
+    return band, last_row
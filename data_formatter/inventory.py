@@ -0,0 +1,177 @@
+import os
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_formatter.util import check_cache_file, get_directory_name
+from data_formatter.patient_parser import extract_patient_data
+from data_formatter.metrics import stage
+
+# a file inside a patient folder, with the stat results collected during the scan
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'ctime', 'mtime'])
+
+
+class PatientEntry:
+    def __init__(self, folder, name, patient_data, files=None):
+        """
+        A patient folder found during the scan.
+
+        :param folder: absolute path to the patient folder
+        :param name: name of the patient folder
+        :param patient_data: first_name, last_name, birthday, case_nr as returned by extract_patient_data
+        :param files: list of FileEntry, in the same order in which os.walk would visit them
+        """
+        self.folder = folder
+        self.name = name
+        self.patient_data = patient_data
+        self.files = files if files is not None else []
+
+
+class Inventory:
+    def __init__(self, in_path, patients=None):
+        """
+        Inventory of all the patient folders in in_path and of the files that they contain. The inventory is built with
+        a single pass over the input folder, and it is shared by all the DataFormatter methods, so that the input folder
+        is never walked more than once.
+
+        :param in_path: absolute path to the input folder
+        :param patients: list of PatientEntry
+        """
+        self.in_path = in_path
+        self.patients = patients if patients is not None else []
+
+    @property
+    def n_files(self):
+        return sum(len(patient.files) for patient in self.patients)
+
+    @classmethod
+    def scan(cls, in_path, workers=1, skip_folders=(), scandir=os.scandir, patient_filter=None):
+        """
+        Walk in_path once with os.scandir and return its Inventory. The DirEntry stat results are used for the file
+        sizes and times, so no further stat call is needed on the files.
+
+        With more than one worker the directories are listed by a pool of threads, so that on a network share many
+        listings wait for the server at the same time. The inventory is the same as with a single worker: the patients
+        and their files are in the order in which os.walk would visit them.
+
+        :param in_path: absolute path to the input folder
+        :param workers: number of directories listed at the same time
+        :param skip_folders: names of the folders that are not walked when they are not inside a patient folder
+        :param scandir: function used to list a directory, like os.scandir
+        :param patient_filter: if not None, function called with the patient data of every patient folder. The patient
+        folders for which it returns False are left out of the inventory, without listing them
+        """
+        inventory = cls(in_path)
+        if workers <= 1:
+            def list_dir(path, in_patient):
+                return _list_dir(path, in_patient, scandir)
+        else:
+            listings = _list_tree(in_path, workers, skip_folders, scandir, patient_filter)
+
+            def list_dir(path, in_patient):
+                return listings[path]
+        inventory._scan_dir(in_path, get_directory_name(in_path), None, list_dir, skip_folders, patient_filter)
+        return inventory
+
+    def _scan_dir(self, path, name, patient, list_dir, skip_folders, patient_filter=None):
+        """
+        Add the content of the directory in path to the inventory. patient is the PatientEntry that contains path, or
+        None if path is not inside a patient folder. list_dir returns the listing of a directory, see _list_dir
+        """
+        if patient is None:
+            with stage('parse'):
+                patient_data = extract_patient_data(name)
+            # if the folder has a case_nr, it is a patient folder
+            if patient_data[3] is not None:
+                if patient_filter is not None and not patient_filter(patient_data):
+                    return
+                patient = PatientEntry(path, name, patient_data)
+                self.patients.append(patient)
+
+        listing = list_dir(path, patient is not None)
+        if listing is None:
+            return
+        subdirs, files = listing
+        if patient is not None:
+            patient.files.extend(files)
+
+        for subdir_path, subdir_name in subdirs:
+            if patient is None and subdir_name in skip_folders:
+                continue
+            self._scan_dir(subdir_path, subdir_name, patient, list_dir, skip_folders, patient_filter)
+
+    def save(self, path):
+        """
+        Save the inventory in a JSON file
+        """
+        patients = [[patient.folder, patient.name, patient.patient_data, [list(file) for file in patient.files]]
+                    for patient in self.patients]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'in_path': self.in_path, 'patients': patients}, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an inventory saved with Inventory.save
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+        patients = [PatientEntry(folder, name, patient_data, [FileEntry(*file) for file in files])
+                    for folder, name, patient_data, files in content['patients']]
+        return cls(content['in_path'], patients)
+
+
+def _list_dir(path, in_patient, scandir=os.scandir):
+    """
+    List the directory in path. Return its subdirectories as a list of (path, name) and, if in_patient, the FileEntry
+    of its files, without the Thumbs.db files. Return None if the directory can't be listed
+    """
+    subdirs = []
+    files = []
+    try:
+        with scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # like os.walk, don't follow the symbolic links to directories
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, entry.name))
+                elif in_patient and not check_cache_file(entry.name):
+                    stat = entry.stat()
+                    files.append(FileEntry(entry.path, stat.st_size, stat.st_ctime, stat.st_mtime))
+    except OSError:
+        # like os.walk, ignore the directories that can't be listed
+        return None
+    return subdirs, files
+
+
+def _list_tree(in_path, workers, skip_folders, scandir=os.scandir, patient_filter=None):
+    """
+    List all the directories in in_path with a pool of workers threads, and return their listings by path, as returned
+    by _list_dir. A directory is listed as soon as the listing of its parent is done. The patient folders rejected by
+    patient_filter are not listed
+    """
+    listings = {}
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(path, name, in_patient):
+            if not in_patient:
+                patient_data = extract_patient_data(name)
+                # the files are only needed inside the patient folders
+                in_patient = patient_data[3] is not None
+                if in_patient and patient_filter is not None and not patient_filter(patient_data):
+                    return
+            futures[executor.submit(_list_dir, path, in_patient, scandir)] = (path, in_patient)
+
+        submit(in_path, get_directory_name(in_path), False)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, in_patient = futures.pop(future)
+                listing = listings[path] = future.result()
+                if listing is None:
+                    continue
+                for subdir_path, subdir_name in listing[0]:
+                    if not in_patient and subdir_name in skip_folders:
+                        continue
+                    submit(subdir_path, subdir_name, in_patient)
+    return listings
@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from data_formatter.util import make_dir
+
+# states of a patient in the journal
+CONVERTING = 'converting'  # the files of the patient are being converted and added to the record
+CONVERTED = 'converted'  # the files are in the record and the PDFs in the manifest sidecar, waiting to be merged
+MERGED = 'merged'  # the merged PDF has been written, the metadata file hasn't
+# once the metadata file has been written the patient is removed from the journal
+
+
+class Journal:
+    def __init__(self, journal_path):
+        """
+        Write-ahead journal of the patients that are being processed. Every patient goes through the states CONVERTING,
+        CONVERTED and MERGED, and is removed from the journal when its metadata file has been written. Every state
+        change is committed to disk before the work of the next state starts, so after a crash the journal tells which
+        patients were in flight and how far they got.
+
+        The journal is used by the main thread and by the merge worker, so every operation takes a lock.
+
+        :param journal_path: path to the SQLite file of the journal
+        """
+        self.journal_path = journal_path
+        make_dir(Path(journal_path).parent)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(journal_path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS patients (out_dir TEXT PRIMARY KEY, folder TEXT, state TEXT, '
+                           'jobs TEXT)')
+        self._conn.commit()
+
+    def begin(self, out_dir, folder, jobs):
+        """
+        Mark the patient with output folder out_dir as CONVERTING
+
+        :param folder: input folder of the patient
+        :param jobs: list of [in_path_file, out_path_file] of the files of the patient converted in this run
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO patients (out_dir, folder, state, jobs) VALUES (?, ?, ?, ?)',
+                               (out_dir, folder, CONVERTING, json.dumps(jobs)))
+            self._conn.commit()
+
+    def set_state(self, out_dir, state):
+        with self._lock:
+            self._conn.execute('UPDATE patients SET state = ? WHERE out_dir = ?', (state, out_dir))
+            self._conn.commit()
+
+    def finish(self, out_dir):
+        """
+        Remove the patient from the journal: all its work is done
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM patients WHERE out_dir = ?', (out_dir,))
+            self._conn.commit()
+
+    def entries(self):
+        """
+        Return the patients in the journal as a list of (out_dir, folder, state, jobs)
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT out_dir, folder, state, jobs FROM patients').fetchall()
+        return [(out_dir, folder, state, json.loads(jobs)) for out_dir, folder, state, jobs in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,103 @@
+import os
+import json
+import bisect
+
+# sidecar file of a manifest, in the output folder of the patient
+SIDECAR_NAME = 'manifest.json'
+# ledger of the converted PDFs written by the previous versions, in the output folder of the patient
+LEGACY_INFO_NAME = 'info.txt'
+
+
+class PatientManifest:
+    def __init__(self, out_dir):
+        """
+        List of the PDFs converted for a patient, ordered by the time of their source files. The entries are kept sorted
+        as they are added, so nothing has to be parsed or sorted when the PDFs are merged.
+
+        The manifest lives in memory. It is saved in a sidecar file in the output folder of the patient only when the
+        run could be interrupted before the PDFs are merged, so that the next run can resume the patient, and the sidecar
+        is removed once the PDFs have been merged.
+
+        :param out_dir: absolute path to the output folder of the patient, where the PDFs are stored
+        """
+        self.out_dir = out_dir
+        self.paths = []
+        self.times = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def sidecar_path(self):
+        return os.path.join(self.out_dir, SIDECAR_NAME)
+
+    def add(self, pdf_path, time):
+        """
+        Add the PDF in pdf_path, converted from a file with the given creation or modification time. PDFs with the same
+        time stay in the order in which they are added
+        """
+        i = bisect.bisect_right(self.times, time)
+        self.times.insert(i, time)
+        self.paths.insert(i, pdf_path)
+
+    def drop(self, paths):
+        """
+        Remove the PDFs in paths from the manifest. The files are not removed
+        """
+        paths = set(paths)
+        entries = [(path, time) for path, time in zip(self.paths, self.times) if path not in paths]
+        self.paths = [path for path, _ in entries]
+        self.times = [time for _, time in entries]
+
+    def save(self):
+        """
+        Save the manifest in its sidecar file. The file is written next to the sidecar and then renamed, so an
+        interrupted run leaves either the old sidecar or the new one. The sidecar replaces the info.txt file of a
+        previous version, if any
+        """
+        # the PDFs are in out_dir, so only their names are saved
+        entries = [[os.path.basename(path), time] for path, time in zip(self.paths, self.times)]
+        tmp_path = self.sidecar_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, separators=(',', ':'))
+        os.replace(tmp_path, self.sidecar_path)
+        info_path = os.path.join(self.out_dir, LEGACY_INFO_NAME)
+        if os.path.isfile(info_path):
+            os.remove(info_path)
+
+    def remove(self):
+        """
+        Remove the sidecar file, and the info.txt file of a previous version, if they exist
+        """
+        for path in (self.sidecar_path, os.path.join(self.out_dir, LEGACY_INFO_NAME)):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def discard(self):
+        """
+        Remove the PDFs of the manifest and its sidecar file
+        """
+        for path in self.paths:
+            if os.path.isfile(path):
+                os.remove(path)
+        self.remove()
+
+    @classmethod
+    def load(cls, out_dir):
+        """
+        Return the manifest of the patient with output folder out_dir, with the PDFs left by an interrupted run: the ones
+        in the sidecar file and the ones in the info.txt file of a previous version. The manifest is empty if there are
+        none
+        """
+        manifest = cls(out_dir)
+        info_path = os.path.join(out_dir, LEGACY_INFO_NAME)
+        if os.path.isfile(info_path):
+            with open(info_path, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            for i in range(len(lines) // 2):
+                manifest.add(lines[2 * i], float(lines[2 * i + 1]))
+        if os.path.isfile(manifest.sidecar_path):
+            with open(manifest.sidecar_path, encoding='utf-8') as f:
+                for name, time in json.load(f):
+                    manifest.add(os.path.join(out_dir, name), time)
+        return manifest
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+from data_formatter.util import get_format
+
+# upper bounds, in seconds, of the buckets of the conversion latency histograms
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+# number of slowest files listed in the report
+SLOWEST_FILES = 20
+# prefix of the names of the Prometheus metrics
+PROMETHEUS_PREFIX = 'data_formatter'
+
+# metrics of the current run, see open_metrics
+_metrics = None
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Histogram of observed values, with the buckets of a Prometheus histogram: counts[i] is the number of values
+        less than or equal to buckets[i], and the last count is the number of all the values
+
+        :param buckets: sorted list of the upper bounds of the buckets
+        """
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return self.counts[-1]
+
+    def observe(self, value):
+        self.sum += value
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+        self.counts[-1] += 1
+
+
+class FormatMetrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Conversions of the files of a data format: the number of files, of errors and of bytes, and the histogram of
+        the seconds taken by file_to_pdf
+        """
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram(buckets)
+
+
+class RunMetrics:
+    def __init__(self, slowest=SLOWEST_FILES, buckets=LATENCY_BUCKETS):
+        """
+        Metrics of a run of DataFormatter.format: the wall time and the count of every stage, the files converted, not
+        converted and skipped, the conversions by data format and the slowest files. Stages can be nested: e.g. the
+        parsing of the folder names is part of the scan.
+
+        The metrics are updated by the main thread and by the merge worker, so every update takes a lock. The
+        conversions done by the worker processes are timed there and added by the main thread with add_file, so with
+        more workers the seconds of the convert stage are the sum of the conversion times, not the wall time.
+
+        :param slowest: number of slowest files to keep
+        :param buckets: upper bounds, in seconds, of the buckets of the conversion latency histograms
+        """
+        self.slowest = slowest
+        self.buckets = buckets
+        self.start_time = time.time()
+        self.stages = {}  # name: [seconds, count]
+        self.files = {'converted': 0, 'error': 0, 'skipped': 0}
+        self.formats = {}  # data format: FormatMetrics
+        self._slowest_files = []  # heap of (seconds, path, data format, size)
+        self._lock = threading.Lock()
+        self._export_thread = None
+        self._stop_export = threading.Event()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds its wall time to the stage with the given name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds, count=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += count
+
+    def add_file(self, path, seconds, size, error=False):
+        """
+        Add the conversion of the file in path, of size bytes, that took the given seconds and failed if error is True
+        """
+        data_format = get_format(path)
+        data_format = data_format.lower() if isinstance(data_format, str) else ''
+        with self._lock:
+            format_metrics = self.formats.get(data_format)
+            if format_metrics is None:
+                format_metrics = self.formats[data_format] = FormatMetrics(self.buckets)
+            format_metrics.latency.observe(seconds)
+            format_metrics.bytes += size
+            if error:
+                format_metrics.errors += 1
+                self.files['error'] += 1
+            else:
+                self.files['converted'] += 1
+            stage = self.stages.setdefault('convert', [0.0, 0])
+            stage[0] += seconds
+            stage[1] += 1
+            entry = (seconds, path, data_format, size)
+            if len(self._slowest_files) < self.slowest:
+                heapq.heappush(self._slowest_files, entry)
+            else:
+                heapq.heappushpop(self._slowest_files, entry)
+
+    def add_skipped(self, count=1):
+        with self._lock:
+            self.files['skipped'] += count
+
+    def report(self):
+        """
+        Return the metrics as a dict that can be saved as JSON
+        """
+        with self._lock:
+            formats = {}
+            for data_format, format_metrics in sorted(self.formats.items()):
+                latency = format_metrics.latency
+                formats[data_format] = {
+                    'count': latency.count, 'errors': format_metrics.errors, 'seconds': latency.sum,
+                    'bytes': format_metrics.bytes,
+                    'bytes_per_second': format_metrics.bytes / latency.sum if latency.sum > 0 else None,
+                    'histogram': {'buckets': latency.buckets, 'counts': latency.counts}}
+            return {
+                'start_time': self.start_time,
+                'elapsed': time.time() - self.start_time,
+                'stages': {name: {'seconds': seconds, 'count': count} for name, (seconds, count) in self.stages.items()},
+                'files': dict(self.files),
+                'formats': formats,
+                'slowest_files': [{'path': path, 'format': data_format, 'seconds': seconds, 'size': size}
+                                  for seconds, path, data_format, size in sorted(self._slowest_files, reverse=True)],
+            }
+
+    def prometheus(self):
+        """
+        Return the metrics in the Prometheus text format
+        """
+        report = self.report()
+        prefix = PROMETHEUS_PREFIX
+        lines = ['# HELP {}_elapsed_seconds Seconds since the start of the run'.format(prefix),
+                 '# TYPE {}_elapsed_seconds gauge'.format(prefix),
+                 '{}_elapsed_seconds {}'.format(prefix, report['elapsed']),
+                 '# HELP {}_stage_seconds_total Wall time spent in every stage'.format(prefix),
+                 '# TYPE {}_stage_seconds_total counter'.format(prefix)]
+        for name, stage in report['stages'].items():
+            lines.append('{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix, _label(name), stage['seconds']))
+        lines += ['# HELP {}_stage_runs_total Number of times every stage has run'.format(prefix),
+                  '# TYPE {}_stage_runs_total counter'.format(prefix)]
+        for name, stage in report['stages'].items():
+            lines.append('{}_stage_runs_total{{stage="{}"}} {}'.format(prefix, _label(name), stage['count']))
+        lines += ['# HELP {}_files_total Files processed, by status'.format(prefix),
+                  '# TYPE {}_files_total counter'.format(prefix)]
+        for status, count in report['files'].items():
+            lines.append('{}_files_total{{status="{}"}} {}'.format(prefix, status, count))
+        lines += ['# HELP {}_conversion_seconds Seconds taken by file_to_pdf, by data format'.format(prefix),
+                  '# TYPE {}_conversion_seconds histogram'.format(prefix)]
+        for data_format, format_report in report['formats'].items():
+            label = _label(data_format)
+            histogram = format_report['histogram']
+            for bucket, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                lines.append('{}_conversion_seconds_bucket{{format="{}",le="{}"}} {}'.format(prefix, label, bucket,
+                                                                                            count))
+            lines.append('{}_conversion_seconds_sum{{format="{}"}} {}'.format(prefix, label, format_report['seconds']))
+            lines.append('{}_conversion_seconds_count{{format="{}"}} {}'.format(prefix, label, format_report['count']))
+        lines += ['# HELP {}_conversion_bytes_total Bytes of the converted files, by data format'.format(prefix),
+                  '# TYPE {}_conversion_bytes_total counter'.format(prefix)]
+        for data_format, format_report in report['formats'].items():
+            lines.append('{}_conversion_bytes_total{{format="{}"}} {}'.format(prefix, _label(data_format),
+                                                                              format_report['bytes']))
+        lines += ['# HELP {}_conversion_errors_total Files not converted, by data format'.format(prefix),
+                  '# TYPE {}_conversion_errors_total counter'.format(prefix)]
+        for data_format, format_report in report['formats'].items():
+            lines.append('{}_conversion_errors_total{{format="{}"}} {}'.format(prefix, _label(data_format),
+                                                                               format_report['errors']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path=None, prometheus_path=None):
+        """
+        Save the report in json_path and the Prometheus metrics in prometheus_path, if not None. The files are written
+        next to their path and then renamed, so that they are never read half written
+        """
+        if json_path is not None:
+            _write_file(json_path, json.dumps(self.report(), indent=2))
+        if prometheus_path is not None:
+            _write_file(prometheus_path, self.prometheus())
+
+    def start_export(self, interval, json_path=None, prometheus_path=None):
+        """
+        Export the metrics every interval seconds in a background thread, until stop_export is called
+        """
+        def run():
+            while not self._stop_export.wait(interval):
+                try:
+                    self.export(json_path, prometheus_path)
+                except OSError:
+                    # e.g. the file is open in another program: try again at the next interval
+                    pass
+
+        self._stop_export.clear()
+        self._export_thread = threading.Thread(target=run, daemon=True)
+        self._export_thread.start()
+
+    def stop_export(self):
+        if self._export_thread is not None:
+            self._stop_export.set()
+            self._export_thread.join()
+            self._export_thread = None
+
+
+def _label(value):
+    """
+    Escape value to be used as the value of a Prometheus label
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_file(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def open_metrics(slowest=SLOWEST_FILES):
+    """
+    Start collecting the metrics of a run in the current process, and return them
+    """
+    global _metrics
+    _metrics = RunMetrics(slowest)
+    return _metrics
+
+
+def get_metrics():
+    """
+    Return the metrics of the current run, or None if they are not being collected
+    """
+    return _metrics
+
+
+def close_metrics():
+    global _metrics
+    if _metrics is not None:
+        _metrics.stop_export()
+        _metrics = None
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager that adds its wall time to the stage with the given name of the current run, if the metrics are
+    being collected
+    """
+    if _metrics is None:
+        yield
+    else:
+        with _metrics.stage(name):
+            yield
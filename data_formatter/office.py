@@ -0,0 +1,310 @@
+import time
+import shutil
+import atexit
+import threading
+from abc import ABC, abstractmethod
+
+# number of documents converted by an Office session before it is restarted
+MAX_DOCUMENTS = 100
+
+
+class OfficeBackend(ABC):
+    """
+    Interface of a document conversion backend. A backend starts sessions (e.g. a running Word application), converts
+    documents with them and stops them. The sessions are reused for many documents by a SessionPool.
+    """
+
+    @abstractmethod
+    def start(self):
+        """
+        Start a new session and return it
+        """
+
+    @abstractmethod
+    def convert(self, session, in_path, out_path):
+        """
+        Convert the document in in_path to PDF with the session, and save it in out_path
+        """
+
+    @abstractmethod
+    def is_alive(self, session):
+        """
+        Return True if the session can still convert documents
+        """
+
+    @abstractmethod
+    def stop(self, session):
+        """
+        Stop the session. Must not raise if the session has crashed
+        """
+
+
+class WordBackend(OfficeBackend):
+    def start(self):
+        import comtypes.client
+        word = comtypes.client.CreateObject('Word.Application')
+        word.Visible = 1
+        return word
+
+    def convert(self, session, in_path, out_path):
+        doc = None
+        try:
+            doc = session.Documents.Open(in_path)
+            doc.SaveAs(out_path, FileFormat=17)
+        finally:
+            if doc is not None:
+                doc.Close()
+
+    def is_alive(self, session):
+        try:
+            session.Documents.Count
+            return True
+        except Exception:
+            return False
+
+    def stop(self, session):
+        try:
+            session.Quit()
+        except Exception:
+            pass
+
+
+class PowerPointBackend(OfficeBackend):
+    def start(self):
+        import comtypes.client
+        powerpoint = comtypes.client.CreateObject('Powerpoint.Application')
+        powerpoint.Visible = 1
+        return powerpoint
+
+    def convert(self, session, in_path, out_path):
+        deck = None
+        try:
+            deck = session.Presentations.Open(in_path)
+            deck.SaveAs(out_path, 32)  # formatType = 32 for ppt to pdf
+        finally:
+            if deck is not None:
+                deck.Close()
+
+    def is_alive(self, session):
+        try:
+            session.Presentations.Count
+            return True
+        except Exception:
+            return False
+
+    def stop(self, session):
+        try:
+            session.Quit()
+        except Exception:
+            pass
+
+
+class ExcelBackend(OfficeBackend):
+    def start(self):
+        from win32com import client
+        # DispatchEx always starts a new Excel instance, instead of attaching to one that may be used by someone else
+        excel = client.DispatchEx('Excel.Application')
+        excel.Visible = False
+        return excel
+
+    def convert(self, session, in_path, out_path):
+        sheets = None
+        try:
+            sheets = session.Workbooks.Open(in_path)
+            work_sheets = sheets.Worksheets[0]
+            work_sheets.ExportAsFixedFormat(0, out_path)
+        finally:
+            if sheets is not None:
+                sheets.Close()
+
+    def is_alive(self, session):
+        try:
+            session.Workbooks.Count
+            return True
+        except Exception:
+            return False
+
+    def stop(self, session):
+        try:
+            session.Quit()
+        except Exception:
+            pass
+
+
+class FakeBackend(OfficeBackend):
+    def __init__(self, start_time=0.0, convert_time=0.0, crash_every=None):
+        """
+        Backend that stands in for an Office application on machines without Office: it copies the input file to
+        out_path. It is meant to test and benchmark the SessionPool.
+
+        :param start_time: seconds needed to start a session
+        :param convert_time: seconds needed to convert a document
+        :param crash_every: if not None, every crash_every-th conversion crashes the session
+        """
+        self.start_time = start_time
+        self.convert_time = convert_time
+        self.crash_every = crash_every
+        self.n_starts = 0
+        self.n_conversions = 0
+
+    def start(self):
+        time.sleep(self.start_time)
+        self.n_starts += 1
+        return {'alive': True}
+
+    def convert(self, session, in_path, out_path):
+        if not session['alive']:
+            raise RuntimeError('The session has crashed')
+        self.n_conversions += 1
+        if self.crash_every is not None and self.n_conversions % self.crash_every == 0:
+            session['alive'] = False
+            raise OSError('The session crashed while converting {}'.format(in_path))
+        time.sleep(self.convert_time)
+        shutil.copy(in_path, out_path)
+
+    def is_alive(self, session):
+        return session['alive']
+
+    def stop(self, session):
+        session['alive'] = False
+
+
+class Session:
+    def __init__(self, backend):
+        """
+        A session of the backend, with the number of documents that it has converted
+        """
+        self.handle = backend.start()
+        self.n_documents = 0
+
+
+class SessionPool:
+    def __init__(self, backend, size=1, max_documents=MAX_DOCUMENTS):
+        """
+        Pool of long-lived sessions of a backend, reused across the documents. Before every conversion the session is
+        checked and replaced if it is not alive anymore, a session that crashes during a conversion is replaced, and
+        every session is recycled after max_documents conversions.
+
+        The sessions are started when they are needed. COM objects can only be used from the thread that created them,
+        so a pool of Office sessions must be used by a single thread.
+
+        :param backend: OfficeBackend
+        :param size: maximum number of sessions
+        :param max_documents: number of documents after which a session is restarted
+        """
+        self.backend = backend
+        self.max_documents = max_documents
+        self.n_restarts = 0  # number of sessions stopped because they crashed or were recycled
+        self._idle = []
+        self._n_free = size  # number of sessions that can still be started
+        self._cond = threading.Condition()
+
+    def convert(self, in_path, out_path):
+        """
+        Convert the document in in_path to PDF with a session of the pool, and save it in out_path
+        """
+        session = self._acquire()
+        try:
+            self.backend.convert(session.handle, in_path, out_path)
+        except Exception:
+            # if the session crashed, throw it away
+            if not self.backend.is_alive(session.handle):
+                self._discard(session)
+                session = None
+            raise
+        finally:
+            if session is not None:
+                self._release(session)
+
+    def close(self):
+        """
+        Stop all the idle sessions
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            self.backend.stop(session.handle)
+
+    def _acquire(self):
+        while True:
+            with self._cond:
+                while not self._idle and self._n_free == 0:
+                    self._cond.wait()
+                if self._idle:
+                    session = self._idle.pop()
+                else:
+                    self._n_free -= 1
+                    session = None
+            if session is None:
+                try:
+                    return Session(self.backend)
+                except Exception:
+                    with self._cond:
+                        self._n_free += 1
+                        self._cond.notify()
+                    raise
+            # health check
+            if self.backend.is_alive(session.handle):
+                return session
+            self._discard(session)
+
+    def _release(self, session):
+        session.n_documents += 1
+        if session.n_documents >= self.max_documents:
+            # recycle the session: a new one will be started when it is needed
+            self._discard(session)
+            return
+        with self._cond:
+            self._idle.append(session)
+            self._cond.notify()
+
+    def _discard(self, session):
+        self.backend.stop(session.handle)
+        with self._cond:
+            self.n_restarts += 1
+            self._n_free += 1
+            self._cond.notify()
+
+
+# backends of the Office data formats
+backends = {'docx': WordBackend, 'pptx': PowerPointBackend, 'xlsx': ExcelBackend}
+_pools = threading.local()
+
+
+def register_backend(data_format, backend_factory):
+    """
+    Use backend_factory() to create the backend of the data format, e.g. to use a different conversion program. The
+    pools already created are not affected
+    """
+    backends[data_format] = backend_factory
+
+
+def get_pool(data_format):
+    """
+    Return the SessionPool of the data format for the current thread, creating it if needed. The pools are closed when
+    the process exits
+    """
+    pools = getattr(_pools, 'pools', None)
+    if pools is None:
+        pools = _pools.pools = {}
+    if data_format not in pools:
+        pools[data_format] = SessionPool(backends[data_format]())
+        atexit.register(pools[data_format].close)
+    return pools[data_format]
+
+
+def benchmark_pool(n_documents, in_path, out_path, start_time=0.5, max_documents=MAX_DOCUMENTS):
+    """
+    Compare the time needed to convert n_documents copies of in_path with a FakeBackend that takes start_time seconds
+    to start, when the application is started for every document and when the sessions are pooled. Return the two
+    times in seconds
+    """
+    times = []
+    for pool_max_documents in (1, max_documents):
+        pool = SessionPool(FakeBackend(start_time=start_time), max_documents=pool_max_documents)
+        start = time.perf_counter()
+        for _ in range(n_documents):
+            pool.convert(in_path, out_path)
+        pool.close()
+        times.append(time.perf_counter() - start)
+    return times
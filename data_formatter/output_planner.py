@@ -0,0 +1,58 @@
+import os
+from pathlib import Path
+from data_formatter.util import make_dir, remove_data_format
+
+
+class OutputPlanner:
+    def __init__(self):
+        """
+        Plans the paths of the PDFs converted for the patients. Every PDF is named after its source file, without the
+        data format, followed by the first number that gives a name not used in the output folder: e.g. scan0.pdf,
+        scan1.pdf, ... for the files named scan.jpg of a patient.
+
+        The output folder of a patient is created and listed once, when the paths of the patient are planned, and the
+        next free number of every name is kept in memory, so no name is probed on the filesystem. The planner remembers
+        the folders that it has created, so that every folder is created only once in a run.
+        """
+        self._created = set()
+
+    def plan(self, out_dir, filenames):
+        """
+        Create the folder out_dir if needed, and return the paths in out_dir of the PDFs of the files with the given
+        names, all distinct and distinct from the files already in out_dir
+
+        :param out_dir: absolute path to the output folder of a patient
+        :param filenames: list of the names of the files to convert
+        :return: list of paths, in the same order as filenames
+        """
+        if out_dir in self._created or os.path.isdir(out_dir):
+            taken = self._list_names(out_dir)
+        else:
+            make_dir(Path(out_dir))
+            taken = set()
+        self._created.add(out_dir)
+
+        next_index = {}  # next number to try, by name
+        paths = []
+        for filename in filenames:
+            file = remove_data_format(filename)  # file is filename without '.format'
+            idx = next_index.get(file, 0)
+            # the numbers below idx are taken, and the taken names only grow, so the first free number is never lower
+            while os.path.normcase(file + str(idx) + '.pdf') in taken:
+                idx += 1
+            out_filename = file + str(idx) + '.pdf'
+            taken.add(os.path.normcase(out_filename))
+            next_index[file] = idx + 1
+            paths.append(os.path.join(out_dir, out_filename))
+        return paths
+
+    @staticmethod
+    def _list_names(out_dir):
+        """
+        Return the names of the files in out_dir, with the case normalized like the filesystem of the platform
+        """
+        try:
+            with os.scandir(out_dir) as entries:
+                return {os.path.normcase(entry.name) for entry in entries if not entry.is_dir()}
+        except OSError:
+            return set()
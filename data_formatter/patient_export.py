@@ -0,0 +1,246 @@
+import os
+import csv
+import json
+from abc import ABC, abstractmethod
+from data_formatter.shard import shard_path
+
+# columns of the exported patients, in the order of the patient data returned by extract_patient_data
+EXPORT_COLUMNS = ['Vorname', 'Nachname', 'Geburtstag', 'Fall-nr']
+# name of the file written in the output folder, by export format
+EXPORT_FILES = {'csv': 'csv_file.csv', 'jsonl': 'patients.jsonl', 'parquet': 'patients.parquet'}
+# number of rows kept in memory before they are written as a row group of the parquet file
+PARQUET_ROW_GROUP = 10000
+
+
+class _FileExport(ABC):
+    def __init__(self, path, append):
+        """
+        File with the exported patients. Without append the rows are written next to path and the file is renamed to
+        path by close, so that a failed export never leaves a half written file. With append the rows are added to the
+        file in path, and case_nrs holds the case numbers that it already contains
+
+        :param path: path to the file
+        :param append: bool. if True, keep the patients already in the file
+        """
+        self.path = path
+        self.case_nrs = set()
+        self._tmp_path = None if append and os.path.isfile(path) else path + '.tmp'
+
+    @abstractmethod
+    def write(self, row):
+        """
+        Write the row first_name, last_name, birthday, case_nr of a patient
+        """
+
+    def close(self):
+        self._close()
+        if self._tmp_path is not None:
+            os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """
+        Close the file after a failed export. The rows written to a new file are discarded
+        """
+        self._close()
+        if self._tmp_path is not None and os.path.isfile(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    @abstractmethod
+    def _close(self):
+        """
+        Close the file, without renaming or removing it
+        """
+
+
+class CsvExport(_FileExport):
+    def __init__(self, path, append=False):
+        super().__init__(path, append)
+        if self._tmp_path is None:
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                reader = csv.reader(f)
+                next(reader, None)  # header
+                self.case_nrs = {row[3] for row in reader if len(row) > 3}
+            self._file = open(path, 'a', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+        else:
+            self._file = open(self._tmp_path, 'w', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(EXPORT_COLUMNS)
+
+    def write(self, row):
+        self._writer.writerow(row)
+
+    def _close(self):
+        self._file.close()
+
+
+class JsonlExport(_FileExport):
+    def __init__(self, path, append=False):
+        super().__init__(path, append)
+        if self._tmp_path is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.case_nrs = {json.loads(line).get(EXPORT_COLUMNS[3]) for line in f if line.strip()}
+            self._file = open(path, 'a', encoding='utf-8')
+        else:
+            self._file = open(self._tmp_path, 'w', encoding='utf-8')
+
+    def write(self, row):
+        self._file.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n')
+
+    def _close(self):
+        self._file.close()
+
+
+class ParquetExport(_FileExport):
+    def __init__(self, path, append=False, row_group=PARQUET_ROW_GROUP):
+        """
+        Parquet file with a string column for every column of EXPORT_COLUMNS, compressed with zstd. A parquet file
+        can't be appended to, so with append the row groups of the existing file are copied to a new file, before the
+        new rows. It needs pyarrow, that is imported only by this export format
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('The parquet export needs pyarrow, install it with: pip install pyarrow') from None
+        # the file is always written again, with the existing rows first
+        super().__init__(path, False)
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([(column, pyarrow.string()) for column in EXPORT_COLUMNS])
+        self._row_group = row_group
+        self._rows = []
+        self._writer = pyarrow.parquet.ParquetWriter(self._tmp_path, self._schema, compression='zstd')
+        if append and os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    for batch in pyarrow.parquet.ParquetFile(f).iter_batches(columns=EXPORT_COLUMNS):
+                        self._writer.write_batch(batch.cast(self._schema))
+                        self.case_nrs.update(batch.column(EXPORT_COLUMNS[3]).to_pylist())
+            except BaseException:
+                self.abort()
+                raise
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._row_group:
+            self._write_rows()
+
+    def _write_rows(self):
+        if self._rows:
+            columns = [self._pyarrow.array(column, self._pyarrow.string()) for column in zip(*self._rows)]
+            self._writer.write_batch(self._pyarrow.RecordBatch.from_arrays(columns, schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        self._write_rows()
+        super().close()
+
+    def _close(self):
+        self._writer.close()
+
+
+EXPORTS = {'csv': CsvExport, 'jsonl': JsonlExport, 'parquet': ParquetExport}
+
+
+def export_path(out_dir, export_format, shard=None):
+    """
+    Return the path of the file of the given export format in out_dir, or of the file of the shard (K, N) if shard is
+    not None
+    """
+    path = os.path.join(out_dir, EXPORT_FILES[export_format])
+    return path if shard is None else shard_path(path, shard)
+
+
+def read_patients(path, export_format):
+    """
+    Yield the first_name, last_name, birthday, case_nr of every patient in the file in path, written by an export of
+    the given format
+    """
+    if export_format == 'csv':
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)  # header
+            for row in reader:
+                # the empty cells are the values that were None
+                yield [value if value != '' else None for value in row]
+    elif export_format == 'jsonl':
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    patient = json.loads(line)
+                    yield [patient.get(column) for column in EXPORT_COLUMNS]
+    else:
+        import pyarrow.parquet
+
+        with open(path, 'rb') as f:
+            for batch in pyarrow.parquet.ParquetFile(f).iter_batches(columns=EXPORT_COLUMNS):
+                yield from (list(row) for row in zip(*(column.to_pylist() for column in batch.columns)))
+
+
+class PatientExporter:
+    def __init__(self, out_dir, formats=('csv',), append=False, shard=None):
+        """
+        Write the patients to a file of every export format in out_dir, named as in EXPORT_FILES, one row at a time as
+        they are added. Every case number is exported once: the patients are deduplicated by case number with an index
+        kept in memory, and the patients without a case number are not exported. The counts of the added, duplicate and
+        not exported patients are kept in counts.
+
+        With append the patients already in the files are kept, and only the patients with a new case number are
+        added, so that a rerun only adds the new patients. Otherwise the files are written again.
+
+        Use it as a context manager: the files are closed at the end of the block, and if an exception is raised the
+        new files are discarded.
+
+        :param out_dir: folder of the files
+        :param formats: export formats among the keys of EXPORT_FILES
+        :param append: bool. if True, add the new patients to the existing files
+        :param shard: if not None, the shard (K, N) of a sharded run, that writes its own files, see export_path
+        """
+        self.counts = {'added': 0, 'existing': 0, 'duplicate': 0, 'no_case_nr': 0}
+        self._seen = set()  # case numbers added in this export
+        self.exports = []
+        try:
+            for export_format in formats:
+                self.exports.append(EXPORTS[export_format](export_path(out_dir, export_format, shard), append))
+        except BaseException:
+            for export in self.exports:
+                export.abort()
+            raise
+
+    def add(self, patient_data):
+        """
+        Export the patient with the given first_name, last_name, birthday, case_nr, if its case number has not been
+        exported yet. Return True if the patient has been added to at least one file
+        """
+        case_nr = patient_data[3]
+        if case_nr is None:
+            self.counts['no_case_nr'] += 1
+            return False
+        if case_nr in self._seen:
+            self.counts['duplicate'] += 1
+            return False
+        self._seen.add(case_nr)
+        added = False
+        for export in self.exports:
+            if case_nr not in export.case_nrs:
+                export.write(patient_data)
+                added = True
+        self.counts['added' if added else 'existing'] += 1
+        return added
+
+    def close(self):
+        for export in self.exports:
+            export.close()
+
+    def abort(self):
+        for export in self.exports:
+            export.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,158 @@
+import os
+import re
+import json
+from calendar import monthrange
+from functools import lru_cache
+from dateutil.parser import parse as date_parse, parserinfo
+
+SKIP_WORDS = frozenset(['', '-', 'geb', 'fallnr', 'fall-nr', 'fr', 'frau', 'hr', 'herr', 'der', 'auf',
+                        'zim', 'nf', 'unbekannt', 'tumorwunde', 'hausarzt'])
+DOCTOR_WORDS = frozenset(['dr', 'prof', 'd'])
+
+# dates like 01.02.1950, 1.2.1950, 01-02-1950, 01/02/1950
+DATE_PATTERN = re.compile(r'(\d{1,2})([./-])(\d{1,2})\2([1-9]\d{3})')
+ALPHA_PATTERN = re.compile(r'[^\W\d_]+')
+DIGIT_PATTERN = re.compile(r'\d')
+WORD_SPLIT_PATTERN = re.compile(r'[,.]')
+
+# all the words that dateutil can recognize in a date. A token without digits that contains any other word can't be
+# parsed as a date
+DATE_WORDS = frozenset(word.lower() for words in parserinfo.JUMP + parserinfo.WEEKDAYS + parserinfo.MONTHS +
+                       parserinfo.HMS + parserinfo.AMPM + parserinfo.UTCZONE + parserinfo.PERTAIN
+                       for word in ((words,) if isinstance(words, str) else words))
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'patient_corpus.json')
+
+
+def extract_patient_data(patient: str) -> list[str, str, str, str]:
+    """
+    Extract first_name, last_name, birthday, case_nr from the patient folder name.
+    The results are memoized per folder name.
+
+    :param patient: patient folder name
+    :return: first_name, last_name, birthday, case_nr
+    """
+    return list(_extract_patient_data(patient))
+
+
+def extract_patients_data(patients: list[str]) -> list[list[str, str, str, str]]:
+    """
+    Extract first_name, last_name, birthday, case_nr from a list of patient folder names. Every distinct name is parsed
+    only once.
+
+    :param patients: list of patient folder names
+    :return: list of first_name, last_name, birthday, case_nr, in the same order as patients
+    """
+    parsed = {patient: _extract_patient_data(patient) for patient in set(patients)}
+    return [list(parsed[patient]) for patient in patients]
+
+
+@lru_cache(maxsize=None)
+def _extract_patient_data(patient):
+    # TODO: Invertire first_name con last_name
+    first_name = None
+    last_name = None
+    birthday = None
+    case_nr = None
+
+    # remove geb. in front of the date, ',' and '-' from beginning and end of words, and the words in SKIP_WORDS
+    patient_data = [datum.replace('geb.', '').strip(' ,-.') for datum in patient.split(' ')]
+    patient_data = [datum for datum in patient_data if datum.lower() not in SKIP_WORDS]
+
+    # first find the birthday, and split the other words if they are separated with a comma or a dot. The 'birthday'
+    # mark remembers the position where the birthday was
+    words = []
+    for datum in patient_data:
+        if is_date(datum):
+            birthday = datum
+            words.append('birthday')
+            continue
+        words.extend(word for word in WORD_SPLIT_PATTERN.split(datum) if word != '')
+
+    # here we remove the doctor name, we isolate the fall_nr and we delete all the remaining numeric data
+    skip_doctor = False
+    patient_data = []
+    for datum in words:
+        if skip_doctor:
+            if len(datum) > 1:
+                skip_doctor = False
+            continue
+        lower_datum = datum.lower()
+        if lower_datum in DOCTOR_WORDS:
+            skip_doctor = True
+            continue
+        # remove nf-zentrum, nf-arzt
+        if 'nf-' in lower_datum:
+            continue
+        if datum.isnumeric():
+            if len(datum) > 5:
+                case_nr = datum
+            continue
+        patient_data.append(datum)
+
+    if patient_data:
+        first_name = patient_data[0]
+        if len(patient_data) > 1 and patient_data[1] != 'birthday':
+            last_name = patient_data[1]
+            for datum in patient_data[2:]:
+                if datum == 'birthday':
+                    break
+                last_name += ' ' + datum
+
+    return first_name, last_name, birthday, case_nr
+
+
+@lru_cache(maxsize=65536)
+def is_date(token: str) -> bool:
+    """
+    Return True if dateutil can parse token as a date. The dates like 01.02.1950 and the words that can't be part of a
+    date are recognized without calling dateutil
+    """
+    match = DATE_PATTERN.fullmatch(token)
+    if match is not None:
+        return _is_valid_date(int(match.group(1)), int(match.group(3)), int(match.group(4)))
+    if DIGIT_PATTERN.search(token) is None:
+        for word in ALPHA_PATTERN.findall(token):
+            if word.lower() not in DATE_WORDS:
+                return False
+    try:
+        return bool(date_parse(token))
+    except Exception:
+        return False
+
+
+def _is_valid_date(first, second, year):
+    """
+    Return True if the date first.second.year is valid, with the same day/month resolution used by dateutil: the first
+    number is the month, unless it is bigger than 12
+    """
+    if first > 12:
+        day, month = first, second
+    else:
+        month, day = first, second
+    if not 1 <= month <= 12:
+        return False
+    return 1 <= day <= monthrange(year, month)[1]
+
+
+def check_corpus(corpus_path=CORPUS_PATH):
+    """
+    Check extract_patient_data against the regression corpus, a JSON list of [patient folder name, expected result]
+    pairs. Return the list of [patient folder name, expected result, result] for the folder names with a different
+    result
+    """
+    with open(corpus_path, 'r', encoding='utf-8') as f:
+        corpus = json.load(f)
+    names = [name for name, _ in corpus]
+    mismatches = []
+    for [name, expected], result in zip(corpus, extract_patients_data(names)):
+        if result != expected:
+            mismatches.append([name, expected, result])
+    return mismatches
+
+
+if __name__ == '__main__':
+    mismatches = check_corpus()
+    for name, expected, result in mismatches:
+        print('{}: expected {}, got {}'.format(name, expected, result))
+    print('{} mismatches'.format(len(mismatches)))
@@ -1,45 +1,122 @@
+import io
 import shutil
-from data_formatter.util import get_format, get_root, get_directory_name, remove_data_format
-from PIL import Image
-import comtypes.client
-from win32com import client
-from fpdf import FPDF
-import extract_msg
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from data_formatter.util import get_format, open_file
+from data_formatter.office import get_pool
+from data_formatter.cache import get_cache
 import os
-from PyPDF2 import PdfMerger
-from textwrap import TextWrapper
-#XLSX vs XLS, DOC vs DOCX
+import struct
+from collections import namedtuple
+from data_formatter.pdf_writer import PdfWriter, write_text
+from data_formatter.image_decode import MAX_DECODE_MEMORY, decode_memory, load_reduced
 
-def file_to_pdf(in_path, out_path, verbose=False):
+# Pillow, extract_msg and PyPDF2 are imported by the converters that use them, so that the commands that don't convert
+# anything (e.g. --extract_csv) start fast and work without them
+
+# width of an A4 page in points
+A4_X_LEN = 595
+# images with more pixels than this are resized to the A4 width instead of being embedded as they are
+MAX_EMBED_PIXELS = 16000000
+# maximum number of attachments of an email converted at the same time
+MAX_ATTACHMENT_WORKERS = 4
+
+# a function that converts the file in in_path to PDF and saves it in out_path. thread_safe and process_safe tell if
+# more conversions can run at the same time in different threads or in different processes. stream_function, if not
+# None, does the same conversion between two binary file objects, so that files kept in memory can be converted.
+# version is part of the key of the converted PDFs in the conversion cache: change it when the output changes.
+# bounded_memory tells if function and stream_function take a max_memory keyword, the memory ceiling of the decoding of
+# an image in bytes
+Converter = namedtuple('Converter', ['function', 'thread_safe', 'process_safe', 'stream_function', 'version',
+                                     'bounded_memory'], defaults=[None, '1', False])
+
+# registry of the converters, by data format
+converters = {}
+# data formats that are converted with the converter of another data format
+aliases = {}
+
+
+def register_converter(data_format, function, thread_safe=False, process_safe=False, data_format_aliases=(),
+                       stream_function=None, version='1', bounded_memory=False):
+    """
+    Register function as the converter of the files with the given data format. A converter registered for a data
+    format that already has one replaces it.
+    On Windows the worker processes of DataFormatter start from a fresh interpreter, so they only know the converters
+    registered by the modules that they import. A converter registered by the main script should be registered as not
+    process safe, so that its files are converted in the main process.
+
+    :param data_format: str. data format without the dot, e.g. 'jpg'
+    :param function: function(in_path, out_path) that converts the file in in_path to PDF and saves it in out_path
+    :param thread_safe: bool. True if more conversions can run at the same time in different threads
+    :param process_safe: bool. True if more conversions can run at the same time in different processes
+    :param data_format_aliases: other data formats that are converted by this converter, e.g. ['jpeg']
+    :param stream_function: function(in_file, out_file) that does the same conversion reading from and writing to binary
+        file objects, or None if the converter needs the file on disk (e.g. the Office applications)
+    :param version: str. version of the converter. The PDFs in the conversion cache made by another version are not
+        used
+    :param bounded_memory: bool. True if function and stream_function take a max_memory keyword, the memory ceiling in
+        bytes of the decoding of an image, see resample_image
+    """
+    data_format = data_format.lower()
+    converters[data_format] = Converter(function, thread_safe, process_safe, stream_function, version, bounded_memory)
+    for alias in data_format_aliases:
+        aliases[alias.lower()] = data_format
+
+
+def normalize_format(data_format):
+    """
+    Return the data format in lower case, replaced by the data format it is an alias of, if any
+    """
+    if not isinstance(data_format, str):
+        return None
+    data_format = data_format.lower()  # This fix any upper/lower case problem (e.g. .JPG vs .jpg)
+    return aliases.get(data_format, data_format)
+
+
+def get_converter(data_format):
+    """
+    Return the Converter registered for the data format (or one of its aliases), or None if there is none
+    """
+    return converters.get(normalize_format(data_format))
+
+
+def file_to_pdf(in_path, out_path, verbose=False, max_decode_memory=MAX_DECODE_MEMORY):
     """
     Convert a file stored in in_path to PDF and store the new PDF file in out_path.
-    The supported data formats are: docx, jpg, msg, pdf, png, pptx, txt, xlsx
+    The supported data formats are the ones in the converters registry: docx, jpg, msg, pdf, png, pptx, txt, xlsx and
+    their aliases. If the conversion cache is open, a file with the same content as a file already converted is
+    served from the cache
 
     :param in_path: str. path to the file that you want to convert to PDF
     :param out_path: str. path where to store the new PDF file
     :param verbose: bool. If true print the error message
+    :param max_decode_memory: int. memory ceiling in bytes of the decoding of an image, passed to the converters
+    registered with bounded_memory
     :return: error_msg: str.
     """
-    data_format = get_format(in_path)
-    data_format = data_format.lower()  # This fix any upper/lower case problem (e.g. .JPG vs .jpg)
-    if data_format == 'doc' or data_format == 'rtf':
-        data_format = 'docx'
-    elif data_format == 'xls':
-        data_format = 'xlsx'
-    elif data_format == 'jpeg':
-        data_format = 'jpg'
-    try:
-        eval(data_format + '_to_pdf(in_path, out_path)')
-        return None
-    except NameError:
+    data_format = normalize_format(get_format(in_path))
+    converter = converters.get(data_format)
+    if converter is None:
         error_msg = "Unrecognized data format: '.{}'. Was not possible to convert the file.".format(data_format)
         if verbose:
             print("\t" + error_msg)
         return error_msg
+    options = {'max_memory': max_decode_memory} if converter.bounded_memory else {}
+    try:
+        cache = get_cache()
+        if cache is None:
+            converter.function(in_path, out_path, **options)
+        else:
+            key = cache.make_key(in_path, data_format, converter.version)
+            if not cache.get(key, out_path):
+                converter.function(in_path, out_path, **options)
+                cache.put(key, out_path)
+        return None
     except RuntimeError:
         error_msg = "The file conversion function timed out, so was not possible to convert the file."
         if verbose:
             print("\t" + error_msg)
+        return error_msg
     except Exception as e:
         #if data_format == 'msg':
         #    error_msg = "You don't have the permission to open the email."
@@ -51,159 +128,311 @@ def file_to_pdf(in_path, out_path, verbose=False):
 
 
 def docx_to_pdf(in_path, out_path):
-    word = comtypes.client.CreateObject('Word.Application')
-    word.Visible = 1
-    doc = None
-    try:
-        doc = word.Documents.Open(in_path)
-        doc.SaveAs(out_path, FileFormat=17)
-    except Exception as error:
-        raise error
-    finally:
-        if doc is not None:
-            doc.Close()
-        # word.Visible = False
-        word.Quit()
-
-
-def jpg_to_pdf(in_path, out_path):
-    image = Image.open(in_path)
-    
-    x_len, y_len = image.size
-    a4_x_len = 595
-    new_x_len = min(x_len, a4_x_len)
-    scale_factor = new_x_len/x_len
-    new_y_len = int(scale_factor * y_len)
-    image = image.resize((new_x_len,new_y_len), Image.ANTIALIAS)
-    
-    im = image.convert('RGB')
-    im.save(out_path)
-    image.close()
-
-
-def msg_to_pdf(in_path, out_path):
-    root_out_path = get_root(out_path)
-    out_path_prov_dir = os.path.join(root_out_path, 'email')  # extract in this folder the email content
-
-    msg = extract_msg.Message(in_path)  # This will create a local 'msg' object for each email in direcory
-    
-    # This will create a separate folder and save a text file with email body content, also it will download all
-    # attachments inside this folder.
-    msg.save(
-        customPath=out_path_prov_dir, maxNameLength=150, customFilename='a')
-    msg.close()
-
-    # convert the email and the attachments to PDF
-    for root, _, files in os.walk(out_path_prov_dir):
-        for file in files:
-            in_file_path = os.path.join(root, file)
-            filename = get_directory_name(in_file_path)
-            out_file_path = os.path.join(out_path_prov_dir, filename + '.pdf')
-            idx = 0
-            while os.path.isfile(out_file_path):
-                out_file_path = os.path.join(out_path_prov_dir, filename + str(idx) + '.pdf')
-                idx += 1
-            err = file_to_pdf(in_file_path, out_file_path)
-            os.remove(in_file_path)
-
-    # merge the email and all the attachments
-    paths = []
-    for root, _, files in os.walk(out_path_prov_dir):
-        # first put the text body of the email ...
-        txt_files = []
-        for file in files:
-            if '.txt' in file:
-                paths.append(os.path.join(root, file))
-                txt_files.append(file)
-        # ... and then all the other attachments
-        for txt_file in txt_files:
-            files.remove(txt_file)
-        for file in files:
-            file_path = os.path.join(root, file)
-            paths.append(file_path)
-
-    merger = PdfMerger()
-
-    for pdf in paths:
-        merger.append(pdf)
-
-    merger.write(out_path)
-    merger.close()
-
-    # remove the folder with the email and the attachments and the copy of the email
-    try:
-        shutil.rmtree(out_path_prov_dir)
-    except OSError:
-        os.remove(out_path_prov_dir)
+    # the Word sessions are reused across the files
+    get_pool('docx').convert(in_path, out_path)
 
 
-def pdf_to_pdf(in_path, out_path):
-    shutil.copy(in_path, out_path)
+def jpg_to_pdf(in_path, out_path, max_memory=MAX_DECODE_MEMORY):
+    image_to_pdf(in_path, out_path, max_memory)
+
+
+def image_to_pdf(in_file, out_file, max_memory=MAX_DECODE_MEMORY):
+    """
+    Save the JPEG or PNG image in in_file as a PDF page, embedding the image data as it is when possible and resizing the
+    image otherwise, decoding it with at most about max_memory bytes. in_file and out_file are paths or binary file
+    objects
+    """
+    if not embed_image(in_file, out_file):
+        resample_image(in_file, out_file, max_memory)
 
 
-def png_to_pdf(in_path, out_path):
-    image = Image.open(in_path)
-   
-    x_len, y_len = image.size
-    a4_x_len = 595
-    new_x_len = min(x_len, a4_x_len)
+def embed_image(in_file, out_file):
+    """
+    Save the image in in_file as a PDF page scaled to the A4 width, without decoding the image: JPEG data is embedded
+    as it is, and PNG data is embedded losslessly. The scaling is done by the page geometry, so the image keeps its
+    resolution. Return False, without writing out_file, if the image is too large or its format can't be embedded
+
+    :param in_file: str or binary file object. path to a JPEG or PNG image, or the image itself
+    :param out_file: str or binary file object. path where to store the PDF file, or the file to write it in
+    :return: bool. True if the PDF has been written
+    """
+    from PIL import Image
+
+    # Image.open only reads the header of the image
+    with Image.open(in_file) as image:
+        x_len, y_len = image.size
+        image_format = image.format
+        mode = image.mode
+    if x_len * y_len > MAX_EMBED_PIXELS:
+        return False
+
+    if image_format == 'JPEG' and mode in ('L', 'RGB'):
+        with open_file(in_file) as f:
+            f.seek(0)
+            data = f.read()
+        color_space = b'/DeviceGray' if mode == 'L' else b'/DeviceRGB'
+        dictionary = b'/Filter /DCTDecode /BitsPerComponent 8'
+    elif image_format == 'PNG':
+        png = read_png(in_file)
+        if png is None:
+            return False
+        data, color_space, dictionary = png
+    else:
+        return False
+
+    new_x_len, new_y_len = a4_page_size(x_len, y_len)
+    with open_file(out_file, 'wb') as f:
+        writer = PdfWriter(f)
+        image = writer.add_stream(b'/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s %s'
+                                  % (x_len, y_len, color_space, dictionary), data)
+        writer.add_image_page(new_x_len, new_y_len, image)
+        writer.close()
+    return True
+
+
+def read_png(in_file):
+    """
+    Read the compressed image data of a PNG file that can be embedded in a PDF as it is: not interlaced, without alpha
+    channel or transparency, with at most 8 bits per channel. Return the data, the PDF color space and the rest of the
+    PDF image dictionary, or None if the PNG can't be embedded
+    """
+    with open_file(in_file) as f:
+        f.seek(0)
+        content = f.read()
+    if content[:8] != b'\x89PNG\r\n\x1a\n':
+        return None
+
+    header = None
+    palette = None
+    idat = []
+    position = 8
+    while position + 8 <= len(content):
+        length, chunk_type = struct.unpack('>I4s', content[position:position + 8])
+        chunk = content[position + 8:position + 8 + length]
+        if chunk_type == b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif chunk_type == b'PLTE':
+            palette = chunk
+        elif chunk_type == b'tRNS':
+            return None
+        elif chunk_type == b'IDAT':
+            idat.append(chunk)
+        elif chunk_type == b'IEND':
+            break
+        position += length + 12
+
+    if header is None or not idat:
+        return None
+    width, _, bit_depth, color_type, _, _, interlace = header
+    if bit_depth > 8 or interlace != 0:
+        return None
+    if color_type == 0:
+        color_space = b'/DeviceGray'
+        colors = 1
+    elif color_type == 2:
+        color_space = b'/DeviceRGB'
+        colors = 3
+    elif color_type == 3 and palette is not None:
+        color_space = b'[/Indexed /DeviceRGB %d <%s>]' % (len(palette) // 3 - 1, palette.hex().encode('ascii'))
+        colors = 1
+    else:
+        # alpha channel
+        return None
+    dictionary = (b'/Filter /FlateDecode /BitsPerComponent %d /DecodeParms <</Predictor 15 /Colors %d '
+                  b'/BitsPerComponent %d /Columns %d>>' % (bit_depth, colors, bit_depth, width))
+    return b''.join(idat), color_space, dictionary
+
+
+def a4_page_size(x_len, y_len):
+    """
+    Return the size of the page, in points, for an image of x_len x y_len pixels: images wider than an A4 page are
+    scaled to the A4 width
+    """
+    new_x_len = min(x_len, A4_X_LEN)
     scale_factor = new_x_len/x_len
     new_y_len = int(scale_factor * y_len)
-    image = image.resize((new_x_len,new_y_len), Image.ANTIALIAS)
-    
-    im = image.convert('RGB')
-    im.save(out_path)
-    image.close()
+    return new_x_len, new_y_len
 
 
-def pptx_to_pdf(in_path, out_path):
-    powerpoint = comtypes.client.CreateObject("Powerpoint.Application")
-    powerpoint.Visible = 1
-    deck = None
+def resample_image(in_file, out_file, max_memory=MAX_DECODE_MEMORY):
+    """
+    Resize the image in in_file to the A4 width and save it as a PDF in out_file. If decoding the whole image would need
+    more than max_memory bytes, the image is decoded at a reduced resolution. in_file and out_file are paths or binary
+    file objects
+    """
+    from PIL import Image
+
+    # the image is closed by the with statement only if it has been opened from a path
+    with Image.open(in_file) as image:
+        new_x_len, new_y_len = a4_page_size(*image.size)
+        if decode_memory(image) > max_memory:
+            resized = None
+        else:
+            resized = image.resize((new_x_len, new_y_len), Image.LANCZOS)
+    if resized is None:
+        resized = load_reduced(in_file, (new_x_len, new_y_len), max_memory)
+
+    im = resized.convert('RGB')
+    im.save(out_file, format='PDF')
+
+
+def msg_to_pdf(in_path, out_path, max_memory=MAX_DECODE_MEMORY):
+    """
+    Convert an email to a single PDF: first the text of the email, then its attachments. The body and the attachments
+    are kept in memory, the attachments with a thread safe converter are converted at the same time in different
+    threads, and the PDF of every part is appended to the merged PDF from memory. Only the attachments whose converter
+    needs a path (e.g. the Office documents) are written to a temporary folder. The attachments that can't be converted
+    are left out. The images are decoded with at most about max_memory bytes
+    """
+    import extract_msg
+    from PyPDF2 import PdfMerger
+
+    msg = extract_msg.Message(in_path)
     try:
-        deck = powerpoint.Presentations.Open(in_path)
-        deck.SaveAs(out_path, 32)  # formatType = 32 for ppt to pdf
-    except Exception as error:
-        raise error
+        parts = email_parts(msg)
     finally:
-        deck.Close()
-        powerpoint.Quit()
+        msg.close()
 
+    # first put the text body of the email (and the text attachments) and then all the other attachments
+    parts.sort(key=lambda part: '.txt' not in part[0])
 
-def txt_to_pdf(in_path, out_path):
-    pdf = FPDF()
+    part_converters = [get_converter(get_format(filename)) for filename, _ in parts]
+    tmp_dir = None
+    if any(converter is not None and converter.stream_function is None for converter in part_converters):
+        tmp_dir = tempfile.mkdtemp()
+    try:
+        pdfs = [None] * len(parts)
+        with ThreadPoolExecutor(max_workers=MAX_ATTACHMENT_WORKERS) as executor:
+            futures = {}
+            for i, (part, converter) in enumerate(zip(parts, part_converters)):
+                if converter is not None and converter.thread_safe:
+                    futures[i] = executor.submit(convert_email_part, converter, part, tmp_dir, i, max_memory)
+            # the other attachments are converted in this thread, e.g. the Office sessions belong to it
+            for i, (part, converter) in enumerate(zip(parts, part_converters)):
+                if converter is not None and not converter.thread_safe:
+                    pdfs[i] = convert_email_part(converter, part, tmp_dir, i, max_memory)
+            for i, future in futures.items():
+                pdfs[i] = future.result()
 
-    pdf.add_page()
-    pdf.set_font("Arial", size=11)
-    wrapper = TextWrapper(width=95, break_long_words=True)
+        merger = PdfMerger()
+        for pdf in pdfs:
+            if pdf is not None:
+                merger.append(pdf)
+        merger.write(out_path)
+        merger.close()
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    with open(in_path, "r", encoding='utf-8') as f:
 
-        for line in f:
-            line_no_special_chars = line.encode('utf-8', 'replace').decode('utf-8')
-            short_lines = wrapper.wrap(text=line_no_special_chars)
-            for short_line in short_lines:
-                #print(line)
-                pdf.cell(200, 10, txt=short_line, ln=1, align='L')
-                
-    pdf.output(out_path)
+def email_parts(msg):
+    """
+    Return the text body and the attachments of the email msg as a list of (filename, data), with data in bytes. The
+    emails attached to msg are added with their own body and attachments. The body is named message.txt, like the file
+    saved by extract_msg
+    """
+    from extract_msg.enums import AttachmentType
+    from extract_msg.utils import prepareFilename
 
+    parts = [('message.txt', msg.getSaveBody())]
+    for attachment in msg.attachments:
+        if attachment.type == AttachmentType.MSG:
+            parts.extend(email_parts(attachment.data))
+        elif attachment.type == AttachmentType.DATA and attachment.data is not None:
+            filename = prepareFilename(str(attachment.getFilename()))
+            parts.append((filename, attachment.data))
+    return parts
 
-def xlsx_to_pdf(in_path, out_path):
-    excel = client.Dispatch("Excel.Application")
-    excel.Visible = True
-    sheets = None
+
+def convert_email_part(converter, part, tmp_dir, i, max_memory=MAX_DECODE_MEMORY):
+    """
+    Convert a part of an email, as returned by email_parts, with the converter. Return the PDF in a BytesIO, or None if
+    the part can't be converted. tmp_dir is the folder where to write the parts whose converter needs a path, i is used
+    to give them a unique name, and max_memory is passed to the converters registered with bounded_memory
+    """
+    filename, data = part
+    options = {'max_memory': max_memory} if converter.bounded_memory else {}
+    pdf = io.BytesIO()
+    cache = get_cache()
+    try:
+        if cache is not None:
+            key = cache.make_key(data, normalize_format(get_format(filename)), converter.version)
+            if cache.get(key, pdf):
+                pdf.seek(0)
+                return pdf
+        if converter.stream_function is not None:
+            converter.stream_function(io.BytesIO(data), pdf, **options)
+        else:
+            in_path = os.path.join(tmp_dir, '{}.{}'.format(i, get_format(filename)))
+            out_path = os.path.join(tmp_dir, '{}.pdf'.format(i))
+            with open(in_path, 'wb') as f:
+                f.write(data)
+            converter.function(in_path, out_path, **options)
+            with open(out_path, 'rb') as f:
+                pdf.write(f.read())
+        if cache is not None:
+            cache.put(key, pdf)
+    except Exception:
+        return None
+    pdf.seek(0)
+    return pdf
+
+
+def pdf_to_pdf(in_path, out_path):
+    shutil.copy(in_path, out_path)
+
+
+def png_to_pdf(in_path, out_path, max_memory=MAX_DECODE_MEMORY):
+    image_to_pdf(in_path, out_path, max_memory)
+
+
+def pptx_to_pdf(in_path, out_path):
+    # the PowerPoint sessions are reused across the files
+    get_pool('pptx').convert(in_path, out_path)
+
+
+def txt_to_pdf(in_path, out_path):
+    # the pages are written to out_path while the text file is read
+    try:
+        with open(in_path, 'rb') as f, open(out_path, 'wb') as out:
+            text_to_pdf(f, out)
+    except Exception:
+        # don't leave a partial PDF behind
+        if os.path.isfile(out_path):
+            os.remove(out_path)
+        raise
+
+
+def text_to_pdf(in_file, out_file):
+    """
+    Write the UTF-8 text read from the binary file object in_file as PDF pages in the binary file object out_file
+    """
+    text = io.TextIOWrapper(in_file, encoding='utf-8')
     try:
-        sheets = excel.Workbooks.Open(in_path)
-        work_sheets = sheets.Worksheets[0]
-        work_sheets.ExportAsFixedFormat(0, out_path)
-    except Exception as error:
-        raise error
+        writer = PdfWriter(out_file)
+        write_text(writer, text)
+        writer.close()
     finally:
-        if sheets is not None:
-            sheets.Close()
-        excel.Visible = False
-        excel.Quit()
+        # leave in_file open
+        text.detach()
+
 
+def xlsx_to_pdf(in_path, out_path):
+    # the Excel sessions are reused across the files
+    get_pool('xlsx').convert(in_path, out_path)
 
 
+# the Office applications run out of process and are not thread safe. Word and Excel start a new instance for every
+# process, while PowerPoint has a single instance shared by all the processes. The emails are converted with the
+# converters of their attachments, so they are process safe only if all of them are: a pptx attachment converted in a
+# worker process would use the PowerPoint instance of the main process at the same time
+register_converter('docx', docx_to_pdf, process_safe=True, data_format_aliases=['doc', 'rtf'])
+register_converter('jpg', jpg_to_pdf, thread_safe=True, process_safe=True, data_format_aliases=['jpeg'],
+                   stream_function=image_to_pdf, bounded_memory=True)
+register_converter('msg', msg_to_pdf, bounded_memory=True)
+register_converter('pdf', pdf_to_pdf, thread_safe=True, process_safe=True, stream_function=shutil.copyfileobj)
+register_converter('png', png_to_pdf, thread_safe=True, process_safe=True, stream_function=image_to_pdf,
+                   bounded_memory=True)
+register_converter('pptx', pptx_to_pdf)
+register_converter('txt', txt_to_pdf, thread_safe=True, process_safe=True, stream_function=text_to_pdf)
+register_converter('xlsx', xlsx_to_pdf, process_safe=True, data_format_aliases=['xls'])
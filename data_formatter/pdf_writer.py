@@ -0,0 +1,239 @@
+import io
+import os
+import zlib
+from textwrap import TextWrapper
+
+# layout of the text pages, the same used by FPDF for an A4 page with Arial 11 and a cell 10 mm high for every line
+A4_WIDTH = 595.28
+A4_HEIGHT = 841.89
+TEXT_FONT_SIZE = 11
+TEXT_X = 31.19
+TEXT_FIRST_BASELINE = 796.07
+TEXT_LEADING = 10 * 72 / 25.4
+TEXT_LINES_PER_PAGE = 26
+TEXT_WRAP_WIDTH = 95
+
+
+class PdfWriter:
+    def __init__(self, f):
+        """
+        Minimal PDF writer that writes every object to the file object f as soon as it is added, so that the memory
+        used doesn't depend on the size of the document. Only the offsets of the objects and the references of the pages
+        are kept in memory. Call close() to write the page tree, the cross-reference table and the trailer.
+
+        :param f: file object opened in binary mode
+        """
+        self.f = f
+        self.offsets = [None, None, None]  # object 0 is the free object, 1 is the catalog and 2 the page tree
+        self.pages = []
+        self.position = 0
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self.f.write(data)
+        self.position += len(data)
+
+    def _new_object(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def _write_object(self, number, content):
+        self.offsets[number] = self.position
+        self._write(b'%d 0 obj\n' % number + content + b'\nendobj\n')
+
+    def add_object(self, content):
+        """
+        Write an object with the given content (bytes) and return its number
+        """
+        number = self._new_object()
+        self._write_object(number, content)
+        return number
+
+    def add_stream(self, dictionary, data, compress=False):
+        """
+        Write a stream object and return its number. dictionary is the content of the stream dictionary without the
+        Length entry, e.g. b'/Type /XObject'. If compress is True, data is compressed with FlateDecode
+        """
+        if compress:
+            data = zlib.compress(data)
+            dictionary += b' /Filter /FlateDecode'
+        number = self._new_object()
+        self.offsets[number] = self.position
+        self._write(b'%d 0 obj\n<<%s /Length %d>>\nstream\n' % (number, dictionary, len(data)))
+        self._write(data)
+        self._write(b'\nendstream\nendobj\n')
+        return number
+
+    def add_page(self, width, height, content, resources=b''):
+        """
+        Write a page of width x height points, with the given content stream and resources dictionary content. Return
+        the number of the page object
+        """
+        content_number = self.add_stream(b'', content, compress=True)
+        page = self.add_object(b'<</Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] /Resources <<%s>> /Contents %d 0 R>>'
+                               % (_number(width), _number(height), resources, content_number))
+        self.pages.append(page)
+        return page
+
+    def add_image_page(self, width, height, image):
+        """
+        Write a page of width x height points filled by the image XObject with number image
+        """
+        content = b'q %s 0 0 %s 0 0 cm /Im0 Do Q' % (_number(width), _number(height))
+        return self.add_page(width, height, content, b'/XObject <</Im0 %d 0 R>>' % image)
+
+    def add_pdf(self, source):
+        """
+        Append all the pages of the PDF in source, with the objects that they use. The source is read with PyPDF2 and
+        its objects are written as soon as they are reached from its pages, so only one source at a time is in memory.
+        Return the number of pages added
+
+        :param source: str or binary file object. path to the PDF, or the PDF itself
+        """
+        # PyPDF2 is only needed to read PDFs, so it is imported here
+        from PyPDF2 import PdfReader
+
+        reader = PdfReader(source)
+        numbers = {}  # (number, generation) of the objects in source -> number of the objects in this PDF
+        pending = []  # objects to write: (number, object, True if it is a page)
+        new_pages = []
+        for page in reader.pages:
+            number = self._new_object()
+            numbers[(page.indirect_ref.idnum, page.indirect_ref.generation)] = number
+            pending.append((number, page, True))
+            new_pages.append(number)
+        while pending:
+            number, obj, is_page = pending.pop()
+            self._write_object(number, self._copy_object(obj, numbers, pending, is_page))
+        self.pages.extend(new_pages)
+        return len(new_pages)
+
+    def _copy_object(self, obj, numbers, pending, is_page=False):
+        """
+        Return obj, an object read by PyPDF2, serialized with the references renumbered. The referenced objects that
+        have not been reached yet get a new number and are added to pending. The pages point to the page tree of this
+        PDF, and the references to the page tree or to the catalog of the source are dropped
+        """
+        from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key not in numbers:
+                target = obj.get_object()
+                if isinstance(target, DictionaryObject) and target.get('/Type') in ('/Pages', '/Catalog'):
+                    return b'null'
+                numbers[key] = self._new_object()
+                pending.append((numbers[key], target, False))
+            return b'%d 0 R' % numbers[key]
+        if isinstance(obj, DictionaryObject):
+            content = [b'<<']
+            for key, value in obj.items():
+                if isinstance(obj, StreamObject) and key == '/Length':
+                    continue
+                content.append(_serialize(key))
+                if is_page and key == '/Parent':
+                    content.append(b'2 0 R')
+                else:
+                    content.append(self._copy_object(value, numbers, pending))
+            if isinstance(obj, StreamObject):
+                # the data is copied as it is, still encoded with its filters
+                data = obj._data
+                content.append(b'/Length %d>>\nstream\n' % len(data) + data + b'\nendstream')
+            else:
+                content.append(b'>>')
+            return b' '.join(content)
+        if isinstance(obj, ArrayObject):
+            return b'[' + b' '.join(self._copy_object(value, numbers, pending) for value in obj) + b']'
+        return _serialize(obj)
+
+    def close(self):
+        """
+        Write the page tree, the catalog, the cross-reference table and the trailer
+        """
+        kids = b' '.join(b'%d 0 R' % page for page in self.pages)
+        self._write_object(2, b'<</Type /Pages /Kids [%s] /Count %d>>' % (kids, len(self.pages)))
+        self._write_object(1, b'<</Type /Catalog /Pages 2 0 R>>')
+        xref_position = self.position
+        xref = [b'xref\n0 %d\n' % len(self.offsets), b'0000000000 65535 f \n']
+        xref.extend(b'%010d 00000 n \n' % offset for offset in self.offsets[1:])
+        self._write(b''.join(xref))
+        self._write(b'trailer\n<</Size %d /Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' % (len(self.offsets), xref_position))
+
+
+def concatenate_pdfs(sources, out_path):
+    """
+    Write in out_path a PDF with the pages of all the sources, in order. The pages are copied one source at a time
+    and written as soon as they are read, so the memory used doesn't depend on the number of sources or pages. If a
+    source can't be read, no partial PDF is left in out_path
+
+    :param sources: iterable of paths or binary file objects of PDF files
+    :param out_path: str. path where to store the PDF file
+    """
+    try:
+        with open(out_path, 'wb') as f:
+            writer = PdfWriter(f)
+            for source in sources:
+                writer.add_pdf(source)
+            writer.close()
+    except Exception:
+        if os.path.isfile(out_path):
+            os.remove(out_path)
+        raise
+
+
+def write_text(writer, lines):
+    """
+    Write the lines of text in A4 pages, wrapping the long lines. Every page is written as soon as its lines are known,
+    so only one page of text is kept in memory. The font is Helvetica (Arial) with the Windows ANSI encoding, and the
+    characters that it doesn't have are replaced by '?'
+
+    :param writer: PdfWriter
+    :param lines: iterable of str, e.g. a text file
+    """
+    font = writer.add_object(b'<</Type /Font /BaseFont /Helvetica /Subtype /Type1 /Encoding /WinAnsiEncoding>>')
+    resources = b'/Font <</F1 %d 0 R>>' % font
+    wrapper = TextWrapper(width=TEXT_WRAP_WIDTH, break_long_words=True)
+    page_lines = []
+    n_pages = 0
+    for line in lines:
+        for short_line in wrapper.wrap(text=line):
+            page_lines.append(short_line)
+            if len(page_lines) == TEXT_LINES_PER_PAGE:
+                writer.add_page(A4_WIDTH, A4_HEIGHT, _text_content(page_lines), resources)
+                n_pages += 1
+                page_lines = []
+    # a text without lines still gets an empty page
+    if page_lines or n_pages == 0:
+        writer.add_page(A4_WIDTH, A4_HEIGHT, _text_content(page_lines), resources)
+
+
+def _text_content(lines):
+    """
+    Return the content stream of a page with the given lines
+    """
+    content = [b'BT /F1 %d Tf %s %s Td %s TL' % (TEXT_FONT_SIZE, _number(TEXT_X), _number(TEXT_FIRST_BASELINE),
+                                                 _number(TEXT_LEADING))]
+    for line in lines:
+        text = line.encode('cp1252', 'replace')
+        text = text.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)').replace(b'\r', b'\\r')
+        content.append(b'(%s) Tj T*' % text)
+    content.append(b'ET')
+    return b'\n'.join(content)
+
+
+def _number(value):
+    """
+    Format a number for a PDF content stream
+    """
+    if float(value).is_integer():
+        return b'%d' % value
+    return (b'%.4f' % value).rstrip(b'0')
+
+
+def _serialize(obj):
+    """
+    Return a direct PyPDF2 object (a name, a number, a string...) as PDF bytes
+    """
+    stream = io.BytesIO()
+    obj.write_to_stream(stream, None)
+    return stream.getvalue()
@@ -0,0 +1,44 @@
+import threading
+from queue import Queue
+
+
+class MergeWorker:
+    def __init__(self, merge, on_error, max_pending=2):
+        """
+        Background thread that merges the PDFs of the patients and writes their metadata while the next patients are
+        being converted. The patients wait in a bounded queue: when max_pending patients are already waiting, submit
+        blocks until the worker catches up, so the memory used by the pipeline stays bounded.
+
+        :param merge: function called with the manifest of a patient, that merges its PDFs and writes its metadata
+        :param on_error: function called with the error message when merge raises an exception
+        :param max_pending: maximum number of patients waiting to be merged
+        """
+        self.merge = merge
+        self.on_error = on_error
+        self._queue = Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, manifest):
+        """
+        Add a patient to the queue of the patients to merge. Block if the queue is full
+        """
+        self._queue.put(manifest)
+
+    def close(self):
+        """
+        Wait until all the submitted patients have been merged, and stop the worker
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            manifest = self._queue.get()
+            if manifest is None:
+                break
+            try:
+                self.merge(manifest)
+            except Exception as e:
+                # handle errors in the merging process
+                self.on_error(str(e))
@@ -0,0 +1,148 @@
+import os
+import sqlite3
+from pathlib import Path
+from data_formatter.util import make_dir, remove_data_format
+
+
+class FilesRecord:
+    def __init__(self, record_path, batch_size=1000):
+        """
+        Persistent record of the input files that have already been processed. The paths are stored in a SQLite table
+        indexed on the path, so checking if a file has been processed takes constant time independently of the number
+        of files in the record, and the new paths are committed in batches.
+
+        If record_path is a .txt file (the format used by the previous versions), the record is stored in a .db file
+        with the same name, and the paths in the .txt file are imported the first time the record is opened.
+
+        The record also keeps the fingerprints of the patient folders processed in incremental mode, and the content
+        hashes of their files, so that a file whose size and modification time haven't changed is never hashed again.
+
+        :param record_path: path to the record file
+        :param batch_size: number of added paths after which the record is committed to disk
+        """
+        if record_path.lower().endswith('.txt'):
+            self.txt_path = record_path
+            self.db_path = remove_data_format(record_path) + '.db'
+        else:
+            self.txt_path = remove_data_format(record_path) + '.txt'
+            self.db_path = record_path
+        self.batch_size = batch_size
+        self._pending = 0
+
+        make_dir(Path(self.db_path).parent)
+        new_record = not os.path.isfile(self.db_path)
+        self._conn = sqlite3.connect(self.db_path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS patients (folder TEXT PRIMARY KEY, fingerprint TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                           'hash TEXT)')
+        self._conn.commit()
+
+        # import the paths of the old txt record, if there is one
+        if new_record and os.path.isfile(self.txt_path):
+            self.import_txt(self.txt_path)
+
+    def __contains__(self, path):
+        """
+        Return True if the exact path has already been recorded
+        """
+        # the path is cleaned like in add, e.g. a file name with undecodable bytes
+        cur = self._conn.execute('SELECT 1 FROM files WHERE path = ?', (_clean(path),))
+        return cur.fetchone() is not None
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def add(self, path):
+        """
+        Add path to the record. The record is committed to disk every self.batch_size paths
+        """
+        self._conn.execute('INSERT OR IGNORE INTO files (path) VALUES (?)', (_clean(path),))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def remove(self, paths):
+        """
+        Remove the paths from the record, so that their files are processed again
+        """
+        self._conn.executemany('DELETE FROM files WHERE path = ?', ((_clean(path),) for path in paths))
+
+    def get_fingerprint(self, folder):
+        """
+        Return the fingerprint of the patient folder saved in the last run, or None if there is none
+        """
+        cur = self._conn.execute('SELECT fingerprint FROM patients WHERE folder = ?', (_clean(folder),))
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+
+    def set_fingerprint(self, folder, fingerprint):
+        """
+        Save the fingerprint of the patient folder. It is committed with the next commit
+        """
+        self._conn.execute('INSERT OR REPLACE INTO patients (folder, fingerprint) VALUES (?, ?)',
+                           (_clean(folder), fingerprint))
+
+    def remove_fingerprint(self, folder):
+        """
+        Remove the fingerprint of the patient folder, so that the patient is processed again in incremental mode
+        """
+        self._conn.execute('DELETE FROM patients WHERE folder = ?', (_clean(folder),))
+
+    def get_hash(self, path, size, mtime):
+        """
+        Return the content hash of the file in path, if it has been saved when the file had the same size and
+        modification time, otherwise None
+        """
+        cur = self._conn.execute('SELECT hash FROM hashes WHERE path = ? AND size = ? AND mtime = ?',
+                                 (_clean(path), size, mtime))
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+
+    def set_hash(self, path, size, mtime, content_hash):
+        """
+        Save the content hash of the file in path, with its size and modification time
+        """
+        self._conn.execute('INSERT OR REPLACE INTO hashes (path, size, mtime, hash) VALUES (?, ?, ?, ?)',
+                           (_clean(path), size, mtime, content_hash))
+
+    def merge(self, db_path):
+        """
+        Add the files, the fingerprints and the content hashes of the record in db_path, e.g. of a shard, to this record.
+        The fingerprints and the hashes of db_path replace the ones of the same folders and files
+        """
+        self.commit()
+        self._conn.execute('ATTACH DATABASE ? AS other', (db_path,))
+        try:
+            self._conn.execute('INSERT OR IGNORE INTO files (path) SELECT path FROM other.files')
+            self._conn.execute('INSERT OR REPLACE INTO patients (folder, fingerprint) '
+                               'SELECT folder, fingerprint FROM other.patients')
+            self._conn.execute('INSERT OR REPLACE INTO hashes (path, size, mtime, hash) '
+                               'SELECT path, size, mtime, hash FROM other.hashes')
+            self.commit()
+        finally:
+            self._conn.execute('DETACH DATABASE other')
+
+    def import_txt(self, txt_path):
+        """
+        Import the paths in a txt record, where every line is a path
+        """
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            paths = ((line.rstrip('\n'),) for line in f if line.rstrip('\n'))
+            self._conn.executemany('INSERT OR IGNORE INTO files (path) VALUES (?)', paths)
+        self.commit()
+
+    def commit(self):
+        self._conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+
+def _clean(path):
+    """
+    Replace the characters that can't be stored in UTF-8, e.g. the surrogates of undecodable file names
+    """
+    return path.encode('utf-8', 'replace').decode('utf-8')
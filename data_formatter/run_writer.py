@@ -0,0 +1,115 @@
+import json
+import time
+import threading
+from data_formatter.util import remove_data_format
+
+# the buffers are written to disk when they hold more than this number of characters ...
+FLUSH_SIZE = 64 * 1024
+# ... or when their oldest line has been waiting for more than this number of seconds
+FLUSH_INTERVAL = 5.0
+
+
+class RunWriter:
+    def __init__(self, log_path, err_path, record, jsonl_path=None, flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        """
+        Single writer of the outputs of a run: the log file, the err file, the record of the processed files and a JSON
+        lines file with an event for every processed file and every error. The lines are kept in memory and every file
+        is opened once per flush: when the buffers hold more than flush_size characters, when their oldest line is
+        older than flush_interval seconds, and at the patient boundaries, with commit.
+
+        The writing methods can be called from more threads (e.g. by the merge worker), but the record can only be used
+        by the thread that opened it, so processed and commit must be called by that thread. The worker processes don't
+        write: they return their error messages to the process that owns the writer.
+
+        :param log_path: path to the log file
+        :param err_path: path to the err file
+        :param record: FilesRecord of the processed files
+        :param jsonl_path: path to the JSON lines file. By default it is log_path with the .jsonl extension
+        :param flush_size: int. number of buffered characters that triggers a flush
+        :param flush_interval: float. seconds after which a buffered line triggers a flush
+        """
+        self.record = record
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        if jsonl_path is None:
+            jsonl_path = remove_data_format(log_path) + '.jsonl'
+        self.jsonl_path = jsonl_path
+        # buffered lines, by file
+        self._buffers = {log_path: [], err_path: [], jsonl_path: []}
+        self._size = 0
+        self._first_time = None  # time of the oldest buffered line
+        self._lock = threading.Lock()
+        self.log_path = log_path
+        self.err_path = err_path
+
+    def log(self, text):
+        """
+        Add text to the log file
+        """
+        self._write(self.log_path, text)
+
+    def error(self, error_msg, path=None):
+        """
+        Add error_msg to the err file, and an error event to the JSON lines file. path is the file that caused the
+        error, if any
+        """
+        self._write(self.err_path, error_msg)
+        self.event('error', path=path, error=error_msg)
+
+    def processed(self, path, error_msg=None, skipped=False):
+        """
+        Record that the file in path has been processed: converted if error_msg is None, otherwise not converted
+        because of error_msg. A file skipped because it was processed in a previous run is not added to the record
+        again
+        """
+        if skipped:
+            self.event('file', path=path, status='skipped')
+            return
+        if error_msg is not None:
+            self._write(self.err_path, error_msg)
+        self.event('file', path=path, status='converted' if error_msg is None else 'error', error=error_msg)
+        self.record.add(path)
+
+    def event(self, event, **fields):
+        """
+        Add a JSON line with the event name, the time and the fields to the JSON lines file
+        """
+        fields = dict(event=event, time=round(time.time(), 3), **fields)
+        self._write(self.jsonl_path, json.dumps(fields, ensure_ascii=False))
+
+    def commit(self):
+        """
+        Commit the record and write the buffers to disk, e.g. at the end of a patient
+        """
+        self.record.commit()
+        self.flush()
+
+    def flush(self):
+        """
+        Write the buffered lines to their files
+        """
+        with self._lock:
+            buffers = {path: lines for path, lines in self._buffers.items() if lines}
+            for path in buffers:
+                self._buffers[path] = []
+            self._size = 0
+            self._first_time = None
+            for path, lines in buffers.items():
+                text = '\n'.join(lines) + '\n'
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(text.encode('utf-8', 'replace').decode('utf-8'))
+
+    def close(self):
+        self.commit()
+
+    def _write(self, path, line):
+        with self._lock:
+            self._buffers[path].append(line)
+            self._size += len(line) + 1
+            now = time.monotonic()
+            if self._first_time is None:
+                self._first_time = now
+            full = self._size >= self.flush_size or now - self._first_time >= self.flush_interval
+        if full:
+            self.flush()
@@ -0,0 +1,58 @@
+import os
+import sys
+import hashlib
+import subprocess
+
+
+def parse_shard(text):
+    """
+    Return the shard K/N as the tuple (K, N), where 1 <= K <= N
+    """
+    try:
+        k, n = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError('The shard must be given as K/N, e.g. 1/4, not {}'.format(text)) from None
+    if not 1 <= k <= n:
+        raise ValueError('The shard K/N must have 1 <= K <= N, not {}'.format(text))
+    return k, n
+
+
+def shard_index(case_nr, n_shards):
+    """
+    Return the shard, from 1 to n_shards, of the patients with the given case number. The leading zeros of the case
+    number are ignored, like in the metadata files, and the hash is the same on every machine and in every run, unlike
+    the hash of Python
+    """
+    digest = hashlib.sha1(case_nr.lstrip('0').encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % n_shards + 1
+
+
+def in_shard(patient_data, shard):
+    """
+    Return True if the patient with the given first_name, last_name, birthday, case_nr belongs to the shard (K, N)
+    """
+    k, n = shard
+    return patient_data[3] is not None and shard_index(patient_data[3], n) == k
+
+
+def shard_path(path, shard):
+    """
+    Return the path of the file of the shard (K, N) that takes the place of the file in path, e.g. log.shard-1-of-4.txt
+    for log.txt
+    """
+    root, ext = os.path.splitext(path)
+    return '{}.shard-{}-of-{}{}'.format(root, shard[0], shard[1], ext)
+
+
+def run_local_shards(argv, n_shards):
+    """
+    Run the n_shards shards of a run at the same time on this machine, each in its own process as if it was a node,
+    with the arguments argv of python -m data_formatter. Return when all of them are done, and raise a RuntimeError if
+    any failed
+    """
+    processes = [subprocess.Popen([sys.executable, '-m', 'data_formatter'] + list(argv) +
+                                  ['--shard', '{}/{}'.format(k, n_shards)])
+                 for k in range(1, n_shards + 1)]
+    failed = ['{}/{}'.format(k, n_shards) for k, process in enumerate(processes, 1) if process.wait() != 0]
+    if failed:
+        raise RuntimeError('The shards {} failed'.format(', '.join(failed)))
@@ -0,0 +1,166 @@
+import os
+import shutil
+import random
+import tempfile
+from PIL import Image
+from data_formatter.pdf_writer import PdfWriter, write_text
+
+FIRST_NAMES = ['Anna', 'Hans', 'Elisabeth', 'Karl', 'Anna-Maria', 'Luca', 'José', 'Dominik', 'Chantal', 'Hans-Peter']
+LAST_NAMES = ['Müller', 'Meier', 'Schmid', 'Keller', 'Weber', 'Huber', 'Öztürk', 'Brunner', 'Frei', 'Zimmermann']
+
+# formats of the patient folder names, as found in the input folders and handled by extract_patient_data
+NAME_FORMATS = [
+    '{last} {first} geb. {day:02d}.{month:02d}.{year} Fall-Nr {case_nr}',
+    '{last}, {first} geb.{day:02d}.{month:02d}.{year} {case_nr}',
+    '{case_nr} {last}, {first} geb {day}.{month}.{year}',
+    '{first} {last} {day:02d}.{month:02d}.{year} - {case_nr}',
+    '{day:02d}-{month:02d}-{year} {last}, Fall-Nr {case_nr} {first}',
+    '{last} {first} Fallnr {case_nr}',
+]
+
+# share of the files of every data format
+DEFAULT_FORMATS = {'jpg': 0.3, 'png': 0.1, 'txt': 0.3, 'pdf': 0.3}
+
+# names of the folders that are not patient folders
+GROUP_NAMES = ['Station {}', 'Ambulatorium {}', 'Archiv {}']
+SUBFOLDER_NAMES = ['Bilder', 'Berichte', 'Verlauf', '2019', '2020']
+INVALID_FOLDERS = ['Arch', 'Stoma', 'Wund', 'Patientenunterlagen']
+
+
+def patient_folder_name(index, rng):
+    """
+    Return a random patient folder name, in one of NAME_FORMATS, with a case_nr that is unique for every index
+    """
+    return rng.choice(NAME_FORMATS).format(first=rng.choice(FIRST_NAMES), last=rng.choice(LAST_NAMES),
+                                           day=rng.randint(1, 28), month=rng.randint(1, 12),
+                                           year=rng.randint(1920, 2000), case_nr=str(5000001 + index))
+
+
+def make_templates(templates_dir, formats, n_variants=4, image_size=(1200, 900), text_size=4096, pdf_pages=1,
+                   msg_template=None, seed=0):
+    """
+    Write n_variants files of every data format in templates_dir, and return their paths by data format. The files of
+    the tree are copies of these templates, so that generating a large tree doesn't take longer than processing it
+
+    :param formats: iterable of data formats among jpg, png, txt, pdf and msg
+    :param image_size: (width, height) of the images in pixels
+    :param text_size: size of the text files in bytes
+    :param pdf_pages: number of pages of the PDF files
+    :param msg_template: path to an .msg file, used for the msg format. The emails can't be generated
+    """
+    rng = random.Random(seed)
+    templates = {}
+    for data_format in formats:
+        paths = []
+        for i in range(n_variants):
+            path = os.path.join(templates_dir, '{}{}.{}'.format(data_format, i, data_format))
+            if data_format in ('jpg', 'png'):
+                color = tuple(rng.randrange(256) for _ in range(3))
+                image = Image.new('RGB', image_size, color)
+                # some noise, so that the images don't compress to nothing
+                for _ in range(200):
+                    x, y = rng.randrange(image_size[0]), rng.randrange(image_size[1])
+                    image.paste(tuple(rng.randrange(256) for _ in range(3)), (x, y, x + 20, y + 20))
+                image.save(path)
+            elif data_format == 'txt':
+                words = [rng.choice(FIRST_NAMES + LAST_NAMES + ['Wunde', 'Verband', 'gereinigt', 'Befund'])
+                         for _ in range(text_size // 6)]
+                text = '\n'.join(' '.join(words[j:j + 12]) for j in range(0, len(words), 12))
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(text[:text_size])
+            elif data_format == 'pdf':
+                with open(path, 'wb') as f:
+                    writer = PdfWriter(f)
+                    write_text(writer, ['Bericht {} Seite {}'.format(i, page) for page in range(pdf_pages)
+                                        for _ in range(60)])
+                    writer.close()
+            elif data_format == 'msg':
+                if msg_template is None:
+                    raise ValueError('The msg files can only be copied from a msg_template')
+                shutil.copyfile(msg_template, path)
+            else:
+                raise ValueError('Can not generate files of data format {}'.format(data_format))
+            paths.append(path)
+        templates[data_format] = paths
+    return templates
+
+
+def generate_tree(root, n_files, files_per_patient=20, formats=None, n_variants=4, image_size=(1200, 900),
+                  text_size=4096, pdf_pages=1, msg_template=None, patients_per_group=500, max_depth=2,
+                  invalid_share=0.02, thumbs_share=0.3, seed=0):
+    """
+    Generate an input folder like the ones formatted by DataFormatter in root: group folders with the patient folders,
+    that have nested subfolders with the files of the patients, a few invalid folders without patients, and Thumbs.db
+    files. The files are copies of a few templates of every data format, and their modification times are spread over
+    some years. The tree is the same for the same arguments.
+
+    :param root: folder where the tree is generated. It must not exist
+    :param n_files: number of files in the patient folders, without the Thumbs.db files
+    :param files_per_patient: average number of files of a patient
+    :param formats: dict with the share of the files of every data format. By default DEFAULT_FORMATS
+    :param n_variants: number of different files of every data format
+    :param image_size: (width, height) of the images in pixels
+    :param text_size: size of the text files in bytes
+    :param pdf_pages: number of pages of the PDF files
+    :param msg_template: path to an .msg file, needed if formats has msg
+    :param patients_per_group: number of patient folders in every group folder
+    :param max_depth: maximum depth of the subfolders inside a patient folder
+    :param invalid_share: number of invalid folders, as a share of the patient folders
+    :param thumbs_share: share of the folders with a Thumbs.db file
+    :param seed: seed of the random choices
+    :return: dict with the number of patients, of files, of bytes and of files of every data format
+    """
+    if formats is None:
+        formats = DEFAULT_FORMATS
+    rng = random.Random(seed)
+    os.makedirs(root)
+    data_formats = list(formats)
+    weights = [formats[data_format] for data_format in data_formats]
+    summary = {'patients': 0, 'files': 0, 'bytes': 0, 'formats': dict.fromkeys(data_formats, 0)}
+    templates_dir = tempfile.mkdtemp()
+    try:
+        templates = make_templates(templates_dir, data_formats, n_variants, image_size, text_size, pdf_pages,
+                                   msg_template, seed)
+        sizes = {path: os.path.getsize(path) for paths in templates.values() for path in paths}
+        start_time = 1262304000  # 2010-01-01
+        index = 0
+        while summary['files'] < n_files:
+            group_index = index // patients_per_group
+            group = os.path.join(root, GROUP_NAMES[group_index % len(GROUP_NAMES)].format(group_index + 1))
+            patient = os.path.join(group, patient_folder_name(index, rng))
+            index += 1
+            summary['patients'] += 1
+            folders = [patient]
+            for _ in range(rng.randint(0, 3)):
+                depth = rng.randint(1, max_depth) if max_depth > 0 else 0
+                folders.append(os.path.join(patient, *rng.sample(SUBFOLDER_NAMES, depth)))
+            for folder in folders:
+                os.makedirs(folder, exist_ok=True)
+                if rng.random() < thumbs_share:
+                    with open(os.path.join(folder, 'Thumbs.db'), 'wb') as f:
+                        f.write(b'\0' * 512)
+            n_patient_files = min(rng.randint(1, 2 * files_per_patient - 1), n_files - summary['files'])
+            for i in range(n_patient_files):
+                data_format = rng.choices(data_formats, weights)[0]
+                template = rng.choice(templates[data_format])
+                # some files in the same folder have the same name
+                path = os.path.join(rng.choice(folders), '{}_{}.{}'.format(
+                    rng.choice(['Scan', 'Foto', 'Bericht', 'Dokument']), i % 7, data_format))
+                if os.path.exists(path):
+                    path = '{}_{}.{}'.format(path[:-len(data_format) - 1], i, data_format)
+                shutil.copyfile(template, path)
+                file_time = start_time + rng.randrange(10 * 365 * 24 * 3600)
+                os.utime(path, (file_time, file_time))
+                summary['files'] += 1
+                summary['bytes'] += sizes[template]
+                summary['formats'][data_format] += 1
+
+            if rng.random() < invalid_share:
+                # a folder without patients, e.g. an archive of the group
+                invalid = os.path.join(group, rng.choice(INVALID_FOLDERS), rng.choice(SUBFOLDER_NAMES))
+                os.makedirs(invalid, exist_ok=True)
+                shutil.copyfile(rng.choice(templates[data_formats[0]]),
+                                os.path.join(invalid, 'Dokument_{}.{}'.format(index, data_formats[0])))
+    finally:
+        shutil.rmtree(templates_dir, ignore_errors=True)
+    return summary
@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from contextlib import contextmanager
 
 
 
@@ -9,7 +10,12 @@ def make_dir(path):
     """
     if not os.path.isdir(path):
         make_dir(path.parent)
-        os.mkdir(path)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            # created in the meantime by another process, e.g. by another shard in the same output folder
+            if not os.path.isdir(path):
+                raise
 
 
 def search_str(file_path: str, string: str) -> bool:
@@ -114,3 +120,16 @@ def remove_data_format(file_pat):
             return file_pat[:-i]
         i += 1
     return file_pat
+
+
+@contextmanager
+def open_file(file, mode='rb'):
+    """
+    Open file if it is a path, otherwise use the file object as it is, without closing it. It lets the same function
+    work on files on disk and on files kept in memory (e.g. io.BytesIO)
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, mode) as f:
+            yield f
+    else:
+        yield file
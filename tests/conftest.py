@@ -0,0 +1,24 @@
+import os
+import pytest
+import data_formatter.util as util
+import data_formatter.data_formatter
+import data_formatter.inventory
+import data_formatter.pdf_converter
+
+# modules that use the path helpers of util
+PATH_HELPER_MODULES = [util, data_formatter.data_formatter, data_formatter.inventory, data_formatter.pdf_converter]
+
+
+@pytest.fixture(autouse=True)
+def path_helpers(monkeypatch):
+    """
+    get_root and get_directory_name only split the paths on backslashes, like the Windows paths of the input folders.
+    On the other platforms they are replaced by os.path.dirname and os.path.basename
+    """
+    if os.sep == '\\':
+        return
+    for module in PATH_HELPER_MODULES:
+        if hasattr(module, 'get_root'):
+            monkeypatch.setattr(module, 'get_root', os.path.dirname)
+        if hasattr(module, 'get_directory_name'):
+            monkeypatch.setattr(module, 'get_directory_name', os.path.basename)
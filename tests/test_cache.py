@@ -0,0 +1,79 @@
+import os
+import json
+import sqlite3
+import pytest
+from data_formatter.cache import LAST_USED_BATCH, ConversionCache
+from data_formatter.data_formatter import DataFormatter
+
+PATIENT = 'Muster Hans geb. 01.02.1950 Fall-Nr 001234567'
+
+
+def last_used(cache_dir, key):
+    conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'))
+    try:
+        return conn.execute('SELECT last_used FROM entries WHERE key = ?', (key,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_stats_are_counted_by_every_cache(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    pdf_path = str(tmp_path / 'file.pdf')
+    with open(pdf_path, 'wb') as f:
+        f.write(b'%PDF-1.4')
+    cache = ConversionCache(cache_dir)
+    other = ConversionCache(cache_dir)
+    try:
+        assert not cache.get('key', str(tmp_path / 'out0.pdf'))
+        cache.put('key', pdf_path)
+        assert cache.get('key', str(tmp_path / 'out1.pdf'))
+        assert other.get('key', str(tmp_path / 'out2.pdf'))
+        assert cache.stats() == (1, 1)
+        assert other.stats() == (1, 0)
+        other.add_stats(2, 3)
+        assert other.stats() == (3, 3)
+    finally:
+        cache.close()
+        other.close()
+
+
+def test_last_used_times_are_written_in_batches(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    pdf_path = str(tmp_path / 'file.pdf')
+    with open(pdf_path, 'wb') as f:
+        f.write(b'%PDF-1.4')
+    cache = ConversionCache(cache_dir)
+    try:
+        cache.put('key', pdf_path)
+        put_time = last_used(cache_dir, 'key')
+        for i in range(LAST_USED_BATCH - 1):
+            assert cache.get('key', str(tmp_path / 'out{}.pdf'.format(i)))
+        # the lookups haven't written to the index
+        assert last_used(cache_dir, 'key') == put_time
+        assert cache.get('key', str(tmp_path / 'out.pdf'))
+        assert last_used(cache_dir, 'key') > put_time
+    finally:
+        cache.close()
+
+
+def cache_event(formatter):
+    with open(os.path.splitext(formatter.log_path)[0] + '.jsonl', encoding='utf-8') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return [(event['hits'], event['misses']) for event in events if event['event'] == 'cache']
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_reports_its_own_hits_and_misses(tmp_path, workers):
+    folder = tmp_path / 'Data' / PATIENT
+    folder.mkdir(parents=True)
+    for i in range(4):
+        (folder / 'note{}.txt'.format(i)).write_text('note {}\n'.format(i), encoding='utf-8')
+    cache_dir = str(tmp_path / 'cache')
+
+    counts = []
+    for out in ('Out1', 'Out2'):
+        formatter = DataFormatter(str(tmp_path / 'Data'), str(tmp_path / out), workers=workers, cache_dir=cache_dir)
+        formatter.format()
+        counts.append(cache_event(formatter))
+    # the second run finds in the cache the files converted by the first one
+    assert counts == [[(0, 4)], [(4, 0)]]
@@ -0,0 +1,108 @@
+import os
+import pytest
+from PIL import Image
+from data_formatter.benchmark import DECODE_MEMORY_MARGIN, peak_memory
+import data_formatter.pdf_converter
+from data_formatter.data_formatter import DataFormatter
+from data_formatter.pdf_converter import file_to_pdf, image_to_pdf, resample_image
+
+# decode ceiling of the test, far below the 137 MB of a decoded 8000 x 6000 RGB image
+MAX_MEMORY = 64 * 1024 * 1024
+
+
+def save_large_image(path):
+    # a 48 MP photo
+    image = Image.new('RGB', (8000, 6000), (200, 120, 40))
+    # some detail, so that the image is not a single color
+    for x in range(0, 8000, 400):
+        image.paste((20, 40, 220), (x, 0, x + 100, 6000))
+    image.save(path)
+    image.close()
+
+
+@pytest.mark.parametrize('data_format', ['jpg', 'png'])
+def test_large_image_stays_under_the_ceiling(tmp_path, data_format):
+    in_path = str(tmp_path / 'large.{}'.format(data_format))
+    out_path = str(tmp_path / 'large.pdf')
+    save_large_image(in_path)
+
+    memory = peak_memory(resample_image, in_path, out_path, MAX_MEMORY)
+    if memory is None:
+        pytest.skip('the peak memory can not be measured on this platform')
+    assert memory <= MAX_MEMORY + DECODE_MEMORY_MARGIN
+    with open(out_path, 'rb') as f:
+        assert f.read(5) == b'%PDF-'
+
+
+@pytest.mark.parametrize('data_format, mode, size', [
+    ('jpg', 'CMYK', (800, 600)),  # can't be embedded as it is
+    ('png', 'RGBA', (800, 600)),  # alpha channel
+    ('jpg', 'RGB', (5472, 3648)),  # 20 MP, more than MAX_EMBED_PIXELS
+])
+def test_image_under_the_ceiling_is_resized(tmp_path, monkeypatch, data_format, mode, size):
+    in_path = str(tmp_path / 'image.{}'.format(data_format))
+    out_path = str(tmp_path / 'image.pdf')
+    Image.new(mode, size).save(in_path)
+
+    def load_reduced(*args):
+        raise AssertionError('the image should be decoded at full resolution')
+
+    monkeypatch.setattr(data_formatter.pdf_converter, 'load_reduced', load_reduced)
+    image_to_pdf(in_path, out_path)
+    with open(out_path, 'rb') as f:
+        assert f.read(5) == b'%PDF-'
+
+
+def spy_load_reduced(monkeypatch):
+    """
+    Return the list of the memory ceilings of the calls to load_reduced, that decodes the images above the ceiling
+    """
+    ceilings = []
+    load_reduced = data_formatter.pdf_converter.load_reduced
+
+    def spy(in_file, size, max_memory):
+        ceilings.append(max_memory)
+        return load_reduced(in_file, size, max_memory)
+
+    monkeypatch.setattr(data_formatter.pdf_converter, 'load_reduced', spy)
+    return ceilings
+
+
+def test_default_ceiling_reduces_a_48_mp_photo(tmp_path, monkeypatch):
+    in_path = str(tmp_path / 'large.jpg')
+    save_large_image(in_path)
+    ceilings = spy_load_reduced(monkeypatch)
+
+    assert file_to_pdf(in_path, str(tmp_path / 'large.pdf')) is None
+    assert len(ceilings) == 1
+
+
+def test_file_to_pdf_stays_under_a_lower_ceiling(tmp_path):
+    max_memory = 32 * 1024 * 1024
+    in_path = str(tmp_path / 'large.png')
+    out_path = str(tmp_path / 'large.pdf')
+    save_large_image(in_path)
+
+    memory = peak_memory(file_to_pdf, in_path, out_path, False, max_memory)
+    if memory is None:
+        pytest.skip('the peak memory can not be measured on this platform')
+    assert memory <= max_memory + DECODE_MEMORY_MARGIN
+    with open(out_path, 'rb') as f:
+        assert f.read(5) == b'%PDF-'
+
+
+@pytest.mark.parametrize('max_decode_memory, reduced', [(None, False), (1024 * 1024, True)])
+def test_formatter_passes_its_ceiling_to_the_converters(tmp_path, monkeypatch, max_decode_memory, reduced):
+    folder = tmp_path / 'Data' / 'Muster Hans geb. 01.02.1950 Fall-Nr 001234567'
+    folder.mkdir(parents=True)
+    # 4.3 MB decoded, and with an alpha channel, so that it is resized
+    Image.new('RGBA', (1200, 900), (200, 120, 40, 255)).save(str(folder / 'photo.png'))
+    ceilings = spy_load_reduced(monkeypatch)
+
+    options = {} if max_decode_memory is None else {'max_decode_memory': max_decode_memory}
+    formatter = DataFormatter(str(tmp_path / 'Data'), str(tmp_path / 'Out'), time_order='modification', **options)
+    formatter.format()
+    assert ceilings == ([max_decode_memory] if reduced else [])
+    with open(formatter.err_path, encoding='utf-8') as f:
+        assert f.read() == ''
+    assert os.path.isfile(os.path.join(str(tmp_path / 'Out'), folder.name, 'Muster, Hans Fall-Nr 001234567.pdf'))
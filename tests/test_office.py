@@ -0,0 +1,81 @@
+import pytest
+from data_formatter.office import OfficeBackend, FakeBackend, SessionPool
+
+
+def convert_documents(pool, tmp_path, n_documents):
+    """
+    Convert n_documents documents with the pool, and return the number of conversions that failed
+    """
+    in_path = tmp_path / 'letter.docx'
+    in_path.write_bytes(b'letter')
+    errors = 0
+    for i in range(n_documents):
+        try:
+            pool.convert(str(in_path), str(tmp_path / 'letter{}.pdf'.format(i)))
+        except OSError:
+            errors += 1
+    return errors
+
+
+def test_sessions_are_reused(tmp_path):
+    backend = FakeBackend()
+    pool = SessionPool(backend)
+    assert convert_documents(pool, tmp_path, 10) == 0
+    assert backend.n_starts == 1
+    assert pool.n_restarts == 0
+    assert (tmp_path / 'letter9.pdf').read_bytes() == b'letter'
+
+
+def test_sessions_are_recycled(tmp_path):
+    backend = FakeBackend()
+    pool = SessionPool(backend, max_documents=3)
+    assert convert_documents(pool, tmp_path, 10) == 0
+    # a new session after the documents 3, 6 and 9
+    assert backend.n_starts == 4
+    assert pool.n_restarts == 3
+
+
+def test_crashed_sessions_are_replaced(tmp_path):
+    backend = FakeBackend(crash_every=4)
+    pool = SessionPool(backend)
+    # the conversions 4 and 8 crash their session
+    assert convert_documents(pool, tmp_path, 10) == 2
+    assert backend.n_starts == 3
+    assert pool.n_restarts == 2
+
+
+def test_crashes_and_recycling(tmp_path):
+    backend = FakeBackend(crash_every=3)
+    pool = SessionPool(backend, max_documents=2)
+    assert convert_documents(pool, tmp_path, 10) == 3
+    # the sessions are recycled after the documents 2, 5 and 8, and crash on the documents 3, 6 and 9
+    assert backend.n_starts == 7
+    assert pool.n_restarts == 6
+
+
+def test_dead_idle_session_is_replaced(tmp_path):
+    backend = FakeBackend()
+    pool = SessionPool(backend)
+    assert convert_documents(pool, tmp_path, 1) == 0
+    # the application was closed while the session was idle
+    pool._idle[0].handle['alive'] = False
+    assert convert_documents(pool, tmp_path, 1) == 0
+    assert backend.n_starts == 2
+    assert pool.n_restarts == 1
+    pool.close()
+    assert not pool._idle
+
+
+def test_incomplete_backend_fails_when_created():
+    class NoStopBackend(OfficeBackend):
+        def start(self):
+            return {}
+
+        def convert(self, session, in_path, out_path):
+            pass
+
+        def is_alive(self, session):
+            return True
+
+    with pytest.raises(TypeError):
+        NoStopBackend()
@@ -0,0 +1,15 @@
+import json
+import pytest
+from data_formatter.patient_parser import CORPUS_PATH, check_corpus, extract_patient_data
+
+with open(CORPUS_PATH, 'r', encoding='utf-8') as f:
+    CORPUS = json.load(f)
+
+
+@pytest.mark.parametrize('name, expected', CORPUS, ids=range(len(CORPUS)))
+def test_corpus(name, expected):
+    assert extract_patient_data(name) == expected
+
+
+def test_batch_corpus():
+    assert check_corpus() == []
@@ -0,0 +1,13 @@
+from data_formatter.pdf_converter import converters, get_converter
+
+
+def test_msg_is_process_safe_only_if_its_attachments_are():
+    # the attachments of an email are converted in the process that converts the email
+    assert not get_converter('msg').process_safe or all(converter.process_safe for converter in converters.values())
+
+
+def test_aliases():
+    assert get_converter('JPEG') is get_converter('jpg')
+    assert get_converter('doc') is get_converter('docx')
+    assert get_converter('xls') is get_converter('xlsx')
+    assert get_converter('zip') is None
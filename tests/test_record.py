@@ -0,0 +1,29 @@
+import os
+from data_formatter.record import FilesRecord
+
+
+def test_undecodable_path(tmp_path):
+    # a file name with bytes that are not UTF-8, as decoded by os.scandir
+    path = os.path.join(str(tmp_path), 'a\udcff.jpg')
+    record = FilesRecord(str(tmp_path / 'files_record.db'))
+    try:
+        assert path not in record
+        record.add(path)
+        record.commit()
+        assert path in record
+        record.remove([path])
+        assert path not in record
+    finally:
+        record.close()
+
+
+def test_txt_record_is_imported(tmp_path):
+    with open(str(tmp_path / 'files_record.txt'), 'w', encoding='utf-8') as f:
+        f.write('/in/a.jpg\n/in/b.pdf\n')
+    record = FilesRecord(str(tmp_path / 'files_record.db'))
+    try:
+        assert len(record) == 2
+        assert '/in/a.jpg' in record
+        assert '/in/c.txt' not in record
+    finally:
+        record.close()
@@ -0,0 +1,166 @@
+import os
+import pytest
+from data_formatter.data_formatter import DataFormatter, merge_pdfs
+from data_formatter.journal import Journal, CONVERTED, MERGED
+from data_formatter.manifest import PatientManifest
+from data_formatter.pdf_converter import file_to_pdf
+from data_formatter.record import FilesRecord
+
+PATIENT = 'Muster Hans geb. 01.02.1950 Fall-Nr 001234567'
+MERGED_NAME = 'Muster, Hans Fall-Nr 001234567'
+
+
+def make_patient(root, name=PATIENT, n_files=3):
+    """
+    Create a patient folder with n_files text files in root/Data, and return the paths of the files
+    """
+    folder = os.path.join(str(root), 'Data', name)
+    os.makedirs(folder)
+    paths = []
+    for i in range(n_files):
+        path = os.path.join(folder, 'note{}.txt'.format(i))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('note {}\n'.format(i) * 20)
+        os.utime(path, (1000000 + i, 1000000 + i))
+        paths.append(path)
+    return paths
+
+
+def make_formatter(root):
+    return DataFormatter(os.path.join(str(root), 'Data'), os.path.join(str(root), 'Out'), time_order='modification',
+                         print_folders=True)
+
+
+def out_dir(root, name=PATIENT):
+    return os.path.join(str(root), 'Out', name)
+
+
+def journal_entries(formatter):
+    journal = Journal(formatter.journal_path)
+    try:
+        return journal.entries()
+    finally:
+        journal.close()
+
+
+def read_err(formatter):
+    with open(formatter.err_path, encoding='utf-8') as f:
+        return f.read()
+
+
+def interrupt(root, formatter, state, paths, name=PATIENT):
+    """
+    Leave the output folder, the record and the journal as a run interrupted in the given state ('converting',
+    'converted' or 'merged') would: the files are converted and in the record, and from 'converted' saved in the
+    manifest sidecar
+    """
+    patient_out_dir = out_dir(root, name)
+    os.makedirs(patient_out_dir)
+    manifest = PatientManifest(patient_out_dir)
+    jobs = []
+    for i, path in enumerate(paths):
+        out_path = os.path.join(patient_out_dir, 'note{}0.pdf'.format(i))
+        assert file_to_pdf(path, out_path) is None
+        manifest.add(out_path, os.path.getmtime(path))
+        jobs.append([path, out_path])
+    record = FilesRecord(formatter.record_path)
+    for path in paths:
+        record.add(path)
+    record.close()
+    journal = Journal(formatter.journal_path)
+    journal.begin(patient_out_dir, os.path.dirname(paths[0]), jobs)
+    if state != 'converting':
+        manifest.save()
+        journal.set_state(patient_out_dir, CONVERTED)
+    if state == 'merged':
+        # the merged PDF has been written, the metadata file hasn't
+        merge_pdfs(manifest)
+        journal.set_state(patient_out_dir, MERGED)
+    journal.close()
+
+
+def test_interrupted_while_converting(tmp_path):
+    paths = make_patient(tmp_path)
+    formatter = make_formatter(tmp_path)
+    interrupt(tmp_path, formatter, 'converting', paths)
+
+    formatter.format()
+    # the files are removed from the record and converted again
+    assert sorted(os.listdir(out_dir(tmp_path))) == [MERGED_NAME + '.jpl', MERGED_NAME + '.pdf']
+    assert journal_entries(formatter) == []
+    assert 'ignored' not in open(formatter.log_path, encoding='utf-8').read()
+
+
+def test_interrupted_after_converting(tmp_path):
+    paths = make_patient(tmp_path)
+    formatter = make_formatter(tmp_path)
+    interrupt(tmp_path, formatter, 'converted', paths)
+
+    formatter.format()
+    assert sorted(os.listdir(out_dir(tmp_path))) == [MERGED_NAME + '.jpl', MERGED_NAME + '.pdf']
+    assert journal_entries(formatter) == []
+
+
+def test_interrupted_after_merging(tmp_path):
+    paths = make_patient(tmp_path)
+    formatter = make_formatter(tmp_path)
+    interrupt(tmp_path, formatter, 'merged', paths)
+
+    formatter.format()
+    assert sorted(os.listdir(out_dir(tmp_path))) == [MERGED_NAME + '.jpl', MERGED_NAME + '.pdf']
+    assert journal_entries(formatter) == []
+
+
+def test_failed_merge_is_not_retried(tmp_path):
+    # a valid patient folder without first name: the name of the merged PDF can't be built
+    name = 'Muster 1234567'
+    make_patient(tmp_path, name)
+    formatter = make_formatter(tmp_path)
+
+    formatter.format()
+    assert 'Was not possible to merge the PDFs of the patient' in read_err(formatter)
+    assert journal_entries(formatter) == []
+    # the converted PDFs are left in the output folder, without the manifest sidecar
+    assert sorted(os.listdir(out_dir(tmp_path, name))) == ['note00.pdf', 'note10.pdf', 'note20.pdf']
+
+    formatter = make_formatter(tmp_path)
+    formatter.format()
+    assert read_err(formatter) == ''
+    assert journal_entries(formatter) == []
+
+
+def test_failed_interrupted_merge_is_not_retried(tmp_path):
+    name = 'Muster 1234567'
+    paths = make_patient(tmp_path, name)
+    formatter = make_formatter(tmp_path)
+    interrupt(tmp_path, formatter, 'converted', paths, name)
+
+    formatter.format()
+    assert 'Was not possible to merge the PDFs of the patient' in read_err(formatter)
+    assert journal_entries(formatter) == []
+
+    formatter = make_formatter(tmp_path)
+    formatter.format()
+    assert read_err(formatter) == ''
+
+
+@pytest.mark.parametrize('interrupted', [False, True])
+def test_failed_metadata_is_not_retried(tmp_path, monkeypatch, interrupted):
+    paths = make_patient(tmp_path)
+    formatter = make_formatter(tmp_path)
+    if interrupted:
+        interrupt(tmp_path, formatter, 'merged', paths)
+
+    def make_metadata(self, out_path_dir):
+        raise OSError('The network share is not available')
+
+    with monkeypatch.context() as m:
+        m.setattr(DataFormatter, '_make_metadata', make_metadata)
+        formatter.format()
+    assert 'Was not possible to write the metadata of the patient' in read_err(formatter)
+    assert journal_entries(formatter) == []
+
+    formatter = make_formatter(tmp_path)
+    formatter.format()
+    assert read_err(formatter) == ''
+    assert journal_entries(formatter) == []
@@ -0,0 +1,154 @@
+import os
+import csv
+import pytest
+from data_formatter.data_formatter import DataFormatter
+from data_formatter.journal import Journal, CONVERTED
+from data_formatter.record import FilesRecord
+from data_formatter.shard import run_local_shards
+from data_formatter.tree_generator import generate_tree
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+N_SHARDS = 3
+
+# like the path_helpers fixture of conftest, for the processes of the shards
+SITECUSTOMIZE = '''import os
+import data_formatter.util as util
+import data_formatter.data_formatter
+import data_formatter.inventory
+import data_formatter.pdf_converter
+
+for module in [util, data_formatter.data_formatter, data_formatter.inventory, data_formatter.pdf_converter]:
+    if hasattr(module, 'get_root'):
+        module.get_root = os.path.dirname
+    if hasattr(module, 'get_directory_name'):
+        module.get_directory_name = os.path.basename
+'''
+
+
+@pytest.fixture
+def tree(tmp_path):
+    input_folder = str(tmp_path / 'Data')
+    generate_tree(input_folder, 60, files_per_patient=4, formats={'txt': 0.6, 'pdf': 0.4}, text_size=512)
+    return input_folder
+
+
+@pytest.fixture
+def shard_processes(tmp_path, monkeypatch):
+    """
+    Run the processes of the shards with the package of this repository, and on the other platforms than Windows with
+    the path helpers replaced like in the tests
+    """
+    paths = [REPO_ROOT]
+    if os.sep != '\\':
+        site_dir = tmp_path / 'site'
+        site_dir.mkdir()
+        (site_dir / 'sitecustomize.py').write_text(SITECUSTOMIZE, encoding='utf-8')
+        paths.insert(0, str(site_dir))
+    if os.environ.get('PYTHONPATH'):
+        paths.append(os.environ['PYTHONPATH'])
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(paths))
+
+
+def output_files(out_dir):
+    """
+    Return the relative paths and sizes of the files in the patient folders of out_dir
+    """
+    files = {}
+    for dir_path, _, file_names in os.walk(out_dir):
+        if dir_path == out_dir:
+            continue
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            files[os.path.relpath(path, out_dir)] = os.path.getsize(path)
+    return files
+
+
+def input_files(input_folder):
+    return [os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(input_folder)
+            for file_name in file_names]
+
+
+def read_rows(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        return sorted(map(tuple, csv.reader(f)))
+
+
+def test_local_shards_are_combined_like_a_single_run(tmp_path, tree, shard_processes):
+    single_folder = str(tmp_path / 'Single')
+    single = DataFormatter(tree, single_folder)
+    single.format()
+    single.extract_csv(['csv', 'jsonl'])
+
+    sharded_folder = str(tmp_path / 'Sharded')
+    run_local_shards(['--input', tree, '--output', sharded_folder, '--export_format', 'csv', 'jsonl'], N_SHARDS)
+    sharded = DataFormatter(tree, sharded_folder)
+    sharded.combine_shards(N_SHARDS)
+
+    assert output_files(sharded_folder) == output_files(single_folder)
+    assert output_files(single_folder)
+    single_record = FilesRecord(single.record_path)
+    sharded_record = FilesRecord(sharded.record_path)
+    try:
+        assert len(sharded_record) == len(single_record)
+        assert [path in sharded_record for path in input_files(tree)] == [path in single_record
+                                                                           for path in input_files(tree)]
+    finally:
+        single_record.close()
+        sharded_record.close()
+    assert read_rows(os.path.join(sharded_folder, 'csv_file.csv')) == read_rows(os.path.join(single_folder,
+                                                                                             'csv_file.csv'))
+    with open(os.path.join(sharded_folder, 'patients.jsonl'), encoding='utf-8') as f:
+        assert len(f.readlines()) == len(read_rows(os.path.join(single_folder, 'csv_file.csv'))) - 1
+    with open(sharded.log_path, encoding='utf-8') as f:
+        log = f.read()
+    assert all('Shard {}/{}:'.format(k, N_SHARDS) in log for k in range(1, N_SHARDS + 1))
+
+
+def interrupt_shard(tree, out_folder, state=None):
+    """
+    Leave a patient of the shard 1/2 in the journal, in CONVERTING or in the given state
+    """
+    formatter = DataFormatter(tree, out_folder, shard=(1, 2))
+    out_dir = os.path.join(out_folder, 'Muster Hans geb. 01.02.1950 Fall-Nr 001234567')
+    journal = Journal(formatter.journal_path)
+    try:
+        journal.begin(out_dir, out_dir, [])
+        if state is not None:
+            journal.set_state(out_dir, state)
+    finally:
+        journal.close()
+    return out_dir
+
+
+def test_combine_lists_patients_not_merged(tmp_path, tree):
+    out_folder = str(tmp_path / 'Out')
+    for k in range(1, 3):
+        DataFormatter(tree, out_folder, shard=(k, 2)).format()
+    out_dir = interrupt_shard(tree, out_folder, CONVERTED)
+
+    formatter = DataFormatter(tree, out_folder)
+    formatter.combine_shards(2)
+    with open(formatter.err_path, encoding='utf-8') as f:
+        err = f.read()
+    assert 'The patient in {} of the shard 1/2 has not been merged'.format(out_dir) in err
+    assert os.path.isfile(formatter.record_path)
+
+
+def test_combine_refuses_shards_interrupted_while_converting(tmp_path, tree):
+    out_folder = str(tmp_path / 'Out')
+    for k in range(1, 3):
+        DataFormatter(tree, out_folder, shard=(k, 2)).format()
+    interrupt_shard(tree, out_folder)
+
+    formatter = DataFormatter(tree, out_folder)
+    with pytest.raises(ValueError, match='1/2 have been interrupted'):
+        formatter.combine_shards(2)
+    assert not os.path.isfile(formatter.record_path)
+
+
+def test_combine_refuses_missing_shards(tmp_path, tree):
+    out_folder = str(tmp_path / 'Out')
+    DataFormatter(tree, out_folder, shard=(1, 2)).format()
+
+    with pytest.raises(ValueError, match='2/2 have not been run'):
+        DataFormatter(tree, out_folder).combine_shards(2)